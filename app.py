@@ -1,237 +1,347 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-import random
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify
+import asyncio
+import contextvars
+import json
+import queue
+import threading
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 from flask_session import Session # Import Flask-Session
-from openai import OpenAI
+import metrics
+from llm_backends import LazyBackend, create_backend
+from game_store import GameStore, StaleGameError
+from round_queue import RoundQueue, RoundWorkerPool, JobFailed, job_status
+import reaper
+import rooms
+from models import STANCES, get_stance_category
+from engine import (MAX_ROUNDS, ROLES, INFLUENCE_ACTION_COSTS, validate_player_statement, charge_statement_token,
+                    play_round, play_round_async, regenerate_tokens, apply_influence, apply_influence_batch,
+                    create_player, new_game, schedule_speakers, listener_drift, ROLE_KEYWORDS, new_seed, round_rng, record)
+from history_index import HistoryIndex
 from dotenv import load_dotenv
 from pathlib import Path
 
-# Load environment variables from .env file
+# Load environment variables from .env file (a file read; nothing is built from them until first use)
 dotenv_path = Path('.') / '.env' # Explicitly point to .env in current directory
 load_dotenv(dotenv_path=dotenv_path)
 
-# --- Debug: Check if API key is loaded --- #
-print(f"DEBUG: OPENAI_API_KEY loaded from environ: {os.environ.get('OPENAI_API_KEY')}")
-# --- End Debug --- #
-
 # --- Setup ---
+# Importing this module only defines the app and its routes. create_app() applies
+# the configuration and sessions; the LLM client and the game store are built on
+# first use. So the module preloads cleanly in a pre-fork server master
+# (gunicorn --preload 'app:create_app()'), and each worker opens its own clients.
 app = Flask(__name__)
-app.secret_key = os.urandom(24) # More secure secret key
 
 # --- Server-Side Session Configuration ---
+# The session only carries the game id (plus the pre-game role choice and flash
+# messages); game data lives in the game-state store below.
 app.config['SESSION_TYPE'] = 'filesystem' # Store session data in files
 app.config['SESSION_PERMANENT'] = False # Session expires when browser closes
 app.config['SESSION_USE_SIGNER'] = True # Encrypt session cookie identifier
 app.config['SESSION_FILE_DIR'] = './.flask_session' # Optional: Specify directory
-Session(app) # Initialize the session extension
-
-# --- OpenAI Client Setup ---
-# IMPORTANT: Set the OPENAI_API_KEY environment variable!
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-if not client.api_key:
-    raise ValueError("ERROR: OPENAI_API_KEY environment variable not set. Please set it in your environment or in a .env file.")
-
-# --- Game Constants ---
-MAX_ROUNDS = 8
-MIN_STATEMENT_WORDS = 15 # New constant
-EVENT_PROBABILITY = 0.25 # 25% chance of an event each round
-TOKEN_REGEN_RATE = 2 # How many influence tokens characters regain each round
-INITIAL_TRUST = 50 # Default starting trust value (0-100)
-MAX_PLAYER_TOKENS = 10 # Maximum tokens the player can hold
-INFLUENCE_ACTION_COSTS = {
-    "gentle_persuasion": 1,
-    "strong_persuasion": 2,
-    "ally_recruitment": 3,
-    "pressure_opponent": 4,
-    "proxy_speaking": 5 # Note: Proxy speaking logic is complex, implement effects later
-}
-INFLUENCE_ACTION_EFFECTS = {
-    # Stance delta is towards player's general alignment (support/oppose project)
-    # Needs refinement - assumes player wants to pull target towards their stance.
-    # Simple approach: Positive delta = more support, Negative delta = more opposition.
-    # TODO: Make delta relative to player's stance vs target's stance.
-    "gentle_persuasion": {"stance_delta": 5, "trust_delta": 2, "history_log": "gently persuaded"},
-    "strong_persuasion": {"stance_delta": 15, "trust_delta": 10, "history_log": "strongly persuaded"},
-    "ally_recruitment": {"stance_delta": 0, "trust_delta": 15, "history_log": "tried to recruit"}, # Focus on trust gain for now
-    "pressure_opponent": {"stance_delta": -10, "trust_delta": -15, "history_log": "pressured"}, # Makes target more opposed/less supportive
-}
-MAX_TOKENS_FACTOR = 1.5 # Max tokens = initial * factor (prevents infinite hoarding)
-STANCES = { # Using descriptive keys
-    "support": "Support",
-    "oppose": "Oppose",
-    "neutral": "Neutral",
-    "compromise": "Compromise"
-}
-NEUTRAL_SCORE = 50
-SUPPORT_THRESHOLD_LOW = 61 # Score >= this means Support
-OPPOSE_THRESHOLD_HIGH = 39 # Score <= this means Oppose
-INITIAL_SUPPORT_SCORE = 75
-INITIAL_NEUTRAL_SCORE = 50
-INITIAL_OPPOSE_SCORE = 25
-INFLUENCE_SCORES = {
-    "developer": 2,
-    "local_resident": 1,
-    "council_member": 3,
-    "student_representative": 1
-}
-VICTORY_CONSENSUS_THRESHOLD = 6 # 6 out of 10 participants
-VICTORY_INFLUENCE_THRESHOLD = 9
-FAILURE_SUPPORT_THRESHOLD = 2 # Player + 2 others minimum to avoid instant failure
-CONSENSUS_THRESHOLD_PERCENT = 0.60 # 60% of participants must be 'Support'
-INFLUENCE_THRESHOLD_PERCENT = 0.60 # 60% of *total influence* must come from 'Support'
-FAILURE_SUPPORT_THRESHOLD_PERCENT = 0.25 # If 'Support' participants are <= 25%, it's a failure
-CRITICAL_CLIMATE_THRESHOLD = 20 # If climate drops <= 20, it's a failure
-
-# Sample names for AI characters
-SAMPLE_NAMES = [
-    "Alex Johnson", "Maria Garcia", "Chen Li", "Sam Williams", "Fatima Ahmed",
-    "David Smith", "Sophia Dubois", "Kenji Tanaka", "Olivia Brown", "Mohammed Khan",
-    "Isabelle Moreau", "Ben Carter", "Chloe Davis", "Raj Patel", "Zoe Miller"
-]
-
-# Define role details
-ROLES = {
-    "developer": {
-        "name": "Developer",
-        "description": "Represents the company planning the new development project.",
-        "objective": "Maximize profit while meeting minimum regulatory requirements.",
-        "influence": "Significant financial backing, technical expertise.",
-        "stance_distribution": { STANCES["support"]: 8, STANCES["neutral"]: 2 }, # 80% support, 20% neutral
-        "initial_influence_tokens": 6, # Updated
-        "initial_trust": INITIAL_TRUST
-    },
-    "local_resident": {
-        "name": "Local Resident",
-        "description": "Lives in the neighborhood affected by the development.",
-        "objective": "Preserve community character, minimize disruption, ensure fair compensation.",
-        "influence": "Community support, personal stakes.",
-        "stance_distribution": { STANCES["oppose"]: 6, STANCES["neutral"]: 4 }, # 60% oppose, 40% neutral
-        "initial_influence_tokens": 2, # Updated
-        "initial_trust": INITIAL_TRUST
-    },
-    "council_member": {
-        "name": "Council Member",
-        "description": "An elected official responsible for representing constituent interests.",
-        "objective": "Balance development benefits with community impact, uphold regulations.",
-        "influence": "Political network, regulatory power.",
-        "stance_distribution": { STANCES["neutral"]: 7, STANCES["support"]: 2, STANCES["oppose"]: 1 }, # 70% neutral, 20% support, 10% oppose
-        "initial_influence_tokens": 5, # Updated
-        "initial_trust": INITIAL_TRUST
-    },
-    "student_representative": {
-        "name": "Student Representative",
-        "description": "Advocates for student housing and campus-related needs.",
-        "objective": "Secure affordable housing options, improve campus accessibility.",
-        "influence": "Represents a large demographic, potential for mobilization.",
-        "stance_distribution": { STANCES["neutral"]: 5, STANCES["support"]: 4, STANCES["oppose"]: 1 }, # 50% neutral, 40% support, 10% oppose
-        "initial_influence_tokens": 3, # Updated
-        "initial_trust": INITIAL_TRUST
-    }
-}
-
-# Micro-Story Events
-MICRO_EVENTS = [
-    {
-        "id": "newspaper_scandal",
-        "text": "Islington Daily exposes potential irregularities in the developer's past projects! Public trust wavers.",
-        "effects": {"target": "role", "role_id": "local_resident", "stance_delta": -15, "climate_delta": -5}
-    },
-    {
-        "id": "student_subsidy",
-        "text": "The city government announces a surprise student housing subsidy program, boosting student optimism!",
-        "effects": {"target": "role", "role_id": "student_representative", "stance_delta": +15, "climate_delta": +5}
-    },
-    {
-        "id": "resident_emergency",
-        "text": "A key Local Resident representative has a sudden family emergency and must skip this round's discussion.",
-        "effects": {"target": "role_specific", "role_id": "local_resident", "skip_round": True} # Target one specific resident
-    },
-    {
-        "id": "unexpected_endorsement",
-        "text": "A respected independent urban planning group unexpectedly endorses the project's core ideas!",
-        "effects": {"target": "all", "stance_delta": +10, "climate_delta": +10}
-    },
-    {
-        "id": "developer_concession",
-        "text": "The Developer offers a minor concession regarding green spaces in the plan.",
-        "effects": {"target": "role", "role_id": "developer", "stance_delta": +5, "climate_delta": +5} # Small boost to developer's perceived score by others
-    },
-    {
-        "id": "budget_cuts_rumor",
-        "text": "Rumors circulate about potential city budget cuts impacting infrastructure needed for the project.",
-        "effects": {"target": "all", "stance_delta": -5, "climate_delta": -10}
-    },
-]
-
-def trigger_and_apply_event(characters, climate_score, current_round):
-    """
-    Checks if a random event should trigger based on EVENT_PROBABILITY.
-    If triggered, selects a random event, applies its effects to characters
-    and climate score, and returns the updated state and event text.
-    Handles stance clamping (0-100) and skip_round effect.
-    """
-    event_triggered_info = None
-    event_text = None
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE', './.flask_secret') # Shared secret if FLASK_SECRET_KEY is unset
+_configured = False
+_configure_lock = threading.Lock()
 
-    if random.random() < EVENT_PROBABILITY:
-        chosen_event = random.choice(MICRO_EVENTS)
-        event_text = f"**Event Occurred (Round {current_round}):** {chosen_event['text']}"
-        effects = chosen_event['effects']
-        event_triggered_info = chosen_event # Store for potential later use/logging
-        print(f"--- EVENT TRIGGERED: {chosen_event['id']} ---") # Server log
-
-        # Apply climate delta
-        climate_delta = effects.get('climate_delta', 0)
-        if climate_delta != 0:
-            original_climate = climate_score
-            climate_score = max(0, min(100, climate_score + climate_delta))
-            print(f"EVENT: Climate changed by {climate_delta} from {original_climate} to {climate_score}")
-
-        # Identify affected characters
-        stance_delta = effects.get('stance_delta', 0)
-        target_type = effects.get('target')
-        target_role = effects.get('role_id')
-        apply_skip = effects.get('skip_round', False)
-        affected_chars_for_event = []
-
-        if target_type == 'all':
-            affected_chars_for_event = characters
-        elif target_type == 'role' and target_role:
-            affected_chars_for_event = [char for char in characters if char['role_id'] == target_role]
-        elif target_type == 'role_specific' and target_role:
-             # Find all eligible characters for the specific role
-             eligible_chars = [char for char in characters if char['role_id'] == target_role and not char.get('skipped_round')] # Avoid affecting already skipped
-             if eligible_chars:
-                 # Pick one randomly from eligible ones
-                 char_to_affect = random.choice(eligible_chars)
-                 affected_chars_for_event = [char_to_affect]
-
-        # Apply effects to identified characters
-        for char in affected_chars_for_event:
-             # Apply stance delta
-             if stance_delta != 0:
-                 original_score = char['stance_score']
-                 char['stance_score'] = max(0, min(100, original_score + stance_delta))
-                 # Recalculate stance category after score change
-                 char['stance'] = get_stance_category(char['stance_score'])
-                 print(f"EVENT: Stance for {char['name']} ({char['role_id']}) changed by {stance_delta} -> {char['stance_score']} ({char['stance']})")
-
-             # Apply skip_round effect (only applies if target was role_specific)
-             if apply_skip and target_type == 'role_specific':
-                 char['skipped_round'] = True # Mark character as skipping this round
-                 print(f"EVENT: {char['name']} ({char['role_id']}) will skip this round due to event.")
-
-    # Return potentially modified characters, climate, and the event message
-    return characters, climate_score, event_text, event_triggered_info
-
-# --- Helper function to derive stance category from score --- #
-def get_stance_category(score):
-    if score <= OPPOSE_THRESHOLD_HIGH:
-        return STANCES["oppose"]
-    elif score >= SUPPORT_THRESHOLD_LOW:
-        return STANCES["support"]
-    else:
-        return STANCES["neutral"]
+def shared_secret_key(path=SECRET_KEY_FILE):
+    """
+    The session-signing secret every worker process agrees on: read from path,
+    or generated and written there by whichever process gets there first.
+    """
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50): # Another worker may be writing it right now
+            with open(path, 'rb') as f:
+                key = f.read()
+            if key:
+                return key
+            time.sleep(0.01)
+        raise RuntimeError(f"Secret key file {path} is empty.")
+    key = os.urandom(32)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+def create_app(config=None):
+    """
+    Configures and returns the app: FLASK_* environment variables (e.g.
+    FLASK_SECRET_KEY, FLASK_SESSION_FILE_DIR), then the `config` overrides, the
+    session secret (shared_secret_key() unless one is set) and server-side
+    sessions. Safe to call more than once; only the first call configures.
+    """
+    global _configured
+    with _configure_lock:
+        if not _configured:
+            app.config.from_prefixed_env()
+            app.config.update(config or {})
+            if not app.config.get('SECRET_KEY'):
+                app.config['SECRET_KEY'] = shared_secret_key()
+            Session(app) # Initialize the session extension
+            _configured = True
+    return app
+
+def _configure_on_first_request(wsgi_app):
+    # `flask run` and servers pointed at app:app skip create_app(); configure on the first request instead
+    def configured_wsgi_app(environ, start_response):
+        if not _configured:
+            create_app()
+        return wsgi_app(environ, start_response)
+    return configured_wsgi_app
+
+app.wsgi_app = _configure_on_first_request(app.wsgi_app)
+
+# --- LLM Backend Setup ---
+# Chosen with LLM_BACKEND: 'openai' (default), 'local' (OpenAI-compatible server at LLM_BASE_URL)
+# or 'stub' (offline canned dialogue for load testing). See llm_backends.py.
+# Built on the first LLM call, so a missing OPENAI_API_KEY only fails the calls that need it.
+# IMPORTANT: The 'openai' backend needs the OPENAI_API_KEY environment variable!
+llm = LazyBackend(create_backend)
+
+# --- Game-State Store ---
+GAME_STORE_PATH = os.environ.get('GAME_STORE_PATH', './game_state.sqlite3') # SQLite file (WAL mode)
+_game_store = None
+_game_store_lock = threading.Lock()
+
+# --- Storage Expiry ---
+# A background reaper (reaper.py) evicts finished and idle games from the store
+# and stale session files, and caps their combined size (LRU). REAPER=0 turns it off.
+REAPER_ENABLED = os.environ.get('REAPER', '1') != '0'
+REAPER_FINISHED_TTL = int(os.environ.get('REAPER_FINISHED_TTL', reaper.FINISHED_TTL)) # Seconds a finished game is kept
+REAPER_IDLE_TTL = int(os.environ.get('REAPER_IDLE_TTL', reaper.IDLE_TTL)) # Seconds an idle game or session is kept
+REAPER_MAX_BYTES = int(os.environ.get('REAPER_MAX_BYTES', reaper.MAX_BYTES)) # Combined size cap in bytes (0 = none)
+REAPER_INTERVAL = int(os.environ.get('REAPER_INTERVAL', reaper.SWEEP_INTERVAL)) # Seconds between sweeps
+_reaper = None
+
+def get_game_store():
+    """Returns the process-wide GameStore, opening it (and starting the reaper) on first use."""
+    global _game_store, _reaper
+    with _game_store_lock:
+        if _game_store is None:
+            _game_store = GameStore(GAME_STORE_PATH, render_round=render_history_round)
+            if REAPER_ENABLED:
+                stores = {'games': _game_store, 'sessions': reaper.SessionFiles(app.config['SESSION_FILE_DIR'])}
+                _reaper = reaper.Reaper(stores, finished_ttl=REAPER_FINISHED_TTL, idle_ttl=REAPER_IDLE_TTL,
+                                        max_bytes=REAPER_MAX_BYTES, interval=REAPER_INTERVAL).start()
+        return _game_store
+
+def load_current_game(with_history=True):
+    """Loads the game whose id is in the session, or None if there isn't one."""
+    return get_game_store().load_game(session.get('game_id'), with_history=with_history)
+
+def update_current_game(mutate, with_history=False):
+    """
+    Applies mutate(game) to the session's game and saves it, under the game's
+    lock and retried on a version conflict (see GameStore.update_game).
+    Returns (game, mutate's result), or (None, None) if there is no game.
+    """
+    game_id = session.get('game_id')
+    if not game_id:
+        return None, None
+    store = get_game_store()
+    with store.lock(game_id):
+        return store.update_game(game_id, mutate, with_history=with_history)
+
+def json_or_form():
+    """The request's fields: its JSON body if that is an object, else the posted form."""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else request.form
+
+# --- Round Queue ---
+# POST /negotiation/jobs always queues the round for background workers; with
+# ROUND_QUEUE=1 the plain form POST does too instead of playing it inline.
+# Workers run in this process (ROUND_WORKERS threads) or, with ROUND_WORKERS=0,
+# in a separate `python -m round_queue` process on the same store file.
+ROUND_QUEUE = os.environ.get('ROUND_QUEUE') == '1'
+ROUND_WORKERS = int(os.environ.get('ROUND_WORKERS', 4)) # In-process round workers (0 = none)
+_round_queue = None
+_round_workers = None
+
+def get_round_queue():
+    """Returns the process-wide RoundQueue, starting the in-process workers on first use."""
+    global _round_queue, _round_workers
+    get_game_store() # The store owns the file's schema; open it first
+    with _game_store_lock:
+        if _round_queue is None:
+            _round_queue = RoundQueue(GAME_STORE_PATH)
+            if ROUND_WORKERS > 0:
+                _round_workers = RoundWorkerPool(_round_queue, process_round_job, ROUND_WORKERS).start()
+        return _round_queue
+
+# --- Metrics & Tracing ---
+# GET /metrics serves the counters and histograms in metrics.py (Prometheus text format).
+# A request is traced if TRACE_REQUESTS=1 or it carries an 'X-Trace: 1' header: its span
+# tree is logged and the top-level spans are returned in a Server-Timing header.
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS') == '1'
+
+def _trace_requested():
+    return TRACE_REQUESTS or request.headers.get('X-Trace') == '1'
+
+@app.before_request
+def _start_request_trace():
+    if _trace_requested() and request.endpoint != 'metrics_endpoint':
+        metrics.start_trace(f"{request.method} {request.path}")
+
+@app.after_request
+def _finish_request_trace(response):
+    trace = metrics.finish_trace()
+    if trace is not None:
+        print(trace.format())
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+@app.teardown_request
+def _drop_request_trace(exc):
+    metrics.finish_trace() # No-op unless the request failed before after_request
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/metrics/storage')
+def storage_stats():
+    """The reaper's live game/session counts, bytes and evictions as JSON."""
+    get_game_store()
+    if _reaper is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **_reaper.stats()})
+
+# --- AI Constants ---
+# Game rules and balance constants live in engine.py
+AI_MODEL = os.environ.get('LLM_MODEL', "gpt-4.1-nano") # Use a cost-effective model suitable for simulation
+AI_ROUND_ENGINE = 'per_npc' # 'per_npc' (one call per character) or 'batched' (one call for the whole table)
+AI_BATCH_TOKENS_PER_NPC = 90 # max_tokens budget per character in a batched call
+AI_SPEAKERS_PER_ROUND = 4 # NPCs that get an LLM call each round, the most relevant first (None = every NPC)
+AI_RESPONSE_MODE = 'concurrent' # 'concurrent' (thread pool fan-out) or 'sequential'
+AI_RESPONSE_CONCURRENCY = 9 # Max simultaneous LLM calls per round
+AI_RESPONSE_TIMEOUT = 20 # Seconds allowed for a single NPC's LLM call
+# The two history options compose (see history_section). Retrieval alone needs no summary call per
+# round; compaction alone sends fewer prompt tokens once games get long (python -m benchmarks.prompt_size).
+HISTORY_COMPACTION = False # Summarize older rounds instead of pasting the whole history into prompts
+HISTORY_RETRIEVAL = True # Give each NPC the older statements most relevant to this turn (BM25)
+HISTORY_RETRIEVED_STATEMENTS = 4 # Older statements retrieved per NPC prompt
+HISTORY_VERBATIM_ROUNDS = 2 # Most recent rounds kept word-for-word in prompts
+HISTORY_TOKEN_BUDGET = 900 # Approximate token budget for the history section of a prompt
+HISTORY_SUMMARY_MAX_TOKENS = 150 # max_tokens for the rolling summary call
+NPC_MEMORY_ENTRIES = 3 # Earlier positions each AI character remembers about itself
+
+# --- Round Processing --- #
+
+def llm_npc_policy(table, negotiation_state, player_statement, rng=None, on_response=None, on_delta=None):
+    """NPC policy for engine.play_round: each AI character reacts through the LLM backend."""
+    # Render the history once for the whole table (see history_section)
+    with metrics.span('history'):
+        history_text, recall = history_section(negotiation_state, table, player_statement)
+    ai_responses_data = get_ai_responses(table, negotiation_state['history'], player_statement,
+                                         negotiation_state.get('negotiation_climate', 50),
+                                         on_response=on_response, on_delta=on_delta, history_text=history_text,
+                                         recall=recall)
+    remember_positions(table, ai_responses_data, negotiation_state['round'])
+    return ai_responses_data
+
+def run_negotiation_round(table, negotiation_state, player_statement, on_event=None, on_ai_response=None, on_ai_delta=None):
+    """
+    Plays one round in place with the LLM NPC policy (see engine.play_round),
+    then applies the next round's token regeneration so it is saved with the
+    round. Returns the event text if an event fired, else None.
+
+    on_event(event_text) fires right after an event triggers, before any AI call;
+    on_ai_response(ai_id, data) / on_ai_delta(ai_id, text) are passed through to
+    get_ai_responses so callers can stream NPC replies as they arrive.
+    """
+    def npc_policy(table, negotiation_state, player_statement, rng):
+        if isinstance(player_statement, dict): # A multiplayer room's round: the NPCs hear every human
+            player_statement = rooms.statements_text(table, player_statement)
+        return llm_npc_policy(table, negotiation_state, player_statement, rng, on_ai_response, on_ai_delta)
+    with metrics.ROUND_SECONDS.labels(AI_ROUND_ENGINE).time(), metrics.span('round', round=negotiation_state['round']):
+        event_text = play_round(table, negotiation_state, player_statement, npc_policy, on_event=on_event,
+                                rng=round_rng(negotiation_state))
+    regenerate_tokens_once(table, negotiation_state)
+    return event_text
+
+def round_submission_error(game, player_statement, submitted_round=None):
+    """
+    Why this statement can't be played as the game's current round, as
+    (message, category, http_status), or None if it can. submitted_round is the
+    round the player's page showed: a resubmitted form (double click, client
+    retry) names a round that has already been played and is turned away.
+    """
+    negotiation_state = game.negotiation_state
+    if negotiation_state.get('outcome') or negotiation_state['round'] > MAX_ROUNDS:
+        return 'The negotiation has already ended.', 'error', 409
+    if submitted_round is not None and submitted_round != negotiation_state['round']:
+        return f"Round {submitted_round} has already been played.", 'info', 409
+    statement_error = validate_player_statement(player_statement, game.table.player)
+    if statement_error:
+        return (*statement_error, 400)
+    return None
+
+def submit_round(game, player_statement, submitted_round=None):
+    """
+    Queues the game's current round with this statement. Returns (job, None),
+    or (None, (message, category, http_status)) if it can't be queued. A round
+    that was already submitted returns its existing job.
+    """
+    queue = get_round_queue()
+    round_number = game.negotiation_state['round'] if submitted_round is None else submitted_round
+    job = queue.job_for(game.id, round_number)
+    if job and job.status != 'failed':
+        return job, None # Already submitted (e.g. a double click or client retry)
+    error = round_submission_error(game, player_statement, submitted_round)
+    if error:
+        return None, error
+    job, _ = queue.submit(game.id, round_number, player_statement)
+    return job, None
+
+def give_up(game):
+    """Ends the negotiation at the player's request (a no-op if it has already ended)."""
+    negotiation_state = game.negotiation_state
+    if not negotiation_state.get('outcome'):
+        negotiation_state['outcome'] = 'Player Gave Up'
+        negotiation_state['final_round'] = negotiation_state['round'] # Record when they gave up
+        record(negotiation_state, 'outcome', outcome=negotiation_state['outcome'])
+
+def regeneration_due(negotiation_state):
+    """Whether this round's start-of-round token regeneration is still to be applied (never on round 1)."""
+    return negotiation_state['round'] > 1 and negotiation_state.get('tokens_regenerated_round') != negotiation_state['round']
+
+def regenerate_tokens_once(table, negotiation_state):
+    """Start-of-round token regeneration, applied at most once per round (not after the game has ended)."""
+    if regeneration_due(negotiation_state) and not negotiation_state.get('outcome'):
+        regenerate_tokens(table, negotiation_state)
+        negotiation_state['tokens_regenerated_round'] = negotiation_state['round']
+
+def process_round_job(job):
+    """
+    Round worker: plays one queued round (the POST /negotiation pipeline) and
+    saves the game. Safe to re-run: a round the game has already moved past
+    is reported, not replayed.
+    """
+    store = get_game_store()
+    with store.lock(job.game_id):
+        return _process_round_job(store, job)
+
+def _process_round_job(store, job):
+    game = store.load_game(job.game_id)
+    if game is None:
+        raise JobFailed('Game not found.')
+    negotiation_state = game.negotiation_state
+    if negotiation_state['round'] > job.round_number:
+        # Played by an earlier attempt that died before acknowledging the job
+        return {'round': negotiation_state['round'], 'outcome': negotiation_state.get('outcome'), 'event': None}
+    if negotiation_state['round'] < job.round_number or negotiation_state.get('outcome'):
+        raise JobFailed('The negotiation is not at this round.')
+    if rooms.is_room(game):
+        return _play_room_round(store, game)
+    player = game.table.player
+    statement_error = validate_player_statement(job.statement, player)
+    if statement_error:
+        raise JobFailed(statement_error[0])
+    charge_statement_token(player, negotiation_state, job.statement)
+    event_text = run_negotiation_round(game.table, negotiation_state, job.statement)
+    store.save_game(game)
+    return {'round': negotiation_state['round'], 'outcome': negotiation_state.get('outcome'), 'event': event_text}
 
 @app.route('/', methods=['GET', 'POST'])
 def role_selection():
@@ -239,6 +349,7 @@ def role_selection():
         player_role_id = request.form.get('role')
         if player_role_id in ROLES:
             session['player_role_id'] = player_role_id
+            session['hosting_room'] = request.form.get('mode') == 'room' # 'Host a Multiplayer Room' button
             # Redirect to customization page
             return redirect(url_for('character_customization')) # Updated redirect
         else:
@@ -247,8 +358,36 @@ def role_selection():
 
     # Clear any previous session data when returning to role selection
     session.pop('player_role_id', None)
-    session.pop('player_profile', None)
-    return render_template('role_selection.html', roles=ROLES)
+    session.pop('game_id', None)
+    session.pop('hosting_room', None)
+    session.pop('joining_room', None)
+    return render_template('role_selection.html', roles=ROLES, hosting=True)
+
+def player_profile_from_form(form):
+    """The player's profile fields from the customization form. Returns (profile, error message or None)."""
+    # Collect player profile data from form
+    player_profile = {
+        'name': form.get('name'),
+        'age': form.get('age'),
+        'gender': form.get('gender'),
+        'local_born': form.get('local_born'),
+        'has_children': form.get('has_children'),
+        'num_children': form.get('num_children') if form.get('has_children') == 'Yes' else 0,
+        'marital_status': form.get('marital_status'),
+        'backstory': form.get('backstory')
+    }
+
+    # Basic validation for num_children if has_children is Yes
+    if player_profile['has_children'] == 'Yes' and not player_profile['num_children']:
+        return player_profile, "Please enter the number of children."
+    try:
+        player_profile['num_children'] = int(player_profile['num_children'])
+        if player_profile['has_children'] == 'Yes' and player_profile['num_children'] < 1:
+            raise ValueError()
+    except (ValueError, TypeError):
+        if player_profile['has_children'] == 'Yes':
+            return player_profile, "Please enter a valid number of children (1 or more)."
+    return player_profile, None
 
 # Character Customization Route
 @app.route('/customize', methods=['GET', 'POST'])
@@ -262,64 +401,24 @@ def character_customization():
     player_role_name = ROLES[player_role_id]['name']
 
     if request.method == 'POST':
-        # Collect player profile data from form
-        player_profile = {
-            'role_id': player_role_id,
-            'role_name': player_role_name,
-            'name': request.form.get('name'),
-            'age': request.form.get('age'),
-            'gender': request.form.get('gender'),
-            'local_born': request.form.get('local_born'),
-            'has_children': request.form.get('has_children'),
-            'num_children': request.form.get('num_children') if request.form.get('has_children') == 'Yes' else 0,
-            'marital_status': request.form.get('marital_status'),
-            'backstory': request.form.get('backstory')
-        }
+        player_profile, error = player_profile_from_form(request.form)
+        if error:
+            return render_template('customization.html', player_role_name=player_role_name, error=error)
 
-        # Basic validation for num_children if has_children is Yes
-        if player_profile['has_children'] == 'Yes' and not player_profile['num_children']:
-             # Ideally, add flash message here for better UX
-             return render_template('customization.html', player_role_name=player_role_name, error="Please enter the number of children.")
-        try:
-            player_profile['num_children'] = int(player_profile['num_children'])
-            if player_profile['has_children'] == 'Yes' and player_profile['num_children'] < 1:
-                raise ValueError()
-        except (ValueError, TypeError):
-             if player_profile['has_children'] == 'Yes':
-                 return render_template('customization.html', player_role_name=player_role_name, error="Please enter a valid number of children (1 or more).")
-
-        # Add initial player game state info
-        player_profile['is_player'] = True
-        player_profile['id'] = 'player_0' # Unique ID for player
-        player_profile['influence'] = INFLUENCE_SCORES.get(player_role_id, 1) # Get influence score
-        player_profile['initial_stance'] = STANCES["support"] # Player always supports their own goal initially
-        player_profile['stance_score'] = {
-            STANCES["support"]: INITIAL_SUPPORT_SCORE,
-            STANCES["neutral"]: INITIAL_NEUTRAL_SCORE,
-            STANCES["oppose"]: INITIAL_OPPOSE_SCORE
-        }.get(player_profile['initial_stance'], INITIAL_NEUTRAL_SCORE) # Default to neutral if somehow invalid
-        player_profile['influence_tokens'] = ROLES[player_role_id]['initial_influence_tokens']
-        player_profile['max_tokens'] = MAX_PLAYER_TOKENS # Use the new constant
-        player_profile['trust_value'] = INITIAL_TRUST
-        player_profile['stance'] = get_stance_category(player_profile['stance_score']) # Set initial stance category
-
-        session['player_profile'] = player_profile
-
-        # Prepare full character list for negotiation
-        ai_opponents = generate_ai_opponents(player_profile['role_id'])
-        for opponent in ai_opponents:
-            opponent['stance'] = get_stance_category(opponent['stance_score']) # Set initial stance category
-        all_characters = ai_opponents + [player_profile] # Player added last before shuffle
-        random.shuffle(all_characters) # Shuffle characters for display order
-        session['characters'] = all_characters # Store the list
-
-        # Initialize negotiation state
-        session['negotiation_state'] = {
-            'round': 1,
-            'history': [], # List of rounds, each round is a dict: {'character_id': statement}
-            'outcome': None, # Will store win/loss reason
-            'negotiation_climate': 50 # Initial climate score (0-100)
-        }
+        if session.get('joining_room'):
+            return join_room_seat(session['joining_room'], player_role_id, player_profile)
+        if session.get('hosting_room'):
+            # A room is a stored game like any other; this browser holds its host seat
+            game = get_game_store().create_game(*rooms.new_room(create_player(player_role_id, **player_profile)))
+            remember_room_seat(game.id, game.table.player.id)
+            return redirect(url_for('room', room_id=game.id))
+
+        # Seat the player with the AI opponents and set up the negotiation state
+        table, negotiation_state = new_game(create_player(player_role_id, **player_profile), seed=new_seed())
+
+        # Store the new game; the session only keeps its id
+        game = get_game_store().create_game(table, negotiation_state)
+        session['game_id'] = game.id
 
         # Redirect to negotiation stage
         return redirect(url_for('negotiation'))
@@ -334,11 +433,11 @@ def character_customization():
 def negotiation_group():
     # This page is now less relevant in the main flow but can be kept for debugging
     # or showing the initial group before the first round starts.
-    characters = session.get('characters')
-    if not characters:
+    game = load_current_game(with_history=False)
+    if not game or not len(game.table):
         return redirect(url_for('role_selection')) # Need characters setup first
 
-    return render_template('negotiation_group.html', characters=characters)
+    return render_template('negotiation_group.html', characters=game.table)
 
 
 # --- Negotiation Stage --- #
@@ -346,219 +445,513 @@ def negotiation_group():
 @app.route('/negotiation', methods=['GET', 'POST'])
 def negotiation():
     # Ensure negotiation has been initialized
-    if 'negotiation_state' not in session or 'characters' not in session or 'player_profile' not in session:
+    game = load_current_game()
+    if not game:
         flash("Game session not found or incomplete. Please start a new game.", "error")
         return redirect(url_for('role_selection'))
 
-    negotiation_state = session['negotiation_state']
-    characters = session.get('characters', [])
-    player_profile = session.get('player_profile', None)
-    current_round = negotiation_state['round']
+    negotiation_state = game.negotiation_state
+    table = game.table
+    player = table.player
 
     if request.method == 'POST':
         action = request.form.get('action') # Check which button was pressed
 
         if action == 'give_up':
-            negotiation_state['outcome'] = 'Player Gave Up'
-            negotiation_state['final_round'] = negotiation_state['round'] # Record when they gave up
+            update_current_game(give_up)
             flash('You have chosen to end the negotiation.', 'warning')
-            session['negotiation_state'] = negotiation_state
-            session.modified = True
             return redirect(url_for('negotiation'))
 
         # If action wasn't 'give_up', assume 'submit_statement'
         player_statement = request.form.get('player_statement', '').strip()
-        word_count = len(player_statement.split())
+        submitted_round = request.form.get('round', type=int)
 
-        # --- Check Minimum Word Count --- #
-        if not player_statement: # Handle empty submission separately if needed
-            flash('Please enter your statement.', 'warning')
-            return redirect(url_for('negotiation'))
-        elif word_count < MIN_STATEMENT_WORDS:
-            flash(f'Your statement must be at least {MIN_STATEMENT_WORDS} words long (currently {word_count}). Please elaborate.', 'error')
+        if ROUND_QUEUE:
+            # Hand the round to the workers; the page polls the job until it's done
+            job, error = submit_round(game, player_statement, submitted_round)
+            if error:
+                flash(error[0], error[1])
             return redirect(url_for('negotiation'))
 
-        # --- Token Cost for Statement --- #
-        player_tokens = player_profile.get('influence_tokens', 0)
-        if player_tokens < 1:
-            flash('Not enough Influence Tokens to make a statement.', 'error')
-            # Need to pass existing state back to template on redirect
-            # This requires GET logic, so redirect is simpler here.
-            return redirect(url_for('negotiation'))
-        else:
-            # Deduct token cost
-            player_profile['influence_tokens'] -= 1
-            # Also update the player character in the main list
-            for char in characters:
-                if char.get('is_player'):
-                    char['influence_tokens'] = player_profile['influence_tokens']
-                    break
-            print(f"Player statement cost: 1 token. Remaining: {player_profile['influence_tokens']}")
-
-        # --- Proceed with round logic only if submitting and word count is met ---
-        player_id = session['player_profile']['id']
-
-        # --- Store previous stance *category* before potential updates --- #
-        # Note: We store the *category* derived from the score at the start of the round
-        for char in characters:
-            if not char.get('is_player'): # Only for AI characters
-                # Store category based on score *before* AI response potentially changes it
-                char['previous_stance_category'] = get_stance_category(char.get('stance_score', NEUTRAL_SCORE))
-
-        if player_statement:
-            round_dialogue = {player_id: player_statement} # Start round with player
-
-            # --- Clear Previous Skip Flags & Trigger/Apply Event --- #
-            for char in characters:
-                char.pop('skipped_round', None) # Remove flag from previous round if set
-
-            climate_score = negotiation_state.get('negotiation_climate', 50)
-            # Get current round *before* potential event happens
-            current_round = negotiation_state['round']
-            characters, climate_score, event_text, _ = trigger_and_apply_event(characters, climate_score, current_round)
-            negotiation_state['negotiation_climate'] = climate_score # Update climate in state
+        store = get_game_store()
+        with store.lock(game.id):
+            # Reload under the lock: a request that held it may have just played this round
+            game = load_current_game()
+            if not game: # Evicted by the reaper since the load above
+                flash("Game session not found or incomplete. Please start a new game.", "error")
+                return redirect(url_for('role_selection'))
+            negotiation_state = game.negotiation_state
+
+            # --- Check Round, Minimum Word Count & Token Cost --- #
+            error = round_submission_error(game, player_statement, submitted_round)
+            if error:
+                flash(error[0], error[1])
+                return redirect(url_for('negotiation'))
+            charge_statement_token(game.table.player, negotiation_state, player_statement)
+
+            # --- Proceed with round logic only if submitting and word count is met ---
+            event_text = run_negotiation_round(game.table, negotiation_state, player_statement)
             if event_text:
                 flash(event_text, 'info') # Display event message to player
 
-            # Update characters in session *before* AI responds, so AI sees event effects
-            session['characters'] = characters
-
-            # --- Core AI Logic --- #
-            ai_responses_data = get_ai_responses(characters, negotiation_state['history'], player_statement, climate_score) # Renamed variable
-            round_dialogue.update({ai_id: data['response'] for ai_id, data in ai_responses_data.items()}) # Add AI statements
-
-            # --- Update Character Stance Scores --- #
-            for char in characters:
-                if not char.get('is_player'): # Only update AI characters
-                    ai_id = char.get('id')
-                    if ai_id in ai_responses_data:
-                        new_score = ai_responses_data[ai_id]['new_score']
-                        old_score = char.get('stance_score', NEUTRAL_SCORE)
-                        if new_score != old_score:
-                            print(f"Updating stance score for {char['name']}: {old_score} -> {new_score}") # Debug print
-                        char['stance_score'] = new_score # Update the score in the character list
-                        char['stance'] = get_stance_category(char['stance_score']) # Update stance category
-
-            # --- Update Negotiation Climate --- #
-            total_score_change = 0
-            ai_count = 0
-            for char in characters:
-                if not char.get('is_player'):
-                    ai_id = char.get('id')
-                    if ai_id in ai_responses_data:
-                        old_score = char.get('stance_score', NEUTRAL_SCORE) - ai_responses_data[ai_id].get('score_change', 0) # Estimate previous score
-                        new_score = char.get('stance_score', NEUTRAL_SCORE)
-                        total_score_change += (new_score - old_score)
-                        ai_count += 1
-
-            if ai_count > 0:
-                average_change = total_score_change / ai_count
-                climate_change_factor = 2 # How much average score change affects climate
-                climate_change = round(average_change * climate_change_factor)
-                current_climate = negotiation_state.get('negotiation_climate', 50)
-                new_climate = current_climate + climate_change
-                new_climate = max(0, min(100, new_climate)) # Clamp 0-100
-                negotiation_state['negotiation_climate'] = new_climate
-                print(f"Climate Change: {climate_change:+}, New Climate: {new_climate}/100 (Avg Score Change: {average_change:.1f})")
-
-            # Add the complete round dialogue to history
-            negotiation_state['history'].append(round_dialogue)
-
-            # Increment round number *before* checking victory or saving state
-            negotiation_state['round'] += 1
-
-            # Check for victory/end condition *after* updating round number
-            if negotiation_state['round'] > MAX_ROUNDS:
-                negotiation_state['outcome'] = check_victory(characters, negotiation_state.get('negotiation_climate', 50))
-
-            # Save the final updated state back to session *before* redirecting
-            session['negotiation_state'] = negotiation_state
-            session['characters'] = characters # Save potentially updated characters (stances)
-            session.modified = True # Explicitly mark session as modified
+            # Save the final updated state (new round, stances, tokens) *before* redirecting
+            try:
+                store.save_game(game)
+            except StaleGameError:
+                flash('The game was changed elsewhere while this round was played; the round was discarded.', 'error')
 
         # Redirect to GET to show updated state
         return redirect(url_for('negotiation'))
 
     # GET Request: Render the negotiation page
-    # Save state back to session before rendering
-    session['negotiation_state'] = negotiation_state
-    session['characters'] = characters # Ensure characters (with previous_stance) is saved
-    session.modified = True # Mark session as modified
-
-    # Prepare characters data for template, adding the derived stance category
-    characters_for_template = []
-    for char in characters:
-        char_copy = char.copy()
-        char_copy['stance'] = get_stance_category(char.get('stance_score', NEUTRAL_SCORE))
-        # Pass the stored previous category for comparison in template
-        char_copy['previous_stance'] = char.get('previous_stance_category')
-        characters_for_template.append(char_copy)
+    # A round still with the workers owns the game state: don't regenerate over it
+    pending_job = get_round_queue().active_job(game.id) if ROUND_QUEUE else None
 
-    climate_score = negotiation_state.get('negotiation_climate', 50) # Get climate score
+    # Rounds regenerate tokens as they finish; this catches up a game saved before they did
+    if regeneration_due(negotiation_state) and not negotiation_state.get('outcome') and not pending_job:
+        game, _ = update_current_game(lambda game: regenerate_tokens_once(game.table, game.negotiation_state),
+                                      with_history=True)
+        negotiation_state = game.negotiation_state
+        table = game.table
+        player = table.player
 
-    # Regenerate Influence Tokens for ALL characters
-    characters = session.get('characters', [])
-    player_profile = session.get('player_profile', None)
-    player_char_in_list = next((char for char in characters if char.get('is_player')), None)
-    if negotiation_state['round'] > 1: # Don't regen on first round entry
-        print("--- Regenerating Influence Tokens ---")
-        for char in characters:
-            current_tokens = char.get('influence_tokens', 0)
-            if char.get('is_player'):
-                # Player regeneration: +1 per round, up to MAX_PLAYER_TOKENS
-                regen_amount = 1 # Base regeneration for player
-                bonus_token = 0 # Initialize bonus token
-                # --- Award Conversion Bonus --- #
-                if session.get('conversion_bonus_pending'):
-                    bonus_token = 1
-                    print("Awarding +1 bonus token for previous NPC conversion!")
-                    session.pop('conversion_bonus_pending', None) # Consume the flag
-                # --- End Conversion Bonus --- #
-                total_regen = regen_amount + bonus_token
-                new_tokens = min(current_tokens + total_regen, MAX_PLAYER_TOKENS)
-                char['influence_tokens'] = new_tokens
-                # Also update the separate player_profile dict if it exists
-                if player_profile and player_profile['id'] == char['id']:
-                    player_profile['influence_tokens'] = new_tokens
-                    print(f"Regenerating tokens for Player: {current_tokens} + {regen_amount} (base) + {bonus_token} (bonus) -> {new_tokens} (Max: {MAX_PLAYER_TOKENS})")
-            else:
-                # AI regeneration: Flat rate based on TOKEN_REGEN_RATE
-                regen_amount = TOKEN_REGEN_RATE # Use the flat rate defined
-                max_tokens = char.get('max_tokens', int(char.get('initial_tokens', 6) * MAX_TOKENS_FACTOR))
-                new_tokens = min(current_tokens + regen_amount, max_tokens)
-                char['influence_tokens'] = new_tokens
-                if new_tokens > current_tokens:
-                     print(f"Regenerating tokens for AI {char.get('name', 'Unknown')}: {current_tokens} -> {new_tokens} (Max: {max_tokens})")
- 
-    # Update session data after regeneration
-    session['characters'] = characters
-    if player_profile: # Ensure player_profile is saved if updated
-        session['player_profile'] = player_profile
+    climate_score = negotiation_state.get('negotiation_climate', 50) # Get climate score
 
     return render_template('negotiation.html',
                            state=negotiation_state,
-                           characters=characters_for_template,
-                           player_profile=player_profile,
+                           characters=table,
+                           player_profile=player,
                            INFLUENCE_ACTION_COSTS=INFLUENCE_ACTION_COSTS,
                            climate_score=climate_score, # Pass climate score
                            max_rounds=MAX_ROUNDS,
-                           stances_map=STANCES)
+                           stances_map=STANCES,
+                           pending_job=pending_job,
+                           round_queue=ROUND_QUEUE)
+
+@app.route('/negotiation/jobs', methods=['POST'])
+def submit_round_job():
+    """
+    Queues the current round with the form's player_statement (and optional
+    round, which makes a resubmit return the round's existing job). Responds
+    202 with the job and its status URL.
+    """
+    game = load_current_game(with_history=False)
+    if not game:
+        return jsonify({'success': False, 'message': 'Game session not found or incomplete. Please start a new game.'}), 400
+    job, error = submit_round(game, request.form.get('player_statement', '').strip(), request.form.get('round', type=int))
+    if error:
+        return jsonify({'success': False, 'message': error[0]}), error[2]
+    return jsonify({'success': True, 'job': job_status(job),
+                    'status_url': url_for('round_job_status', job_id=job.id)}), 202
+
+@app.route('/negotiation/jobs/<string:job_id>')
+def round_job_status(job_id):
+    """Status of one of this session's round jobs: queued, running, done (with result) or failed (with error)."""
+    job = get_round_queue().get(job_id)
+    if job is None or job.game_id != session.get('game_id'):
+        return jsonify({'success': False, 'message': 'Job not found.'}), 404
+    return jsonify({'success': True, 'job': job_status(job)})
+
+# --- JSON State API --- #
+
+def character_state(char):
+    """The public, changing fields of a character, as sent to the page."""
+    return {'id': char.id, 'name': char.name, 'role_name': char.role_name, 'is_player': char.is_player,
+            'stance_score': char.stance_score, 'stance': char.stance, 'trust_value': char.trust_value,
+            'influence_tokens': char.influence_tokens, 'influence': char.influence}
+
+def game_state(game, since=None, since_numbers=None):
+    """
+    The game as JSON for GET /negotiation/state. With since=N only rounds after
+    N are included, and only the characters that changed since round N was
+    saved (since_numbers, its stored numbers; all characters if unknown).
+    """
+    negotiation_state = game.negotiation_state
+    table = game.table
+    history = negotiation_state.get('history', [])
+    first_round = since or 0
+    if since and since_numbers is not None:
+        characters = table.changed_since(since_numbers)
+    else:
+        characters = list(table)
+    return {
+        'version': game.version,
+        'round': negotiation_state['round'],
+        'max_rounds': MAX_ROUNDS,
+        'outcome': negotiation_state.get('outcome'),
+        'climate': negotiation_state.get('negotiation_climate', 50),
+        'player_tokens': table.player.influence_tokens,
+        'since': since,
+        'characters': [character_state(char) for char in characters],
+        'rounds': [{'round': index + 1,
+                    'statements': [{'id': char_id, 'name': table.get(char_id).name if table.get(char_id) else 'Unknown',
+                                    'text': text} for char_id, text in history[index].items()]}
+                   for index in range(first_round, len(history))]
+    }
+
+def state_since(args):
+    """The ?since=<round> of a state request: None if absent; ValueError unless it is a round number (0 or more)."""
+    value = args.get('since')
+    if value is None:
+        return None
+    since = int(value)
+    if since < 0:
+        raise ValueError(f"Negative round: {since}")
+    return since
+
+def state_etag(version, since):
+    """ETag of a /negotiation/state response: the game version, plus the delta's base round."""
+    return f"{version}" if since is None else f"{version}-since-{since}"
+
+@app.route('/negotiation/state')
+def negotiation_state_api():
+    """
+    The current game as JSON (see game_state), or with ?since=<round> only what
+    changed after that round (400 if it is not a round number). Responses carry
+    a weak ETag of the game version, so a poll with If-None-Match gets a 304
+    without the game being loaded.
+    """
+    try:
+        since = state_since(request.args)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'since must be a round number (0 or more).'}), 400
+    game_id = session.get('game_id')
+    store = get_game_store()
+    version = store.game_version(game_id) if game_id else None
+    if version is None:
+        return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 404
+    etag = state_etag(version, since)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        game = store.load_game(game_id)
+        if game is None:
+            return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 404
+        since_numbers = store.round_numbers(game_id, since) if since else None
+        response = jsonify(game_state(game, since, since_numbers))
+        etag = state_etag(game.version, since) # The game may have moved on since the version check
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --- Streaming Round (Server-Sent Events) --- #
+
+def format_sse(event, data):
+    """Formats one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _run_streamed_round(game, player_statement, events, traced=False, lock=None):
+    """
+    Worker for /negotiation/stream: plays the round, feeds SSE events, then saves the game.
+    With traced=True the round gets its own trace, logged and sent in 'round_complete'.
+    lock, if given, is the game's lock, released once the round is saved.
+    """
+    if traced:
+        metrics.start_trace('round (stream)')
+    table = game.table
+    negotiation_state = game.negotiation_state
+    round_start = time.perf_counter()
+    first_reply_at = []
+
+    def on_ai_response(ai_id, data):
+        if not first_reply_at:
+            first_reply_at.append(time.perf_counter() - round_start)
+            print(f"--- Time to first NPC reply: {first_reply_at[0]:.2f}s ---")
+        events.put(('npc', {
+            'id': ai_id,
+            'name': table.get(ai_id).name,
+            'dialogue': data['response'],
+            'stance_score': data['new_score'],
+            'stance': get_stance_category(data['new_score'])
+        }))
+
+    def on_ai_delta(ai_id, text):
+        events.put(('npc_delta', {'id': ai_id, 'text': text}))
+
+    def on_event(event_text):
+        events.put(('event', {'text': event_text}))
+
+    try:
+        run_negotiation_round(table, negotiation_state, player_statement,
+                              on_event=on_event, on_ai_response=on_ai_response, on_ai_delta=on_ai_delta)
+        get_game_store().save_game(game)
+        summary = {
+            'round': negotiation_state['round'],
+            'climate': negotiation_state.get('negotiation_climate', 50),
+            'outcome': negotiation_state.get('outcome'),
+            'time_to_first_reply': round(first_reply_at[0], 3) if first_reply_at else None,
+            'round_time': round(time.perf_counter() - round_start, 3)
+        }
+        trace = metrics.finish_trace()
+        if trace is not None:
+            print(trace.format())
+            summary['trace'] = trace.to_list()
+        events.put(('round_complete', summary))
+    except StaleGameError:
+        events.put(('error', {'message': 'The game was changed elsewhere while this round was played; the round was discarded.'}))
+    except Exception as e:
+        print(f"ERROR in streamed round: {e}")
+        events.put(('error', {'message': 'An error occurred while processing the round.'}))
+    finally:
+        if lock is not None:
+            lock.release()
+    events.put(None) # Always release the stream
+
+@app.route('/negotiation/stream', methods=['POST'])
+def negotiation_stream():
+    """
+    Plays a round like POST /negotiation but streams each NPC reply as a
+    Server-Sent Event as soon as it is parsed. Events: 'event' (micro-event text),
+    'npc_delta' (partial dialogue), 'npc' (id, dialogue, stance_score, stance),
+    'round_complete' (with the round's spans under 'trace' if the request was traced)
+    and 'error'.
+    """
+    game_id = session.get('game_id')
+    if not game_id:
+        return jsonify({'success': False, 'message': 'Game session not found or incomplete. Please start a new game.'}), 400
+    store = get_game_store()
+    lock = store.lock(game_id)
+    lock.acquire() # Held until the round is saved: released by the round's worker thread, or below
+    try:
+        game = load_current_game()
+        if not game:
+            lock.release()
+            return jsonify({'success': False, 'message': 'Game session not found or incomplete. Please start a new game.'}), 400
+        player = game.table.player
+        player_statement = request.form.get('player_statement', '').strip()
+        error = round_submission_error(game, player_statement, request.form.get('round', type=int))
+        if error:
+            lock.release()
+            return jsonify({'success': False, 'message': error[0]}), error[2]
+        # Saved with the round result in one compare-and-set: a discarded round costs nothing
+        charge_statement_token(player, game.negotiation_state, player_statement)
+
+        # The round runs in a worker thread that saves the game when it finishes, so a
+        # client disconnect doesn't abandon the round half-way.
+        events = queue.Queue()
+        traced = metrics.current_trace() is not None
+        threading.Thread(target=_run_streamed_round, args=(game, player_statement, events, traced, lock), daemon=True).start()
+    except Exception:
+        lock.release()
+        raise
+
+    def generate():
+        yield format_sse('statement', {'id': player.id, 'name': player.name, 'dialogue': player_statement})
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            yield format_sse(*item)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- Multiplayer Rooms --- #
+# A room (rooms.py) is a stored game with several human seats. The session maps
+# each room id to the seat this browser holds; every participant's page follows
+# the shared state over GET /rooms/<id>/events. Rounds are played by the round
+# queue: each round's job is held until the round deadline and expedited once
+# every human has submitted.
+ROOM_POLL_SECONDS = 1 # Longest an event stream waits before re-checking the stored version
+ROOM_KEEPALIVE_SECONDS = 15 # Idle time before an event stream sends a comment line
+ROOM_UPDATES = rooms.RoomUpdates()
+
+def room_seat(room_id):
+    """The char id this browser holds in the room, or None."""
+    return session.get('rooms', {}).get(room_id)
+
+def remember_room_seat(room_id, char_id):
+    session['rooms'] = {**session.get('rooms', {}), room_id: char_id}
+
+def load_room(room_id, with_history=False):
+    """The room's game, or None if there is no such room."""
+    game = get_game_store().load_game(room_id, with_history=with_history)
+    return game if game and rooms.is_room(game) else None
+
+def room_state(game, char_id):
+    """game_state plus the room view, with the tokens of the viewer's seat."""
+    state = game_state(game)
+    state['player_tokens'] = game.table.get(char_id).influence_tokens
+    state['room'] = rooms.room_view(game, char_id)
+    return state
+
+def schedule_room_round(game):
+    """
+    Queues the room's current round, held until its deadline (idempotent), and
+    releases it at once if every human has already submitted.
+    """
+    negotiation_state = game.negotiation_state
+    room = negotiation_state['room']
+    if room['status'] != 'playing' or negotiation_state.get('outcome'):
+        return None
+    queue = get_round_queue()
+    job, _ = queue.submit(game.id, negotiation_state['round'], '', not_before=room['deadline'])
+    if rooms.all_submitted(game):
+        queue.expedite(job.id)
+    return job
+
+def _play_room_round(store, game):
+    """Round worker for a room: plays the submitted statements, then opens and schedules the next round."""
+    negotiation_state = game.negotiation_state
+    statements = rooms.round_statements(game)
+    event_text = None
+    if not statements:
+        # Nobody spoke before the deadline: close the room rather than keep the NPCs talking to empty seats
+        negotiation_state['outcome'] = 'Room Abandoned'
+        negotiation_state['final_round'] = negotiation_state['round']
+        record(negotiation_state, 'outcome', outcome=negotiation_state['outcome'])
+    else:
+        event_text = run_negotiation_round(game.table, negotiation_state, statements)
+        rooms.open_round(game)
+    store.save_game(game)
+    schedule_room_round(game)
+    ROOM_UPDATES.notify()
+    return {'round': negotiation_state['round'], 'outcome': negotiation_state.get('outcome'), 'event': event_text}
+
+def join_room_seat(room_id, role_id, profile):
+    """Customization POST of a joining player: takes the AI seat and redirects to the room."""
+    store = get_game_store()
+    with store.lock(room_id):
+        game, result = store.update_game(room_id, lambda game: rooms.join_room(game, role_id, profile)
+                                         if rooms.is_room(game) else (None, ('Room not found.', 404)))
+    session.pop('joining_room', None)
+    if game is None:
+        flash('Room not found.', 'error')
+        return redirect(url_for('role_selection'))
+    human, error = result
+    if error:
+        flash(error[0], 'error')
+        return redirect(url_for('join_room', room_id=room_id))
+    remember_room_seat(room_id, human.id)
+    ROOM_UPDATES.notify()
+    return redirect(url_for('room', room_id=room_id))
+
+@app.route('/rooms/<string:room_id>/join', methods=['GET', 'POST'])
+def join_room(room_id):
+    """Role choice for someone joining a room from its invite link (an AI seat of that role becomes theirs)."""
+    game = load_room(room_id)
+    if game is None:
+        flash('Room not found.', 'error')
+        return redirect(url_for('role_selection'))
+    if room_seat(room_id):
+        return redirect(url_for('room', room_id=room_id))
+    open_roles = rooms.open_roles(game)
+    if request.method == 'POST':
+        player_role_id = request.form.get('role')
+        if player_role_id not in open_roles:
+            flash('That seat is no longer available.', 'error')
+            return redirect(url_for('join_room', room_id=room_id))
+        session['player_role_id'] = player_role_id
+        session['joining_room'] = room_id
+        return redirect(url_for('character_customization'))
+    if not open_roles:
+        flash('This room is full or has already started.', 'error')
+    return render_template('role_selection.html', roles={role_id: ROLES[role_id] for role_id in open_roles},
+                           hosting=False)
+
+@app.route('/rooms/<string:room_id>')
+def room(room_id):
+    game = load_room(room_id, with_history=True)
+    if game is None:
+        flash('Room not found.', 'error')
+        return redirect(url_for('role_selection'))
+    char_id = room_seat(room_id)
+    if not char_id:
+        return redirect(url_for('join_room', room_id=room_id))
+    schedule_room_round(game) # Re-queues the round if its job failed
+    return render_template('room.html', room_id=room_id, initial_state=room_state(game, char_id),
+                           join_url=url_for('join_room', room_id=room_id, _external=True))
+
+@app.route('/rooms/<string:room_id>/state')
+def room_state_api(room_id):
+    char_id = room_seat(room_id)
+    game = load_room(room_id, with_history=True) if char_id else None
+    if game is None:
+        return jsonify({'success': False, 'message': 'Room not found.'}), 404
+    return jsonify(room_state(game, char_id))
+
+@app.route('/rooms/<string:room_id>/start', methods=['POST'])
+def start_room(room_id):
+    """The host starts the first round."""
+    char_id = room_seat(room_id)
+    if not char_id or load_room(room_id) is None:
+        return jsonify({'success': False, 'message': 'Room not found.'}), 404
+    store = get_game_store()
+    with store.lock(room_id):
+        game, error = store.update_game(room_id, lambda game: rooms.start_room(game, char_id))
+    if error:
+        return jsonify({'success': False, 'message': error[0]}), error[1]
+    schedule_room_round(game)
+    ROOM_UPDATES.notify()
+    return jsonify({'success': True})
+
+@app.route('/rooms/<string:room_id>/statement', methods=['POST'])
+def room_statement(room_id):
+    """A human's statement for the current round (JSON or form: player_statement, round)."""
+    char_id = room_seat(room_id)
+    if not char_id or load_room(room_id) is None:
+        return jsonify({'success': False, 'message': 'Room not found.'}), 404
+    data = json_or_form()
+    player_statement = (data.get('player_statement') or '').strip()
+    submitted_round = data.get('round')
+    submitted_round = int(submitted_round) if str(submitted_round or '').isdigit() else None
+    store = get_game_store()
+    with store.lock(room_id):
+        game, error = store.update_game(
+            room_id, lambda game: rooms.submit_statement(game, char_id, player_statement, submitted_round))
+    if error:
+        return jsonify({'success': False, 'message': error[0]}), error[1]
+    schedule_room_round(game) # Expedites the round once everyone has spoken
+    ROOM_UPDATES.notify()
+    return jsonify({'success': True, 'player_tokens': game.table.get(char_id).influence_tokens})
+
+@app.route('/rooms/<string:room_id>/events')
+def room_events(room_id):
+    """
+    Server-Sent Events for one participant: a 'state' event (room_state) on
+    connect and after every change to the room, until the negotiation ends.
+    The stream holds a worker thread while the page is open (see README).
+    """
+    char_id = room_seat(room_id)
+    if not char_id or load_room(room_id) is None:
+        return jsonify({'success': False, 'message': 'Room not found.'}), 404
+    store = get_game_store()
+
+    def generate():
+        version = None
+        seen = ROOM_UPDATES.wait(None, 0)
+        last_sent = time.monotonic()
+        while True:
+            current = store.game_version(room_id)
+            if current != version:
+                game = store.load_game(room_id)
+                if game is None:
+                    yield format_sse('error', {'message': 'Room not found.'})
+                    return
+                version = game.version
+                yield format_sse('state', room_state(game, char_id))
+                last_sent = time.monotonic()
+                if game.negotiation_state.get('outcome'):
+                    return
+            elif time.monotonic() - last_sent >= ROOM_KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+            seen = ROOM_UPDATES.wait(seen, ROOM_POLL_SECONDS)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # --- New Route for Viewing Profiles --- #
 
 @app.route('/profile/<string:char_id>')
 def view_profile(char_id):
     """Displays the profile details for a specific character."""
-    if 'characters' not in session:
+    game = load_current_game(with_history=False)
+    if not game:
         # Or perhaps return a simple error page
         return "Character data not found in session. Please start a new game.", 404
 
-    character_to_view = None
-    for char in session['characters']:
-        if char.get('id') == char_id:
-            character_to_view = char
-            break
-
+    character_to_view = game.table.get(char_id)
     if character_to_view:
         return render_template('profile.html', character=character_to_view)
     else:
@@ -566,271 +959,740 @@ def view_profile(char_id):
 
 # --- Core AI Logic --- #
 
+TRANSCRIPT_HEADER = "\nDialogue History:\n"
+
+def speaker_name(characters_lookup, char_id):
+    """Name of the character who made a statement ('Unknown' if the seat is no longer at the table)."""
+    speaker = characters_lookup.get(char_id)
+    return speaker.name if speaker else 'Unknown'
+
+def render_history_round(round_number, round_statements, characters_lookup):
+    """Renders one round of dialogue history as prompt text."""
+    lines = [f"--- Round {round_number} ---\n"]
+    for char_id, statement in round_statements.items():
+        lines.append(f"{speaker_name(characters_lookup, char_id)}: {statement}\n")
+    lines.append("---\n")
+    return ''.join(lines)
+
 def format_history_for_prompt(history, characters_lookup):
     """Formats the dialogue history into a readable string for the LLM prompt."""
-    prompt_history = "\nDialogue History:\n"
     if not history:
-        return prompt_history + "No discussion yet.\n"
+        return TRANSCRIPT_HEADER + "No discussion yet.\n"
+    return TRANSCRIPT_HEADER + ''.join(
+        render_history_round(i + 1, round_statements, characters_lookup)
+        for i, round_statements in enumerate(history)
+    )
 
-    for i, round_statements in enumerate(history):
-        prompt_history += f"--- Round {i+1} ---\n"
-        for char_id, statement in round_statements.items():
-            speaker = characters_lookup.get(char_id)
-            speaker_name = speaker.get('name', 'Unknown') if speaker else 'Unknown'
-            prompt_history += f"{speaker_name}: {statement}\n"
-        prompt_history += "---\n"
-    return prompt_history
+def get_transcript(negotiation_state, characters_lookup):
+    """
+    Returns the dialogue history prompt text, rendering only rounds that are not
+    yet in the cached transcript. negotiation_state['transcript'] holds the
+    rendered text of the first 'rounds' rounds; past rounds never change, so the
+    cached text is a stable prompt prefix shared by every NPC in a round.
+    """
+    history = negotiation_state['history']
+    transcript = negotiation_state.setdefault('transcript', {'rounds': 0, 'text': ''})
+    if transcript['rounds'] > len(history): # History was replaced; start over
+        transcript['rounds'], transcript['text'] = 0, ''
+    if transcript['rounds'] < len(history):
+        transcript['text'] += ''.join(
+            render_history_round(i + 1, history[i], characters_lookup)
+            for i in range(transcript['rounds'], len(history))
+        )
+        transcript['rounds'] = len(history)
 
-# Function for AI Response Generation (Replaces Placeholder)
-def get_ai_responses(characters, history, player_statement, climate_score):
-    """Generates responses for all AI characters and calculates potential stance score changes based on AI suggestion."""
-    print("\n--- Generating AI Responses --- ")
-    # Filter out player AND characters skipping the round due to an event
-    active_ai_characters = []
-    for c in characters:
-        if not c.get('is_player'):
-            if c.get('skipped_round'):
-                print(f"    Skipping AI response generation for {c['name']} ({c['role_id']}) due to event.")
-            else:
-                active_ai_characters.append(c)
+    if not transcript['rounds']:
+        return TRANSCRIPT_HEADER + "No discussion yet.\n"
+    return TRANSCRIPT_HEADER + transcript['text']
 
-    responses_data = {}
-    cumulative_climate_change = 0
-
-    for ai in active_ai_characters: # Iterate through AI characters who are participating this round
-        print(f"  Generating response for: {ai['name']} ({ai['role_name']}, Stance: {ai['stance']}/{ai['stance_score']}, Inf: {ai['influence']})")
-
-        # Prepare specific history and prompt for this AI
-        ai_current_stance_category = get_stance_category(ai.get('stance_score', NEUTRAL_SCORE))
-        system_prompt = (
-            f"You are participating in a town hall negotiation about a new development project. "
-            f"You are {ai['name']}, a {ai['role_name']}. "
-            f"Your specific objective is: {ai.get('backstory', 'Objective not specified.')}. "
-            f"Your current stance score towards the main proposal is: {ai.get('stance_score', NEUTRAL_SCORE)}/100 ({get_stance_category(ai.get('stance_score', NEUTRAL_SCORE))}). Higher means more supportive. "
-            f"Consider your role, objectives, and the dialogue history. "
-            f"Respond naturally to the latest statement(s) in the conversation. Keep your response concise (1-3 sentences). "
-            f"IMPORTANT: After your dialogue, on a NEW LINE, add a score adjustment based on how the latest statement(s) affected your stance. Format EXACTLY as 'SCORE_CHANGE: +/-value' (e.g., SCORE_CHANGE: +5, SCORE_CHANGE: -3, SCORE_CHANGE: 0). The value should be between -10 and +10."
-            f"The negotiation history so far is:\n{format_history_for_prompt(history, {c['id']: c for c in characters})}"
-            f"The player has just said: '{player_statement}'. "
+def _error_response(ai):
+    """Fallback entry used when an AI character's LLM call fails or times out."""
+    return {
+        'response': f"(Error generating response for {ai.name})",
+        'new_score': ai.stance_score
+    }
+
+def _stream_completion_text(ai, on_delta, **llm_kwargs):
+    """Streams the LLM reply, forwarding dialogue text to on_delta as it arrives.
+
+    Text is forwarded only up to the first newline, so the trailing SCORE_CHANGE
+    line never reaches the client; the full text is returned for normal parsing.
+    """
+    chunks = []
+    sent = 0
+    for piece in llm.stream(**llm_kwargs):
+        chunks.append(piece)
+        text = ''.join(chunks)
+        dialogue_part = text.split('\n', 1)[0]
+        if len(dialogue_part) > sent:
+            on_delta(ai.id, dialogue_part[sent:])
+            sent = len(dialogue_part)
+    return ''.join(chunks)
+
+# --- History Compaction --- #
+
+def estimate_tokens(text):
+    """Rough token count for prompt budgeting (~4 characters per token for English)."""
+    return len(text) // 4 + 1
+
+def _extractive_summary(rounds_text, max_tokens):
+    """Fallback summary when the LLM is unavailable: the first sentence of each statement, truncated."""
+    lines = []
+    for line in rounds_text.splitlines():
+        if not line or line.startswith('---'):
+            continue
+        speaker, _, statement = line.partition(': ')
+        first_sentence = statement.split('. ')[0][:80]
+        lines.append(f"{speaker}: {first_sentence}")
+    return ' | '.join(lines)[:max_tokens * 4]
+
+def update_history_summary(negotiation_state, upto_round, characters_lookup):
+    """
+    Folds history rounds [summary rounds, upto_round) into the game's rolling
+    summary, stored in negotiation_state['history_summary']. Each round is
+    summarized exactly once, when it leaves the verbatim window.
+    """
+    history = negotiation_state['history']
+    summary = negotiation_state.setdefault('history_summary', {'rounds': 0, 'text': ''})
+    if summary['rounds'] > len(history): # History was replaced; start over
+        summary['rounds'], summary['text'] = 0, ''
+    if summary['rounds'] >= upto_round:
+        return summary['text']
+
+    new_rounds_text = ''.join(
+        render_history_round(i + 1, history[i], characters_lookup)
+        for i in range(summary['rounds'], upto_round)
+    )
+    max_tokens = min(HISTORY_SUMMARY_MAX_TOKENS, HISTORY_TOKEN_BUDGET // 3)
+    print(f"--- Summarizing history rounds {summary['rounds'] + 1}-{upto_round} ---")
+    try:
+        with metrics.LLM_SUMMARY_SECONDS.time(), metrics.span('llm.summary'):
+            completion = llm.complete(
+            model=AI_MODEL,
+            messages=[
+                {"role": "system", "content": (
+                    "You maintain a running summary of a town hall negotiation about a new development project. "
+                    f"Update the summary with the new rounds. Keep it under {max_tokens * 3 // 4} words, "
+                    "name each participant's position and any shifts, and drop small talk.")},
+                {"role": "user", "content": f"Current summary: {summary['text'] or '(none)'}\nNew rounds:\n{new_rounds_text}"}
+            ],
+            max_tokens=max_tokens,
+            temperature=0.2,
+            timeout=AI_RESPONSE_TIMEOUT
         )
+        metrics.record_usage(completion, 'summary')
+        summary['text'] = completion.text
+    except Exception as e:
+        print(f"ERROR summarizing history, using extractive fallback: {e}")
+        metrics.LLM_ERRORS.labels('summary').inc()
+        combined = f"{summary['text']} | {_extractive_summary(new_rounds_text, max_tokens)}" if summary['text'] else _extractive_summary(new_rounds_text, max_tokens)
+        summary['text'] = combined[-max_tokens * 4:] # Keep the newest material if over budget
+    summary['rounds'] = upto_round
+    return summary['text']
+
+def verbatim_window(history, characters_lookup, first_verbatim, budget):
+    """
+    Renders the rounds from first_verbatim on, dropping the oldest while they
+    exceed budget tokens (the last round is always kept). Returns
+    (first_verbatim, rendered rounds).
+    """
+    recent = [render_history_round(i + 1, history[i], characters_lookup) for i in range(first_verbatim, len(history))]
+    while len(recent) > 1 and estimate_tokens(''.join(recent)) > budget:
+        recent.pop(0)
+        first_verbatim += 1
+    return first_verbatim, recent
+
+def compact_history(negotiation_state, characters_lookup):
+    """
+    Builds a bounded-size history section: a rolling summary of older rounds plus
+    the last HISTORY_VERBATIM_ROUNDS rounds word-for-word. If the verbatim rounds
+    alone exceed HISTORY_TOKEN_BUDGET the window shrinks, so prompt size stays
+    flat however many rounds are played. Returns (history_text, first verbatim round index).
+    """
+    history = negotiation_state['history']
+    if not history:
+        return TRANSCRIPT_HEADER + "No discussion yet.\n", 0
+
+    summarized_rounds = negotiation_state.get('history_summary', {}).get('rounds', 0)
+    first_verbatim = min(len(history), max(summarized_rounds, len(history) - HISTORY_VERBATIM_ROUNDS))
+    verbatim_budget = HISTORY_TOKEN_BUDGET - min(HISTORY_SUMMARY_MAX_TOKENS, HISTORY_TOKEN_BUDGET // 3)
+    first_verbatim, recent = verbatim_window(history, characters_lookup, first_verbatim, verbatim_budget)
+
+    summary_text = update_history_summary(negotiation_state, first_verbatim, characters_lookup)
+    parts = [TRANSCRIPT_HEADER]
+    if summary_text:
+        parts.append(f"Summary of rounds 1-{first_verbatim}: {summary_text}\n")
+    parts.extend(recent)
+    return ''.join(parts), first_verbatim
+
+def history_index(negotiation_state):
+    """The game's BM25 index of past statements, brought up to date with its history (see history_index.py)."""
+    index = negotiation_state.get('history_index')
+    if index is None:
+        index = negotiation_state['history_index'] = HistoryIndex()
+    return index.sync(negotiation_state['history'])
+
+def format_recalled(statements, characters_lookup):
+    """Renders retrieved (score, round, char_id, statement) hits, oldest first, for a prompt ('' if none)."""
+    if not statements:
+        return ''
+    entries = '; '.join(f"Round {round_number}, {speaker_name(characters_lookup, char_id)}: \"{statement}\""
+                        for _, round_number, char_id, statement in sorted(statements, key=lambda hit: hit[1]))
+    return f"Earlier statements relevant to this: {entries}. "
+
+def history_recall(negotiation_state, characters_lookup, player_statement, first_verbatim):
+    """
+    recall(ai) for rounds before first_verbatim (the ones not quoted word for
+    word): the HISTORY_RETRIEVED_STATEMENTS older statements most relevant to
+    the player's statement and ai's role, ranked with BM25 (no LLM call).
+    recall(None) queries for the whole table.
+    """
+    index = history_index(negotiation_state)
+    def recall(ai):
+        query = player_statement
+        exclude_ids = ()
+        if ai is not None:
+            query += ' ' + ' '.join(sorted(ROLE_KEYWORDS.get(ai.role_id, ())))
+            exclude_ids = (ai.id,) # Its own positions are in its position memory
+        with metrics.span('history.retrieve'):
+            hits = index.search(query, HISTORY_RETRIEVED_STATEMENTS, before_round=first_verbatim + 1, exclude_ids=exclude_ids)
+        return format_recalled(hits, characters_lookup)
+    return recall
+
+def history_section(negotiation_state, characters_lookup, player_statement):
+    """
+    The round's history for the NPC prompts: (history_text, recall), recall
+    being None or history_recall's per-NPC recall(ai). The two options compose:
+
+        neither             the full transcript (cached prefix)
+        HISTORY_COMPACTION  a rolling summary of the older rounds + the recent ones (compact_history)
+        HISTORY_RETRIEVAL   the recent rounds only (HISTORY_TOKEN_BUDGET) + each NPC's recalled
+                            older statements: no summary call
+        both                the summary + recent rounds, and the recalled statements
+    """
+    history = negotiation_state['history']
+    if HISTORY_COMPACTION:
+        history_text, first_verbatim = compact_history(negotiation_state, characters_lookup)
+    elif HISTORY_RETRIEVAL and history:
+        first_verbatim, recent = verbatim_window(history, characters_lookup,
+                                                 max(0, len(history) - HISTORY_VERBATIM_ROUNDS), HISTORY_TOKEN_BUDGET)
+        omitted = f"(Rounds 1-{first_verbatim} omitted.)\n" if first_verbatim else ''
+        history_text = TRANSCRIPT_HEADER + omitted + ''.join(recent)
+    else:
+        return get_transcript(negotiation_state, characters_lookup), None
+    if not (HISTORY_RETRIEVAL and first_verbatim):
+        return history_text, None
+    return history_text, history_recall(negotiation_state, characters_lookup, player_statement, first_verbatim)
+
+def remember_positions(table, ai_responses_data, round_number):
+    """Appends each responding AI's stance and opening line to its short position memory."""
+    for ai_id, data in ai_responses_data.items():
+        if data['response'] is None: # Listened this round
+            continue
+        memory = table.get(ai_id).position_memory
+        memory.append({
+            'round': round_number,
+            'score': data['new_score'],
+            'said': data['response'].split('. ')[0][:100]
+        })
+        del memory[:-NPC_MEMORY_ENTRIES]
+
+def format_position_memory(ai):
+    """Renders an AI character's remembered earlier positions for its prompt ('' if none or the full transcript is sent)."""
+    memory = ai.position_memory
+    if not (HISTORY_COMPACTION or HISTORY_RETRIEVAL) or not memory:
+        return ''
+    entries = '; '.join(f"Round {m['round']} (score {m['score']}): \"{m['said']}\"" for m in memory)
+    return f"Your own earlier positions: {entries}. "
+
+def build_table_prompt(history_text):
+    """System prompt shared by every NPC in a round (rules + transcript, no persona details)."""
+    return (
+        f"You are participating in a town hall negotiation about a new development project. "
+        f"Consider your role, objectives, and the dialogue history. "
+        f"Respond naturally to the latest statement(s) in the conversation. Keep your response concise (1-3 sentences). "
+        f"IMPORTANT: After your dialogue, on a NEW LINE, add a score adjustment based on how the latest statement(s) affected your stance. Format EXACTLY as 'SCORE_CHANGE: +/-value' (e.g., SCORE_CHANGE: +5, SCORE_CHANGE: -3, SCORE_CHANGE: 0). The value should be between -10 and +10."
+        f"The negotiation history so far is:\n{history_text}"
+    )
+
+def _npc_request(ai, history_text, player_statement, recalled=''):
+    """The LLM call arguments for one AI character's reply (recalled: its retrieved earlier statements, if any)."""
+    print(f"  Generating response for: {ai.name} ({ai.role_name}, Stance: {ai.stance}/{ai.stance_score}, Inf: {ai.influence})")
+
+    # The system prompt is identical for every AI this round; only the user message is per-character
+    system_prompt = build_table_prompt(history_text)
+    full_prompt = (
+        f"You are {ai.name}, a {ai.role_name}. "
+        f"Your specific objective is: {ai.backstory or 'Objective not specified.'}. "
+        f"Your current stance score towards the main proposal is: {ai.stance_score}/100 ({ai.stance}). Higher means more supportive. "
+        f"{format_position_memory(ai)}"
+        f"{recalled}"
+        f"The player has just said: '{player_statement}'. "
+    )
+    return dict(
+        model=AI_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": full_prompt}
+        ],
+        max_tokens=80, # Keep responses concise
+        temperature=0.7, # Allow some creativity
+        timeout=AI_RESPONSE_TIMEOUT # Per-call timeout so one slow NPC can't stall the round
+    )
+
+def _parse_npc_reply(ai, ai_response_full):
+    """Splits an NPC reply into dialogue and SCORE_CHANGE; returns {'response', 'new_score'}."""
+    print(f"  -> Raw response received for {ai.name}: {ai_response_full[:80]}...")
+
+    # --- Parse AI Response for Dialogue and Score Change --- #
+    ai_dialogue = ai_response_full
+    score_change = 0 # Default to 0 change
+    change_str = None
+    try:
+        parts = ai_response_full.split('\nSCORE_CHANGE:')
+        if len(parts) == 2:
+            ai_dialogue = parts[0].strip()
+            change_str = parts[1].strip()
+            score_change = int(change_str)
+            print(f"    Parsed score change for {ai.name}: {score_change}")
+        else:
+            print(f"    WARNING: Could not parse SCORE_CHANGE for {ai.name}. Format might be incorrect. Response: {ai_response_full[:50]}...")
+            metrics.SCORE_PARSE_FAILURES.labels('missing').inc()
+    except ValueError:
+        print(f"    WARNING: Invalid number format for SCORE_CHANGE for {ai.name}. Value: {change_str}")
+        metrics.SCORE_PARSE_FAILURES.labels('invalid').inc()
+        score_change = 0 # Reset to 0 if conversion fails
+    except Exception as parse_e:
+        print(f"    ERROR parsing response for {ai.name}: {parse_e}")
+        metrics.SCORE_PARSE_FAILURES.labels('error').inc()
+        score_change = 0
+
+    # --- Apply Suggested Stance Change --- #
+    new_score = max(0, min(100, ai.stance_score + score_change)) # Clamp score between 0 and 100
+
+    return {
+        'response': ai_dialogue, # Use the parsed dialogue
+        'new_score': new_score
+    }
 
-        full_prompt = system_prompt
+def generate_ai_response(ai, history_text, player_statement, on_delta=None, recalled=''):
+    """Generates a single AI character's dialogue and suggested new stance score.
 
+    If on_delta is given the completion is streamed and on_delta(ai_id, text) is
+    called with each new piece of dialogue.
+    """
+    llm_kwargs = _npc_request(ai, history_text, player_statement, recalled)
+    try:
+        with metrics.LLM_NPC_SECONDS.labels('per_npc').time(), metrics.span('llm.npc', npc=ai.id):
+            if on_delta:
+                ai_response_full = _stream_completion_text(ai, on_delta, **llm_kwargs).strip() # Streams report no usage
+            else:
+                completion = llm.complete(**llm_kwargs)
+                metrics.record_usage(completion, 'npc')
+                ai_response_full = completion.text
+        return _parse_npc_reply(ai, ai_response_full)
+    except Exception as e:
+        print(f"ERROR generating response for {ai.name}: {e}")
+        metrics.LLM_ERRORS.labels('npc').inc()
+        return _error_response(ai)
+
+def _fan_out_ai_responses(ai_characters, history_text, player_statement, on_response=None, on_delta=None, recall=None):
+    """Runs generate_ai_response for each given AI character, concurrently if enabled.
+
+    Returns a dict keyed by character id; characters whose call failed or did not
+    finish before the round deadline are simply absent. on_response(ai_id, data)
+    is called as soon as each character's reply has been parsed.
+    """
+    results = {}
+
+    if AI_RESPONSE_MODE == 'concurrent' and len(ai_characters) > 1:
+        max_workers = max(1, min(AI_RESPONSE_CONCURRENCY, len(ai_characters)))
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='npc')
         try:
-            # Make the API call
-            completion = client.chat.completions.create(
-                model="gpt-4.1-nano", # Use a cost-effective model suitable for simulation
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": full_prompt}
-                ],
-                max_tokens=80, # Keep responses concise
-                temperature=0.7 # Allow some creativity
-            )
-            ai_response_full = completion.choices[0].message.content.strip()
-            print(f"  -> Raw response received for {ai['name']}: {ai_response_full[:80]}...")
-
-            # --- Parse AI Response for Dialogue and Score Change --- #
-            ai_dialogue = ai_response_full
-            score_change = 0 # Default to 0 change
-            try:
-                parts = ai_response_full.split('\nSCORE_CHANGE:')
-                if len(parts) == 2:
-                    ai_dialogue = parts[0].strip()
-                    change_str = parts[1].strip()
-                    score_change = int(change_str)
-                    print(f"    Parsed score change for {ai['name']}: {score_change}")
-                else:
-                    print(f"    WARNING: Could not parse SCORE_CHANGE for {ai['name']}. Format might be incorrect. Response: {ai_response_full[:50]}...")
-            except ValueError:
-                print(f"    WARNING: Invalid number format for SCORE_CHANGE for {ai['name']}. Value: {change_str}")
-                score_change = 0 # Reset to 0 if conversion fails
-            except Exception as parse_e:
-                print(f"    ERROR parsing response for {ai['name']}: {parse_e}")
-                score_change = 0
-
-            # --- Apply Suggested Stance Change --- #
-            current_score = ai.get('stance_score', NEUTRAL_SCORE)
-            new_score = current_score + score_change
-            new_score = max(0, min(100, new_score)) # Clamp score between 0 and 100
-
-            responses_data[ai['id']] = {
-                'response': ai_dialogue, # Use the parsed dialogue
-                'new_score': new_score
-            }
-            # --- End Stance Change Logic ---
-        except Exception as e:
-            print(f"ERROR generating response for {ai['name']}: {e}")
-            responses_data[ai['id']] = {
-                'response': f"(Error generating response for {ai['name']})",
-                'new_score': ai.get('stance_score', NEUTRAL_SCORE)
+            # Each call runs in a copy of this context, so its spans join the round's trace
+            futures = {
+                executor.submit(contextvars.copy_context().run, generate_ai_response, ai, history_text, player_statement, on_delta,
+                                recall(ai) if recall else ''): ai
+                for ai in ai_characters
             }
+            # Overall deadline for the round: every call gets AI_RESPONSE_TIMEOUT, and
+            # calls queued behind the concurrency cap get additional waves of it.
+            waves = -(-len(ai_characters) // max_workers) # Ceiling division
+            try:
+                for future in as_completed(futures, timeout=AI_RESPONSE_TIMEOUT * waves + 1):
+                    ai = futures[future]
+                    try:
+                        results[ai.id] = future.result()
+                        if on_response:
+                            on_response(ai.id, results[ai.id])
+                    except Exception as e:
+                        print(f"ERROR generating response for {ai.name}: {e}")
+                        metrics.LLM_ERRORS.labels('npc').inc()
+            except FuturesTimeoutError:
+                print(f"    WARNING: Round deadline exceeded; {len(futures) - len(results)} AI response(s) timed out.")
+                metrics.LLM_ERRORS.labels('timeout').inc(len(futures) - len(results))
+        finally:
+            # Don't block the request on stragglers; they fall back to the error entry
+            executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        for ai in ai_characters: # Iterate through AI characters who are participating this round
+            results[ai.id] = generate_ai_response(ai, history_text, player_statement, on_delta, recall(ai) if recall else '')
+            if on_response:
+                on_response(ai.id, results[ai.id])
+
+    return results
+
+# --- Batched "Whole Table" Round Engine --- #
+
+def _extract_json_array(text):
+    """Pulls the first JSON array out of an LLM reply (tolerates ```json fences and chatter)."""
+    start = text.find('[')
+    end = text.rfind(']')
+    if start == -1 or end <= start:
+        raise ValueError("No JSON array found in response.")
+    return json.loads(text[start:end + 1])
+
+def get_ai_responses_batched(ai_characters, history_text, player_statement, recalled=''):
+    """Generates dialogue for every given AI character with a single LLM call.
+
+    The shared transcript and player statement are sent once, followed by one line
+    per NPC (id, persona, stance). The model must reply with a JSON array of
+    {"id", "dialogue", "score_change"} objects. Each entry is validated against the
+    requested characters; anything missing or malformed is left out of the result
+    so the caller can fall back to the per-NPC path for those characters.
+    """
+    if not ai_characters:
+        return {}
+
+    print(f"  Generating batched table response for {len(ai_characters)} AI characters")
+    try:
+        with metrics.LLM_NPC_SECONDS.labels('batched').time(), metrics.span('llm.batched', npcs=len(ai_characters)):
+            completion = llm.complete(**_batched_request(ai_characters, history_text, player_statement, recalled))
+        metrics.record_usage(completion, 'batched')
+        entries = _extract_json_array(completion.text)
+    except Exception as e:
+        print(f"ERROR generating batched table response: {e}")
+        metrics.LLM_ERRORS.labels('batched').inc()
+        return {}
+    return _parse_batched_entries(ai_characters, entries)
+
+def _batched_request(ai_characters, history_text, player_statement, recalled=''):
+    """The LLM call arguments for a whole-table batched reply (recalled: retrieved earlier statements, if any)."""
+    persona_lines = "\n".join(
+        f"- id: {ai.id} | {ai.name}, a {ai.role_name} | "
+        f"{ai.backstory or 'Objective not specified.'} | "
+        f"Stance score: {ai.stance_score}/100 ({ai.stance})"
+        for ai in ai_characters
+    )
+    system_prompt = (
+        f"You are voicing several participants in a town hall negotiation about a new development project. "
+        f"Each participant has a role, an objective and a stance score towards the main proposal (0-100, higher means more supportive). "
+        f"For EVERY participant listed below, write a natural, concise response (1-3 sentences) to the latest statement(s), "
+        f"in character, and a score adjustment between -10 and +10 reflecting how the statement affected their stance. "
+        f"Reply ONLY with a JSON array, one object per participant, formatted EXACTLY as "
+        f'[{{"id": "<participant id>", "dialogue": "<what they say>", "score_change": <integer>}}, ...]. '
+        f"The negotiation history so far is:\n{history_text}"
+    )
+    user_prompt = (
+        f"{recalled}"
+        f"The player has just said: '{player_statement}'.\n"
+        f"Participants:\n{persona_lines}"
+    )
+    return dict(
+        model=AI_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=AI_BATCH_TOKENS_PER_NPC * len(ai_characters),
+        temperature=0.7,
+        timeout=AI_RESPONSE_TIMEOUT
+    )
+
+def _parse_batched_entries(ai_characters, entries):
+    """Validates the JSON entries of a batched reply; returns {ai_id: {'response', 'new_score'}} for the good ones."""
+    if not isinstance(entries, list):
+        print("    WARNING: Batched response was not a JSON array.")
+        return {}
+
+    ai_by_id = {ai.id: ai for ai in ai_characters}
+    results = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        ai = ai_by_id.get(entry.get('id'))
+        dialogue = entry.get('dialogue')
+        score_change = entry.get('score_change', 0)
+        if ai is None or ai.id in results:
+            continue # Unknown, inactive or duplicate id
+        if not isinstance(dialogue, str) or not dialogue.strip():
+            print(f"    WARNING: Missing dialogue for {ai.name} in batched response.")
+            continue
+        if isinstance(score_change, bool) or not isinstance(score_change, (int, float, str)):
+            print(f"    WARNING: Invalid score_change for {ai.name} in batched response: {score_change!r}")
+            continue
+        try:
+            score_change = int(score_change)
+        except (ValueError, OverflowError): # Not a number, NaN, or a JSON 1e999 / Infinity
+            print(f"    WARNING: Invalid score_change for {ai.name} in batched response: {score_change!r}")
+            continue
+        score_change = max(-10, min(10, score_change))
+        results[ai.id] = {
+            'response': dialogue.strip(),
+            'new_score': max(0, min(100, ai.stance_score + score_change))
+        }
 
-    print(f"--- AI Responses & Stance Updates Calculated ({len(responses_data)}/{len(active_ai_characters)}) ---")
-    return responses_data
+    print(f"    Batched response covered {len(results)}/{len(ai_characters)} AI characters")
+    return results
 
-# --- Victory Check Logic --- #
-def check_victory(characters, climate_score):
-    """Determines the outcome of the negotiation based on final stances and potentially climate."""
-    # Use derived stance category for final check
-    supporters = []
-    opposers = []
-    total_influence = 0
-    supporter_influence = 0
-    total_participants = len(characters)
-
-    for char in characters:
-        stance = get_stance_category(char.get('stance_score', NEUTRAL_SCORE))
-        influence = char.get('influence', 1) # Default influence to 1 if not found
-        total_influence += influence
-        if stance == STANCES['support']:
-            supporters.append(char)
-            supporter_influence += influence
-        elif stance == STANCES['oppose']:
-            opposers.append(char)
-
-    # --- Implement New Victory/Failure Conditions --- #
-    # 1. Consensus Victory
-    if total_participants > 0 and (len(supporters) / total_participants) >= CONSENSUS_THRESHOLD_PERCENT:
-        return f"Consensus Victory: Project approved with broad agreement ({len(supporters)}/{total_participants} supporters)!"
-
-    # 2. Influence Victory
-    if total_influence > 0 and (supporter_influence / total_influence) >= INFLUENCE_THRESHOLD_PERCENT:
-        return f"Influence Victory: Key figures secured project approval (Supporting Influence: {supporter_influence}/{total_influence})!"
-
-    # 3. Compromise Victory (Placeholder - requires tracking specific proposals)
-    # if conditions_for_compromise_met(characters, history):
-    #    return "Compromise Victory: A middle ground was found!"
-
-    # 4. Total Failure (Critically Low Support OR Bad Climate)
-    support_ratio = (len(supporters) / total_participants) if total_participants > 0 else 0
-    if support_ratio <= FAILURE_SUPPORT_THRESHOLD_PERCENT:
-        return f"Total Failure: Project rejected due to overwhelming opposition or apathy (Support: {len(supporters)}/{total_participants})."
-    if climate_score <= CRITICAL_CLIMATE_THRESHOLD:
-        return f"Total Failure: Negotiations collapsed due to a toxic climate (Climate Score: {climate_score})."
-
-    # 5. Partial Failure (Stalemate - Default if no other condition met)
-    return f"Partial Failure: Negotiation ended in stalemate. Insufficient consensus or influence reached (Support: {len(supporters)}/{total_participants}, Influence: {supporter_influence}/{total_influence}, Climate: {climate_score})."
-
-    # 6. Public Backlash (Placeholder - requires separate mechanic)
-    # if public_opinion_low:
-    #    return "Failure: Public backlash halted the project."
-
-def generate_ai_opponents(player_role_id):
-    """Generates the 9 AI opponents with profiles, including initial stance and influence."""
-    opponents = []
-    used_names = set()
-    role_counts = {
-        "developer": 2,
-        "local_resident": 3,
-        "student_representative": 2,
-        "council_member": 2
-    }
+# Function for AI Response Generation (Replaces Placeholder)
+def get_ai_responses(table, history, player_statement, climate_score, on_response=None, on_delta=None, history_text=None,
+                     recall=None):
+    """Generates responses for the AI characters and calculates potential stance score changes based on AI suggestion.
+
+    Only the AI_SPEAKERS_PER_ROUND characters the statement concerns most get an
+    LLM call (engine.schedule_speakers); the others listen, with response None
+    and a small stance drift with the climate.
+
+    With AI_ROUND_ENGINE = 'batched' the whole table is asked for in one LLM call
+    first, and only characters missing from that reply go through the per-NPC path.
+    In 'concurrent' mode the per-character LLM calls are fanned out over a bounded
+    thread pool (AI_RESPONSE_CONCURRENCY workers), so a round takes roughly as long
+    as its slowest call. Results are always keyed by character id and returned in
+    table order, regardless of which call finishes first.
+
+    on_response(ai_id, data) fires as each character's reply is ready (including
+    error fallbacks); on_delta(ai_id, text) streams per-NPC dialogue text.
+    history_text is the pre-rendered transcript (see get_transcript); if omitted
+    it is rendered once here and shared by all characters. recall(ai), if given,
+    returns the earlier statements retrieved for that character's prompt
+    (recall(None): for the whole table, in a batched call).
+    """
+    active_ai_characters = _active_ai_characters(table)
+    speakers, listeners = schedule_speakers(active_ai_characters, player_statement, history, AI_SPEAKERS_PER_ROUND)
+    if history_text is None:
+        history_text = format_history_for_prompt(history, table)
+
+    results = {}
+    if AI_ROUND_ENGINE == 'batched':
+        results.update(get_ai_responses_batched(speakers, history_text, player_statement, recall(None) if recall else ''))
+        if on_response:
+            for ai_id, data in results.items():
+                on_response(ai_id, data)
+
+    remaining = [ai for ai in speakers if ai.id not in results]
+    if remaining:
+        results.update(_fan_out_ai_responses(remaining, history_text, player_statement, on_response, on_delta, recall))
+    return _add_listeners(active_ai_characters, _merge_in_table_order(speakers, results, on_response), listeners,
+                          climate_score)
+
+def _add_listeners(active_ai_characters, responses_data, listeners, climate_score):
+    """Adds the characters the turn scheduler left silent (response None, a small stance drift), in table order."""
+    metrics.NPC_CALLS_SAVED.observe(len(listeners))
+    if listeners:
+        print(f"    Turn scheduler: {len(responses_data)} speaking, {len(listeners)} listening"
+              f" ({', '.join(ai.name for ai in listeners)})")
+    drift = {ai.id: {'response': None, 'new_score': listener_drift(ai, climate_score)} for ai in listeners}
+    return {ai.id: responses_data.get(ai.id) or drift[ai.id] for ai in active_ai_characters}
+
+def _active_ai_characters(table):
+    """The AI characters taking part this round (not skipping due to an event)."""
+    print("\n--- Generating AI Responses --- ")
+    # Filter out player AND characters skipping the round due to an event
+    active_ai_characters = []
+    for c in table.ai_characters:
+        if c.skipped_round:
+            print(f"    Skipping AI response generation for {c.name} ({c.role_id}) due to event.")
+        else:
+            active_ai_characters.append(c)
+    return active_ai_characters
 
-    # Decrease count for player's role
-    if player_role_id in role_counts:
-        role_counts[player_role_id] -= 1 # Player takes one spot
-
-    opponent_id_counter = 1 # Start AI IDs from 1
-    for role_id, count in role_counts.items():
-        role_info = ROLES[role_id]
-        for _ in range(count):
-            # Ensure unique name
-            name = random.choice(SAMPLE_NAMES)
-            while name in used_names:
-                name = random.choice(SAMPLE_NAMES)
-            used_names.add(name)
-
-            # Determine initial stance randomly based on role distribution
-            stance_dist = role_info.get('stance_distribution', { STANCES["neutral"]: 1 }) # Default to neutral if undefined
-            possible_stances = list(stance_dist.keys())
-            weights = list(stance_dist.values())
-            chosen_initial_stance = random.choices(possible_stances, weights=weights, k=1)[0]
-
-            # Map chosen stance to initial score
-            initial_score_map = {
-                STANCES["support"]: INITIAL_SUPPORT_SCORE,
-                STANCES["neutral"]: INITIAL_NEUTRAL_SCORE,
-                STANCES["oppose"]: INITIAL_OPPOSE_SCORE
-            }
-            chosen_initial_score = initial_score_map.get(chosen_initial_stance, INITIAL_NEUTRAL_SCORE)
-
-            # Generate simple random profile for AI
-            ai_profile = {
-                'id': f'ai_{opponent_id_counter}', # Unique ID for AI
-                'role_id': role_id,
-                'role_name': role_info['name'],
-                'name': name,
-                'age': random.randint(20, 70),
-                'gender': random.choice(['Male', 'Female', 'Other']),
-                'local_born': random.choice(['Yes', 'No']),
-                'has_children': random.choice(['Yes', 'No']),
-                # Add simplified backstory/details based on role
-                'backstory': f"Objective: {role_info['objective']}", # Simplified backstory
-                'is_player': False, # Flag to differentiate AI from player
-                'influence': INFLUENCE_SCORES.get(role_id, 1), # Add influence score
-                'initial_stance': chosen_initial_stance, # Store the randomly chosen stance
-                'stance_score': chosen_initial_score, # Set score based on chosen stance
-                'stance': get_stance_category(chosen_initial_score), # Set initial stance category
-                'influence_tokens': ROLES[role_id]['initial_influence_tokens'],
-                'max_tokens': int(ROLES[role_id]['initial_influence_tokens'] * MAX_TOKENS_FACTOR),
-                'trust_value': INITIAL_TRUST,
-            }
-            # Add simple logic for num_children if needed, or omit for AI
-            if ai_profile['has_children'] == 'Yes':
-                ai_profile['num_children'] = random.randint(1, 4)
-            else:
-                ai_profile['num_children'] = 0
-            # Add marital status if needed
-            ai_profile['marital_status'] = random.choice(['Single', 'Married', 'Other'])
+def _merge_in_table_order(active_ai_characters, results, on_response=None):
+    """Fills in error fallbacks for missing characters and orders the results by seat."""
+    # Merge in character order so round_dialogue keeps the table's speaking order
+    responses_data = {}
+    for ai in active_ai_characters:
+        if ai.id not in results:
+            results[ai.id] = _error_response(ai)
+            if on_response:
+                on_response(ai.id, results[ai.id])
+        responses_data[ai.id] = results[ai.id]
 
-            opponents.append(ai_profile)
-            opponent_id_counter += 1
+    print(f"--- AI Responses & Stance Updates Calculated ({len(responses_data)}/{len(active_ai_characters)}) ---")
+    return responses_data
 
-    return opponents
+# --- Async Round Engine (used by async_app.py) --- #
+# The same prompts, parsing and fallbacks as above, but every LLM call is awaited
+# (llm.acomplete / llm.astream), so one event loop can keep the NPC calls of
+# hundreds of rounds in flight without a thread per call.
+
+async def _astream_completion_text(ai, on_delta, **llm_kwargs):
+    """Async _stream_completion_text."""
+    chunks = []
+    sent = 0
+    async for piece in llm.astream(**llm_kwargs):
+        chunks.append(piece)
+        dialogue_part = ''.join(chunks).split('\n', 1)[0]
+        if len(dialogue_part) > sent:
+            on_delta(ai.id, dialogue_part[sent:])
+            sent = len(dialogue_part)
+    return ''.join(chunks)
+
+async def agenerate_ai_response(ai, history_text, player_statement, on_delta=None, recalled=''):
+    """Async generate_ai_response."""
+    llm_kwargs = _npc_request(ai, history_text, player_statement, recalled)
+    try:
+        with metrics.LLM_NPC_SECONDS.labels('per_npc').time(), metrics.span('llm.npc', npc=ai.id):
+            if on_delta:
+                ai_response_full = (await _astream_completion_text(ai, on_delta, **llm_kwargs)).strip()
+            else:
+                completion = await llm.acomplete(**llm_kwargs)
+                metrics.record_usage(completion, 'npc')
+                ai_response_full = completion.text
+        return _parse_npc_reply(ai, ai_response_full)
+    except Exception as e:
+        print(f"ERROR generating response for {ai.name}: {e}")
+        metrics.LLM_ERRORS.labels('npc').inc()
+        return _error_response(ai)
+
+async def aget_ai_responses_batched(ai_characters, history_text, player_statement, recalled=''):
+    """Async get_ai_responses_batched."""
+    if not ai_characters:
+        return {}
+    print(f"  Generating batched table response for {len(ai_characters)} AI characters")
+    try:
+        with metrics.LLM_NPC_SECONDS.labels('batched').time(), metrics.span('llm.batched', npcs=len(ai_characters)):
+            completion = await llm.acomplete(**_batched_request(ai_characters, history_text, player_statement, recalled))
+        metrics.record_usage(completion, 'batched')
+        entries = _extract_json_array(completion.text)
+    except Exception as e:
+        print(f"ERROR generating batched table response: {e}")
+        metrics.LLM_ERRORS.labels('batched').inc()
+        return {}
+    return _parse_batched_entries(ai_characters, entries)
+
+async def _afan_out_ai_responses(ai_characters, history_text, player_statement, on_response=None, on_delta=None, recall=None):
+    """Async _fan_out_ai_responses: at most AI_RESPONSE_CONCURRENCY calls per round, same round deadline."""
+    results = {}
+    if AI_RESPONSE_MODE != 'concurrent':
+        for ai in ai_characters:
+            results[ai.id] = await agenerate_ai_response(ai, history_text, player_statement, on_delta,
+                                                         recall(ai) if recall else '')
+            if on_response:
+                on_response(ai.id, results[ai.id])
+        return results
+
+    max_workers = max(1, min(AI_RESPONSE_CONCURRENCY, len(ai_characters)))
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def respond(ai):
+        async with semaphore:
+            results[ai.id] = await agenerate_ai_response(ai, history_text, player_statement, on_delta,
+                                                         recall(ai) if recall else '')
+        if on_response:
+            on_response(ai.id, results[ai.id])
+
+    tasks = [asyncio.create_task(respond(ai)) for ai in ai_characters]
+    waves = -(-len(ai_characters) // max_workers) # Ceiling division
+    _, pending = await asyncio.wait(tasks, timeout=AI_RESPONSE_TIMEOUT * waves + 1)
+    if pending:
+        print(f"    WARNING: Round deadline exceeded; {len(pending)} AI response(s) timed out.")
+        metrics.LLM_ERRORS.labels('timeout').inc(len(pending))
+        for task in pending:
+            task.cancel() # They fall back to the error entry
+    return results
+
+async def aget_ai_responses(table, history, player_statement, climate_score, on_response=None, on_delta=None, history_text=None,
+                           recall=None):
+    """Async get_ai_responses."""
+    active_ai_characters = _active_ai_characters(table)
+    speakers, listeners = schedule_speakers(active_ai_characters, player_statement, history, AI_SPEAKERS_PER_ROUND)
+    if history_text is None:
+        history_text = format_history_for_prompt(history, table)
+
+    results = {}
+    if AI_ROUND_ENGINE == 'batched':
+        results.update(await aget_ai_responses_batched(speakers, history_text, player_statement, recall(None) if recall else ''))
+        if on_response:
+            for ai_id, data in results.items():
+                on_response(ai_id, data)
+
+    remaining = [ai for ai in speakers if ai.id not in results]
+    if remaining:
+        results.update(await _afan_out_ai_responses(remaining, history_text, player_statement, on_response, on_delta, recall))
+    return _add_listeners(active_ai_characters, _merge_in_table_order(speakers, results, on_response), listeners,
+                          climate_score)
+
+async def allm_npc_policy(table, negotiation_state, player_statement, rng=None, on_response=None, on_delta=None):
+    """Async llm_npc_policy (for engine.play_round_async)."""
+    with metrics.span('history'):
+        if HISTORY_COMPACTION:
+            # Summarizing uses the blocking client, at most once per round: keep it off the event loop
+            history_text, recall = await asyncio.to_thread(history_section, negotiation_state, table, player_statement)
+        else:
+            history_text, recall = history_section(negotiation_state, table, player_statement)
+    ai_responses_data = await aget_ai_responses(table, negotiation_state['history'], player_statement,
+                                                negotiation_state.get('negotiation_climate', 50),
+                                                on_response=on_response, on_delta=on_delta, history_text=history_text,
+                                                recall=recall)
+    remember_positions(table, ai_responses_data, negotiation_state['round'])
+    return ai_responses_data
+
+async def arun_negotiation_round(table, negotiation_state, player_statement, on_event=None, on_ai_response=None, on_ai_delta=None):
+    """Async run_negotiation_round (see engine.play_round_async)."""
+    async def npc_policy(table, negotiation_state, player_statement, rng):
+        return await allm_npc_policy(table, negotiation_state, player_statement, rng, on_ai_response, on_ai_delta)
+    with metrics.ROUND_SECONDS.labels(AI_ROUND_ENGINE).time(), metrics.span('round', round=negotiation_state['round']):
+        event_text = await play_round_async(table, negotiation_state, player_statement, npc_policy, on_event=on_event,
+                                            rng=round_rng(negotiation_state))
+    regenerate_tokens_once(table, negotiation_state)
+    return event_text
 
 @app.route('/influence', methods=['POST'])
 def influence():
-    action = request.form.get('action')
-    target_id = request.form.get('target_id')
-    cost = INFLUENCE_ACTION_COSTS.get(action, 0)
-    action_effect = INFLUENCE_ACTION_EFFECTS.get(action, {})
-
-    # Find the target NPC in the session's character list
-    characters = session.get('characters', [])
-    target_npc = next((char for char in characters if char['id'] == target_id), None)
-
-    if not target_npc:
-        return jsonify({'success': False, 'message': 'Target NPC not found.'}), 404
-
-    old_stance_score = target_npc.get('stance_score', INITIAL_NEUTRAL_SCORE)
-    old_stance = get_stance_category(old_stance_score)
-    old_trust = target_npc.get('trust_value', INITIAL_TRUST)
-
-    # Apply effects (modify stance and trust)
-    stance_change = action_effect.get('stance_change', 0)
-    trust_change = action_effect.get('trust_change', 0)
-
-    target_npc['stance_score'] = max(0, min(100, target_npc.get('stance_score', INITIAL_NEUTRAL_SCORE) + stance_change))
-    target_npc['trust_value'] = max(0, min(100, target_npc.get('trust_value', INITIAL_TRUST) + trust_change))
-    new_stance = get_stance_category(target_npc['stance_score']) # Get new stance AFTER change
-    target_npc['stance'] = new_stance # Update stance category string
-
-    print(f"Applied influence '{action}' to {target_npc['name']}. Stance: {old_stance_score} -> {target_npc['stance_score']} ({new_stance}), Trust: {old_trust} -> {target_npc['trust_value']}")
-
-    # --- Check for Neutral -> Support Conversion --- #
-    if old_stance == STANCES['neutral'] and new_stance == STANCES['support']:
-        session['conversion_bonus_pending'] = True
-        print(f"!!! Conversion bonus triggered for turning {target_npc['name']} supportive! Pending for next round.")
-    # --- End Conversion Check --- #
-
-    # Update player tokens
-    player_profile = session.get('player_profile', None)
-    if player_profile:
-        player_profile['influence_tokens'] -= cost
-        session['player_profile'] = player_profile
-
-    return jsonify({'success': True, 'message': f'Influence action {action} applied to {target_npc["name"]}.'})
+    data = json_or_form() # The page posts JSON; form posts still work
+    action = data.get('action')
+    target_id = data.get('target_id')
+
+    # Find the target NPC in the game's table and apply the action (under the game's lock, retried on a conflict)
+    game, result = update_current_game(lambda game: apply_influence(game.table, game.negotiation_state, action, target_id))
+    if not game:
+        return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 400
+    target_npc, error = result
+    if error:
+        return jsonify({'success': False, 'message': error[0]}), error[1]
+
+    return jsonify({'success': True, 'message': f'Influence action {action} applied to {target_npc.name}.',
+                    'player_tokens': game.table.player.influence_tokens, 'target_id': target_npc.id,
+                    'new_stance_score': target_npc.stance_score, 'new_trust_value': target_npc.trust_value})
+
+def influence_batch_message(count, delta):
+    """The player-facing summary of an applied influence batch."""
+    message = f"{count} influence action{'s' if count != 1 else ''} applied for {delta['spent']} token{'s' if delta['spent'] != 1 else ''}."
+    if delta['conversions']:
+        message += f" {len(delta['conversions'])} won over to Support: bonus token next round!"
+    return message
+
+@app.route('/influence/batch', methods=['POST'])
+def influence_batch():
+    """
+    Applies several influence actions in one request and one save:
+    {"actions": [{"action": ..., "target_id": ...}, ...]}. Nothing is applied
+    unless every action is valid and the player can pay for all of them.
+    Responds with the new token count and each target's stance and trust.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict): # Not JSON, or a JSON list or scalar
+        return jsonify({'success': False, 'message': 'No influence actions given.'}), 400
+    operations = payload.get('actions')
+    game, result = update_current_game(
+        lambda game: apply_influence_batch(game.table, game.negotiation_state, operations))
+    if not game:
+        return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 400
+    delta, error = result
+    if error:
+        return jsonify({'success': False, 'message': error[0]}), error[1]
+    return jsonify({'success': True, 'message': influence_batch_message(len(operations), delta), **delta})
 
 if __name__ == '__main__':
     # Use 0.0.0.0 to make it accessible on the network if needed, otherwise 127.0.0.1
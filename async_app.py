@@ -0,0 +1,348 @@
+"""
+Async serving mode: the game's routes on an ASGI server.
+
+The sync Flask app (app.py) holds a worker thread for every round in flight,
+so concurrent players are capped by the worker count. Here the same routes
+run as coroutines on Quart (Flask's async twin, so the templates and url_for
+names are shared): NPC LLM calls are awaited through llm.acomplete/astream
+(see the async round engine in app.py), and game-state reads and writes go
+through AsyncGameStore, which keeps SQLite off the event loop. One process
+can hold hundreds of rounds in flight.
+
+    hypercorn async_app:app --bind 127.0.0.1:5000
+    uvicorn async_app:app --port 5000
+
+Sessions are Quart's signed cookies and only carry the game id, like the sync
+app's. Both apps can share one game store file, but not a browser session.
+"""
+import asyncio
+import os
+import time
+
+from quart import Quart, Response, flash, jsonify, redirect, render_template, request, session, url_for
+
+import app as sync_app
+import metrics
+from engine import (MAX_ROUNDS, ROLES, INFLUENCE_ACTION_COSTS, charge_statement_token, apply_influence, apply_influence_batch,
+                    create_player, new_game, new_seed)
+from game_store import AsyncGameStore, StaleGameError
+from models import STANCES, get_stance_category
+
+app = Quart(__name__)
+
+STORE_THREADS = 4 # Threads running SQLite calls for the event loop
+_store = None
+
+def get_store():
+    """The process-wide AsyncGameStore over the sync app's GameStore."""
+    global _store
+    if _store is None:
+        _store = AsyncGameStore(sync_app.get_game_store(), max_workers=STORE_THREADS)
+    return _store
+
+async def load_current_game(with_history=True):
+    return await get_store().load_game(session.get('game_id'), with_history=with_history)
+
+async def update_current_game(mutate, with_history=False):
+    """app.update_current_game on the event loop: under the game's asyncio lock."""
+    game_id = session.get('game_id')
+    if not game_id:
+        return None, None
+    async with get_store().lock(game_id):
+        return await get_store().update_game(game_id, mutate, with_history=with_history)
+
+# --- Metrics & Tracing --- #
+
+@app.before_request
+async def _start_request_trace():
+    if (sync_app.TRACE_REQUESTS or request.headers.get('X-Trace') == '1') and request.endpoint != 'metrics_endpoint':
+        metrics.start_trace(f"{request.method} {request.path}")
+
+@app.after_request
+async def _finish_request_trace(response):
+    trace = metrics.finish_trace()
+    if trace is not None:
+        print(trace.format())
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/metrics/storage')
+async def storage_stats():
+    get_store()
+    if sync_app._reaper is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **sync_app._reaper.stats()})
+
+# --- Game Setup --- #
+
+@app.route('/', methods=['GET', 'POST'])
+async def role_selection():
+    if request.method == 'POST':
+        player_role_id = (await request.form).get('role')
+        if player_role_id in ROLES:
+            session['player_role_id'] = player_role_id
+            return redirect(url_for('character_customization'))
+        return redirect(url_for('role_selection'))
+
+    session.pop('player_role_id', None)
+    session.pop('game_id', None)
+    return await render_template('role_selection.html', roles=ROLES)
+
+@app.route('/customize', methods=['GET', 'POST'])
+async def character_customization():
+    player_role_id = session.get('player_role_id')
+    if not player_role_id or player_role_id not in ROLES:
+        return redirect(url_for('role_selection'))
+    player_role_name = ROLES[player_role_id]['name']
+
+    if request.method == 'POST':
+        player_profile, error = sync_app.player_profile_from_form(await request.form)
+        if error:
+            return await render_template('customization.html', player_role_name=player_role_name, error=error)
+        table, negotiation_state = new_game(create_player(player_role_id, **player_profile), seed=new_seed())
+        game = await get_store().create_game(table, negotiation_state)
+        session['game_id'] = game.id
+        return redirect(url_for('negotiation'))
+
+    return await render_template('customization.html', player_role_name=player_role_name)
+
+@app.route('/negotiation_group')
+async def negotiation_group():
+    game = await load_current_game(with_history=False)
+    if not game or not len(game.table):
+        return redirect(url_for('role_selection'))
+    return await render_template('negotiation_group.html', characters=game.table)
+
+# --- Negotiation Stage --- #
+
+@app.route('/negotiation', methods=['GET', 'POST'])
+async def negotiation():
+    game = await load_current_game()
+    if not game:
+        await flash("Game session not found or incomplete. Please start a new game.", "error")
+        return redirect(url_for('role_selection'))
+
+    if request.method == 'POST':
+        form = await request.form
+        if form.get('action') == 'give_up':
+            await update_current_game(sync_app.give_up)
+            await flash('You have chosen to end the negotiation.', 'warning')
+            return redirect(url_for('negotiation'))
+
+        player_statement = form.get('player_statement', '').strip()
+        async with get_store().lock(game.id):
+            game = await load_current_game() # Reloaded under the lock (see app.negotiation)
+            if not game:
+                await flash("Game session not found or incomplete. Please start a new game.", "error")
+                return redirect(url_for('role_selection'))
+            error = sync_app.round_submission_error(game, player_statement, form.get('round', type=int))
+            if error:
+                await flash(error[0], error[1])
+                return redirect(url_for('negotiation'))
+            charge_statement_token(game.table.player, game.negotiation_state, player_statement)
+
+            event_text = await sync_app.arun_negotiation_round(game.table, game.negotiation_state, player_statement)
+            if event_text:
+                await flash(event_text, 'info')
+            try:
+                await get_store().save_game(game)
+            except StaleGameError:
+                await flash('The game was changed elsewhere while this round was played; the round was discarded.', 'error')
+        return redirect(url_for('negotiation'))
+
+    if sync_app.regeneration_due(game.negotiation_state) and not game.negotiation_state.get('outcome'):
+        game, _ = await update_current_game(lambda game: sync_app.regenerate_tokens_once(game.table, game.negotiation_state),
+                                            with_history=True)
+
+    negotiation_state = game.negotiation_state
+    return await render_template('negotiation.html',
+                                 state=negotiation_state,
+                                 characters=game.table,
+                                 player_profile=game.table.player,
+                                 INFLUENCE_ACTION_COSTS=INFLUENCE_ACTION_COSTS,
+                                 climate_score=negotiation_state.get('negotiation_climate', 50),
+                                 max_rounds=MAX_ROUNDS,
+                                 stances_map=STANCES)
+
+@app.route('/negotiation/state')
+async def negotiation_state_api():
+    """Async GET /negotiation/state (see app.negotiation_state_api)."""
+    try:
+        since = sync_app.state_since(request.args)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'since must be a round number (0 or more).'}), 400
+    game_id = session.get('game_id')
+    store = get_store()
+    version = await store.game_version(game_id) if game_id else None
+    if version is None:
+        return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 404
+    etag = sync_app.state_etag(version, since)
+    if request.if_none_match.contains_weak(etag):
+        response = Response('', status=304)
+    else:
+        game = await store.load_game(game_id)
+        if game is None:
+            return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 404
+        since_numbers = await store.round_numbers(game_id, since) if since else None
+        response = jsonify(sync_app.game_state(game, since, since_numbers))
+        etag = sync_app.state_etag(game.version, since)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+async def _run_streamed_round(game, player_statement, events, traced=False, lock=None):
+    """Background task for /negotiation/stream (see app._run_streamed_round)."""
+    if traced:
+        metrics.start_trace('round (stream)')
+    table = game.table
+    negotiation_state = game.negotiation_state
+    round_start = time.perf_counter()
+    first_reply_at = []
+
+    def on_ai_response(ai_id, data):
+        if not first_reply_at:
+            first_reply_at.append(time.perf_counter() - round_start)
+        events.put_nowait(('npc', {
+            'id': ai_id,
+            'name': table.get(ai_id).name,
+            'dialogue': data['response'],
+            'stance_score': data['new_score'],
+            'stance': get_stance_category(data['new_score'])
+        }))
+
+    try:
+        await sync_app.arun_negotiation_round(
+            table, negotiation_state, player_statement,
+            on_event=lambda event_text: events.put_nowait(('event', {'text': event_text})),
+            on_ai_response=on_ai_response,
+            on_ai_delta=lambda ai_id, text: events.put_nowait(('npc_delta', {'id': ai_id, 'text': text})))
+        await get_store().save_game(game)
+        summary = {
+            'round': negotiation_state['round'],
+            'climate': negotiation_state.get('negotiation_climate', 50),
+            'outcome': negotiation_state.get('outcome'),
+            'time_to_first_reply': round(first_reply_at[0], 3) if first_reply_at else None,
+            'round_time': round(time.perf_counter() - round_start, 3)
+        }
+        trace = metrics.finish_trace()
+        if trace is not None:
+            print(trace.format())
+            summary['trace'] = trace.to_list()
+        events.put_nowait(('round_complete', summary))
+    except StaleGameError:
+        events.put_nowait(('error', {'message': 'The game was changed elsewhere while this round was played; the round was discarded.'}))
+    except Exception as e:
+        print(f"ERROR in streamed round: {e}")
+        events.put_nowait(('error', {'message': 'An error occurred while processing the round.'}))
+    finally:
+        if lock is not None:
+            lock.release()
+    events.put_nowait(None) # Always release the stream
+
+@app.route('/negotiation/stream', methods=['POST'])
+async def negotiation_stream():
+    """Async POST /negotiation/stream; same events as the sync route."""
+    game_id = session.get('game_id')
+    if not game_id:
+        return jsonify({'success': False, 'message': 'Game session not found or incomplete. Please start a new game.'}), 400
+    form = await request.form
+    lock = get_store().lock(game_id)
+    await lock.acquire() # Held until the round is saved: released by the background task, or below
+    try:
+        game = await load_current_game()
+        if not game:
+            lock.release()
+            return jsonify({'success': False, 'message': 'Game session not found or incomplete. Please start a new game.'}), 400
+        player = game.table.player
+        player_statement = form.get('player_statement', '').strip()
+        error = sync_app.round_submission_error(game, player_statement, form.get('round', type=int))
+        if error:
+            lock.release()
+            return jsonify({'success': False, 'message': error[0]}), error[2]
+        # Saved with the round result in one compare-and-set: a discarded round costs nothing
+        charge_statement_token(player, game.negotiation_state, player_statement)
+
+        # A background task (not the response generator) plays and saves the round,
+        # so a client disconnect doesn't abandon it half-way
+        events = asyncio.Queue()
+        app.add_background_task(_run_streamed_round, game, player_statement, events,
+                                metrics.current_trace() is not None, lock)
+    except BaseException:
+        lock.release()
+        raise
+
+    async def generate():
+        yield sync_app.format_sse('statement', {'id': player.id, 'name': player.name, 'dialogue': player_statement})
+        while True:
+            item = await events.get()
+            if item is None:
+                break
+            yield sync_app.format_sse(*item)
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None # Rounds can outlast the default response timeout
+    return response
+
+@app.route('/profile/<string:char_id>')
+async def view_profile(char_id):
+    game = await load_current_game(with_history=False)
+    if not game:
+        return "Character data not found in session. Please start a new game.", 404
+    character_to_view = game.table.get(char_id)
+    if character_to_view:
+        return await render_template('profile.html', character=character_to_view)
+    return f"Character with ID '{char_id}' not found.", 404
+
+@app.route('/influence', methods=['POST'])
+async def influence():
+    data = await request.get_json(silent=True)
+    if not isinstance(data, dict): # Not JSON, or a JSON list or scalar
+        data = await request.form
+    action = data.get('action')
+    target_id = data.get('target_id')
+
+    game, result = await update_current_game(lambda game: apply_influence(game.table, game.negotiation_state, action, target_id))
+    if not game:
+        return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 400
+    target_npc, error = result
+    if error:
+        return jsonify({'success': False, 'message': error[0]}), error[1]
+    return jsonify({'success': True, 'message': f'Influence action {action} applied to {target_npc.name}.',
+                    'player_tokens': game.table.player.influence_tokens, 'target_id': target_npc.id,
+                    'new_stance_score': target_npc.stance_score, 'new_trust_value': target_npc.trust_value})
+
+@app.route('/influence/batch', methods=['POST'])
+async def influence_batch():
+    """Async POST /influence/batch (see app.influence_batch)."""
+    payload = await request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'success': False, 'message': 'No influence actions given.'}), 400
+    operations = payload.get('actions')
+    game, result = await update_current_game(
+        lambda game: apply_influence_batch(game.table, game.negotiation_state, operations))
+    if not game:
+        return jsonify({'success': False, 'message': 'Game session not found. Please start a new game.'}), 400
+    delta, error = result
+    if error:
+        return jsonify({'success': False, 'message': error[0]}), error[1]
+    return jsonify({'success': True, 'message': sync_app.influence_batch_message(len(operations), delta), **delta})
+
+@app.before_serving
+async def _load_secret_key():
+    # Resolved at startup, like app.create_app(), so importing this module writes no secret file
+    if not app.secret_key:
+        app.secret_key = os.environ.get('FLASK_SECRET_KEY') or sync_app.shared_secret_key() # Same secret in every worker
+
+@app.after_serving
+async def _close_store():
+    if _store is not None:
+        _store.close()
+
+
+if __name__ == '__main__':
+    app.run(host='127.0.0.1', port=5000)
@@ -0,0 +1,312 @@
+"""
+Vectorized batch engine for Monte Carlo balancing (needs NumPy).
+
+Holds G games x C seats as NumPy arrays (stance_score, influence, tokens,
+max_tokens, trust, role, player and skip masks, plus per-game climate and
+outcome) and plays the rules of engine.py on all games at once: micro-event
+effects, clamping, stance categorization, token regeneration, the random NPC
+policy and the consensus/influence/failure checks. The player follows the
+simulator's passive or greedy strategy (the latter vectorized too), and the
+rules come from a BalanceConfig.
+
+Random inputs for a round are drawn up front as arrays (RoundDraws). Feeding
+the same draws to the scalar engine through ReplayRandom reproduces the batch
+results exactly, which is how benchmarks/batch_engine.py checks parity.
+"""
+import random
+from collections import Counter, namedtuple
+
+import numpy as np
+
+import engine
+from models import SUPPORT_THRESHOLD_LOW, OPPOSE_THRESHOLD_HIGH
+
+ROLE_IDS = list(engine.ROLES)
+
+# Outcome codes, in check_victory order; 0 = still playing
+OUTCOME_CONSENSUS, OUTCOME_INFLUENCE, OUTCOME_FAIL_SUPPORT, OUTCOME_FAIL_CLIMATE, OUTCOME_PARTIAL = 1, 2, 3, 4, 5
+OUTCOME_NAMES = {
+    OUTCOME_CONSENSUS: 'Consensus Victory',
+    OUTCOME_INFLUENCE: 'Influence Victory',
+    OUTCOME_FAIL_SUPPORT: 'Total Failure',
+    OUTCOME_FAIL_CLIMATE: 'Total Failure',
+    OUTCOME_PARTIAL: 'Partial Failure',
+}
+
+# --- Micro-events as arrays --- #
+_TARGET_CODES = {'all': 0, 'role': 1, 'role_specific': 2}
+_EVENT_TARGET = np.array([_TARGET_CODES.get(e['effects'].get('target'), -1) for e in engine.MICRO_EVENTS])
+_EVENT_ROLE = np.array([ROLE_IDS.index(e['effects']['role_id']) if e['effects'].get('role_id') else -1
+                        for e in engine.MICRO_EVENTS])
+_EVENT_STANCE = np.array([e['effects'].get('stance_delta', 0) for e in engine.MICRO_EVENTS])
+_EVENT_CLIMATE = np.array([e['effects'].get('climate_delta', 0) for e in engine.MICRO_EVENTS])
+_EVENT_SKIP = np.array([bool(e['effects'].get('skip_round', False)) for e in engine.MICRO_EVENTS])
+
+STRATEGIES = ('passive', 'greedy') # Player strategies, as in simulator.py
+
+RoundDraws = namedtuple('RoundDraws', 'roll choice score')
+RoundDraws.__doc__ = """Random inputs for one round: roll (G,) event trigger, choice (G, 2) uniforms for
+the event pick and the role_specific target, score (G, C) NPC score changes (k-th active AI uses column k)."""
+
+def draw_round(np_rng, games, seats, score_range=(-5, 5)):
+    """Draws one round's random inputs for every game."""
+    return RoundDraws(
+        np_rng.random(games),
+        np_rng.random((games, 2)),
+        np_rng.integers(score_range[0], score_range[1] + 1, size=(games, seats))
+    )
+
+def stance_categories(scores):
+    """Vectorized get_stance_category: 0 = Oppose, 1 = Neutral, 2 = Support."""
+    return np.where(scores <= OPPOSE_THRESHOLD_HIGH, 0, np.where(scores >= SUPPORT_THRESHOLD_LOW, 2, 1))
+
+
+class BatchGames:
+    """G games with C seats each, advanced one round at a time in lockstep."""
+
+    def __init__(self, stance, influence, tokens, max_tokens, trust, is_player, role, climate,
+                 skipped=None, bonus_pending=None, round_number=1, config=engine.DEFAULT_CONFIG):
+        """Takes (G, C) seat arrays and (G,) climate; see from_tables() and setup() for the usual constructors."""
+        self.stance = np.asarray(stance, dtype=np.int16)
+        self.influence = np.asarray(influence, dtype=np.int16)
+        self.tokens = np.asarray(tokens, dtype=np.int16)
+        self.max_tokens = np.asarray(max_tokens, dtype=np.int16)
+        self.trust = np.asarray(trust, dtype=np.int16)
+        self.is_player = np.asarray(is_player, dtype=bool)
+        self.role = np.asarray(role, dtype=np.int8)
+        self.climate = np.asarray(climate, dtype=np.int16)
+        self.skipped = np.zeros(self.stance.shape, dtype=bool) if skipped is None else np.asarray(skipped, dtype=bool)
+        self.bonus_pending = np.zeros(len(self.climate), dtype=bool) if bonus_pending is None else np.asarray(bonus_pending, dtype=bool)
+        self.round = round_number
+        self.config = config
+        self.outcome = np.zeros(len(self.climate), dtype=np.int8)
+        self._rows = np.arange(len(self.climate))
+        self._player_seat = np.argmax(self.is_player, axis=1)
+
+    @classmethod
+    def from_tables(cls, tables, negotiation_states, config=engine.DEFAULT_CONFIG):
+        """Copies the state of scalar (Table, negotiation_state) pairs; all games must be on the same round."""
+        seats = len(tables[0])
+        round_number = negotiation_states[0]['round']
+        if any(len(t) != seats for t in tables) or any(s['round'] != round_number for s in negotiation_states):
+            raise ValueError("All games in a batch need the same seat count and round.")
+
+        def column(field):
+            return [[getattr(char, field) for char in table] for table in tables]
+        return cls(column('stance_score'), column('influence'), column('influence_tokens'), column('max_tokens'),
+                   column('trust_value'), column('is_player'),
+                   [[ROLE_IDS.index(char.role_id) for char in table] for table in tables],
+                   [s.get('negotiation_climate', 50) for s in negotiation_states],
+                   skipped=column('skipped_round'),
+                   bonus_pending=[bool(s.get('conversion_bonus_pending')) for s in negotiation_states],
+                   round_number=round_number, config=config)
+
+    @classmethod
+    def new(cls, roles, seed=0, first_index=0, config=engine.DEFAULT_CONFIG):
+        """One game per entry of roles (player role ids), set up by the scalar engine and seeded like simulator.py."""
+        setups = [engine.new_game(engine.create_player(role_id, config, name='Sim Player'),
+                                  random.Random(f"{seed}:{index}"), config)
+                  for index, role_id in enumerate(roles, start=first_index)]
+        return cls.from_tables([table for table, _ in setups], [state for _, state in setups], config)
+
+    @classmethod
+    def setup(cls, roles, np_rng, config=engine.DEFAULT_CONFIG):
+        """
+        One game per entry of roles, set up with array operations: the same
+        table composition, stance distributions and starting values as
+        engine.new_game, but drawn from np_rng (names and profiles are skipped).
+        """
+        games = len(roles)
+        # Seat template per player role: AI roles by TABLE_ROLE_COUNTS, player in the last column
+        templates = []
+        for player_role in ROLE_IDS:
+            counts = dict(engine.TABLE_ROLE_COUNTS)
+            counts[player_role] -= 1
+            templates.append([ROLE_IDS.index(r) for r, n in counts.items() for _ in range(n)] + [ROLE_IDS.index(player_role)])
+        player_roles = np.array([ROLE_IDS.index(r) for r in roles])
+        role = np.array(templates, dtype=np.int8)[player_roles]
+        seats = role.shape[1]
+        is_player = np.zeros((games, seats), dtype=bool)
+        is_player[:, -1] = True
+
+        # Initial AI stances from each role's weighted stance distribution (inverse CDF)
+        score_of = {engine.STANCES['support']: engine.INITIAL_SUPPORT_SCORE, engine.STANCES['neutral']: engine.INITIAL_NEUTRAL_SCORE,
+                    engine.STANCES['oppose']: engine.INITIAL_OPPOSE_SCORE}
+        stance = np.empty((games, seats), dtype=np.int16)
+        u = np.asarray(np_rng.random((games, seats)))
+        for index, role_id in enumerate(ROLE_IDS):
+            distribution = config.stance_distributions.get(role_id) or {engine.STANCES['neutral']: 1}
+            weights = np.array(list(distribution.values()), dtype=float)
+            scores = np.array([score_of.get(s, engine.INITIAL_NEUTRAL_SCORE) for s in distribution])
+            picks = np.minimum(np.searchsorted(np.cumsum(weights) / weights.sum(), u, side='right'), len(scores) - 1)
+            stance = np.where(role == index, scores[picks], stance)
+        stance[:, -1] = engine.INITIAL_SUPPORT_SCORE
+
+        role_tokens = np.array([engine.ROLES[r]['initial_influence_tokens'] for r in ROLE_IDS])
+        influence = np.array([engine.INFLUENCE_SCORES.get(r, 1) for r in ROLE_IDS])[role]
+        tokens = role_tokens[role]
+        max_tokens = np.where(is_player, config.max_player_tokens, (role_tokens * engine.MAX_TOKENS_FACTOR).astype(int)[role])
+
+        # Shuffle seat order per game
+        order = np.argsort(np_rng.random((games, seats)), axis=1)
+        def shuffled(a):
+            return np.take_along_axis(np.asarray(a), order, axis=1)
+        return cls(shuffled(stance), shuffled(influence), shuffled(tokens), shuffled(max_tokens),
+                   np.full((games, seats), engine.INITIAL_TRUST), shuffled(is_player), shuffled(role),
+                   np.full(games, 50), config=config)
+
+    @property
+    def shape(self):
+        return self.stance.shape
+
+    def regenerate_tokens(self):
+        """engine.regenerate_tokens for every game, including the pending conversion bonus."""
+        player_regen = 1 + self.bonus_pending[:, None]
+        self.tokens = np.where(self.is_player,
+                               np.minimum(self.tokens + player_regen, self.config.max_player_tokens),
+                               np.minimum(self.tokens + self.config.token_regen_rate, self.max_tokens)).astype(np.int16)
+        self.bonus_pending[:] = False
+
+    def spend_greedy(self):
+        """simulator.greedy_strategy for every game: spare tokens go on persuading the AI closest to Support."""
+        costs = self.config.influence_action_costs
+        effects = self.config.influence_action_effects
+        gentle, strong = costs['gentle_persuasion'], costs['strong_persuasion']
+        if gentle < 1:
+            raise ValueError("gentle_persuasion must cost at least 1 token.")
+        rows, player_seat = self._rows, self._player_seat
+        while True:
+            spare = self.tokens[rows, player_seat].astype(np.int64) - 1
+            candidates = ~self.is_player & (self.stance < SUPPORT_THRESHOLD_LOW)
+            acting = candidates.any(axis=1) & (spare >= gentle)
+            if not acting.any():
+                return
+            # First seat with the highest score among non-supporters, as max() picks it
+            target = np.argmax(np.where(candidates, self.stance, -1), axis=1)
+            use_strong = spare >= strong
+            stance_delta = np.where(use_strong, effects.get('strong_persuasion', {}).get('stance_delta', 0),
+                                    effects.get('gentle_persuasion', {}).get('stance_delta', 0))
+            trust_delta = np.where(use_strong, effects.get('strong_persuasion', {}).get('trust_delta', 0),
+                                   effects.get('gentle_persuasion', {}).get('trust_delta', 0))
+            r, t = rows[acting], target[acting]
+            old_stance = self.stance[r, t]
+            new_stance = np.clip(old_stance + stance_delta[acting], 0, 100)
+            self.stance[r, t] = new_stance
+            self.trust[r, t] = np.clip(self.trust[r, t] + trust_delta[acting], 0, 100)
+            self.bonus_pending[r] |= (stance_categories(old_stance) == 1) & (stance_categories(new_stance) == 2)
+            self.tokens[r, player_seat[acting]] -= np.where(use_strong, strong, gentle)[acting].astype(np.int16)
+
+    def charge_statement_token(self):
+        self.tokens = (self.tokens - self.is_player).astype(np.int16)
+
+    def play_round(self, draws):
+        """engine.play_round with the random NPC policy, for every game at once."""
+        self.skipped[:] = False # Skip flags only last one round
+
+        # --- Micro-event --- #
+        fired = draws.roll < self.config.event_probability
+        event = (draws.choice[:, 0] * len(engine.MICRO_EVENTS)).astype(np.intp)
+        self.climate = np.clip(self.climate + np.where(fired, _EVENT_CLIMATE[event], 0), 0, 100).astype(np.int16)
+
+        target = _EVENT_TARGET[event]
+        in_role = self.role == _EVENT_ROLE[event][:, None]
+        affected = fired[:, None] & ((target == 0)[:, None] | ((target == 1)[:, None] & in_role))
+        # role_specific: one eligible member of the role, chosen like rng.choice(eligible) in seat order
+        eligible = in_role & ~self.skipped
+        pick = (draws.choice[:, 1] * eligible.sum(axis=1)).astype(np.intp)
+        chosen = (fired & (target == 2))[:, None] & eligible & (np.cumsum(eligible, axis=1) - 1 == pick[:, None])
+        affected |= chosen
+        self.stance = np.where(affected, np.clip(self.stance + _EVENT_STANCE[event][:, None], 0, 100), self.stance).astype(np.int16)
+        self.skipped |= chosen & _EVENT_SKIP[event][:, None]
+
+        # --- NPC reactions: the k-th active AI in seat order takes score column k --- #
+        active = ~self.is_player & ~self.skipped
+        rank = np.maximum(np.cumsum(active, axis=1) - 1, 0)
+        change = np.take_along_axis(draws.score, rank, axis=1)
+        self.stance = np.where(active, np.clip(self.stance + change, 0, 100), self.stance).astype(np.int16)
+        # Responses carry no 'score_change', so (as in engine.play_round) they leave the climate alone
+
+        self.round += 1
+        if self.round > engine.MAX_ROUNDS:
+            self.outcome = self.check_victory()
+
+    def check_victory(self):
+        """Vectorized engine.check_victory; returns outcome codes."""
+        config = self.config
+        supporters = self.stance >= SUPPORT_THRESHOLD_LOW
+        participants = self.stance.shape[1]
+        support_count = supporters.sum(axis=1)
+        total_influence = self.influence.sum(axis=1, dtype=np.int64)
+        supporter_influence = (self.influence * supporters).sum(axis=1, dtype=np.int64)
+        support_ratio = support_count / participants
+        return np.select(
+            [support_ratio >= config.consensus_threshold_percent,
+             (total_influence > 0) & (supporter_influence / np.maximum(total_influence, 1) >= config.influence_threshold_percent),
+             support_ratio <= config.failure_support_threshold_percent,
+             self.climate <= config.critical_climate_threshold],
+            [OUTCOME_CONSENSUS, OUTCOME_INFLUENCE, OUTCOME_FAIL_SUPPORT, OUTCOME_FAIL_CLIMATE],
+            default=OUTCOME_PARTIAL
+        ).astype(np.int8)
+
+    def play(self, np_rng, score_range=(-5, 5), strategy='passive', on_draws=None):
+        """Plays every game to the end. on_draws(draws), if given, sees each round's draws first."""
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy '{strategy}'. Use one of: {', '.join(STRATEGIES)}.")
+        games, seats = self.shape
+        while self.round <= engine.MAX_ROUNDS:
+            if self.round > 1:
+                self.regenerate_tokens()
+            if strategy == 'greedy':
+                self.spend_greedy()
+            self.charge_statement_token()
+            draws = draw_round(np_rng, games, seats, score_range)
+            if on_draws:
+                on_draws(draws)
+            self.play_round(draws)
+        return self.outcome
+
+
+class ReplayRandom:
+    """
+    Stands in for the rng of the scalar engine and replays one game's slice of
+    a RoundDraws, so engine.play_round(..., rng=ReplayRandom) with the random
+    policy makes exactly the choices BatchGames.play_round makes.
+    """
+
+    def load(self, draws, game):
+        self._roll = float(draws.roll[game])
+        self._choices = draws.choice[game].tolist()
+        self._scores = draws.score[game].tolist()
+
+    def random(self):
+        return self._roll
+
+    def choice(self, seq):
+        return seq[int(self._choices.pop(0) * len(seq))]
+
+    def randint(self, a, b):
+        return self._scores.pop(0)
+
+
+def outcome_code(outcome):
+    """Maps an engine.check_victory outcome string to its batch outcome code."""
+    if outcome.startswith('Total Failure'):
+        return OUTCOME_FAIL_CLIMATE if 'climate' in outcome else OUTCOME_FAIL_SUPPORT
+    return {'Consensus Victory': OUTCOME_CONSENSUS, 'Influence Victory': OUTCOME_INFLUENCE,
+            'Partial Failure': OUTCOME_PARTIAL}[outcome.split(':', 1)[0]]
+
+def simulate_batch(games, roles=None, seed=0, batch_size=50_000, score_range=(-5, 5), strategy='passive',
+                   config=engine.DEFAULT_CONFIG):
+    """
+    Batch counterpart of simulator.simulate with the random policy. Games are
+    set up with BatchGames.setup. Returns a Counter of (role_id, outcome category) -> games.
+    """
+    roles = list(roles or engine.ROLES)
+    np_rng = np.random.default_rng(seed)
+    counts = Counter()
+    for start in range(0, games, batch_size):
+        batch_roles = [roles[index % len(roles)] for index in range(start, min(start + batch_size, games))]
+        batch = BatchGames.setup(batch_roles, np_rng, config)
+        outcomes = batch.play(np_rng, score_range, strategy)
+        counts.update(zip(batch_roles, (OUTCOME_NAMES[code] for code in outcomes.tolist())))
+    return counts
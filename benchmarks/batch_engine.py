@@ -0,0 +1,114 @@
+"""
+Batch engine benchmark and parity check.
+
+Plays the same seeded games (random NPC policy) twice: with the scalar engine
+functions one game at a time, and with the NumPy batch engine all at once,
+feeding both the same random draws. Checks that final stances, tokens, trust,
+climate and outcomes match exactly, for the passive player with the default
+rules and for the greedy player with modified rules, then reports
+game-rounds/second for each path and for a large batch-only run.
+
+    python -m benchmarks.batch_engine [games] [large_games]
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+
+import numpy as np
+
+import engine
+import simulator
+from batch_engine import BatchGames, ReplayRandom, draw_round, outcome_code
+
+
+# Rules for the greedy parity run: cheaper, stronger persuasion and a faster token economy
+GREEDY_CONFIG = engine.DEFAULT_CONFIG.replace(
+    token_regen_rate=2,
+    influence_action_costs={'gentle_persuasion': 1, 'strong_persuasion': 2},
+    influence_action_effects={'gentle_persuasion': {'stance_delta': 6, 'trust_delta': 1},
+                              'strong_persuasion': {'stance_delta': 12, 'trust_delta': -3}},
+)
+
+
+def _setup(games, seed, config=engine.DEFAULT_CONFIG):
+    roles = list(engine.ROLES)
+    return [engine.new_game(engine.create_player(roles[i % len(roles)], config, name='Sim Player'),
+                            random.Random(f"{seed}:{i}"), config) for i in range(games)]
+
+
+def run_parity(games, seed=3, strategy='passive', config=engine.DEFAULT_CONFIG):
+    """Returns (scalar rounds/s, batch rounds/s); raises AssertionError on any mismatch."""
+    scalar_games = _setup(games, seed, config)
+    tables, states = zip(*_setup(games, seed, config))
+    batch = BatchGames.from_tables(tables, states, config)
+    scalar_strategy = simulator.STRATEGIES[strategy]
+    seats = len(scalar_games[0][0])
+
+    np_rng = np.random.default_rng(seed)
+    rounds = [draw_round(np_rng, games, seats, simulator.RANDOM_SCORE_RANGE) for _ in range(engine.MAX_ROUNDS)]
+
+    replay = ReplayRandom()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # Silence the engine's debug prints
+        for draws in rounds:
+            for index, (table, state) in enumerate(scalar_games):
+                if state['round'] > 1:
+                    engine.regenerate_tokens(table, state, config)
+                scalar_strategy(table, state, replay, config)
+                engine.charge_statement_token(table.player)
+                replay.load(draws, index)
+                engine.play_round(table, state, simulator.SIM_STATEMENT, simulator.random_policy, rng=replay,
+                                  config=config)
+    scalar_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for draws in rounds:
+        if batch.round > 1:
+            batch.regenerate_tokens()
+        if strategy == 'greedy':
+            batch.spend_greedy()
+        batch.charge_statement_token()
+        batch.play_round(draws)
+    batch_time = time.perf_counter() - started
+
+    def scalar_column(field):
+        return np.array([[getattr(char, field) for char in table] for table, _ in scalar_games])
+    assert np.array_equal(scalar_column('stance_score'), batch.stance), "stance_score differs"
+    assert np.array_equal(scalar_column('influence_tokens'), batch.tokens), "influence_tokens differs"
+    assert np.array_equal(scalar_column('trust_value'), batch.trust), "trust_value differs"
+    assert np.array_equal(np.array([s['negotiation_climate'] for _, s in scalar_games]), batch.climate), "climate differs"
+    assert [outcome_code(s['outcome']) for _, s in scalar_games] == batch.outcome.tolist(), "outcome differs"
+
+    game_rounds = games * engine.MAX_ROUNDS
+    return game_rounds / scalar_time, game_rounds / batch_time
+
+
+def run_large(games, seed=4):
+    """Batch-only throughput (game-rounds/s) for the greedy player, including the vectorized setup."""
+    np_rng = np.random.default_rng(seed)
+    started = time.perf_counter()
+    batch = BatchGames.setup([list(engine.ROLES)[i % len(engine.ROLES)] for i in range(games)], np_rng)
+    batch.play(np_rng, simulator.RANDOM_SCORE_RANGE, strategy='greedy')
+    return games * engine.MAX_ROUNDS / (time.perf_counter() - started)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check scalar vs. batch engine parity and time both.")
+    parser.add_argument('games', type=int, nargs='?', default=2000, help="Games per parity run")
+    parser.add_argument('large_games', type=int, nargs='?', default=100_000, help="Games in the batch-only run")
+    args = parser.parse_args(argv)
+    games, large_games = args.games, args.large_games
+    scalar_rate, batch_rate = run_parity(games)
+    run_parity(games, seed=5, strategy='greedy', config=GREEDY_CONFIG)
+    print(f"Parity: {games} games x {engine.MAX_ROUNDS} rounds match exactly (stances, tokens, trust, climate, outcomes),"
+          " passive player / default rules and greedy player / modified rules")
+    print(f"{'path':<22} {'game-rounds/s':>14}")
+    print(f"{'scalar engine':<22} {scalar_rate:>14,.0f}")
+    print(f"{'batch engine':<22} {batch_rate:>14,.0f}   ({batch_rate / scalar_rate:.0f}x)")
+    print(f"{f'batch, {large_games:,} games':<22} {run_large(large_games):>14,.0f}")
+
+
+if __name__ == '__main__':
+    main()
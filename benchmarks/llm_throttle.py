@@ -0,0 +1,188 @@
+"""
+LLM throttling benchmark against a local fake provider.
+
+Starts an OpenAI-compatible fake server in this process. Its
+/v1/chat/completions endpoint has a per-second request quota, rejects calls
+over the quota with 429 and a Retry-After header, and turns a share of the
+others into random 429s. Replies are the stub backend's canned NPC lines.
+
+The benchmark sends a burst of NPC calls through the plain 'local' backend
+(client retries off) and then through the same backend wrapped in
+GuardedBackend (llm_guard.py). For each run it reports the calls that
+succeeded, errored or got a degraded reply, plus the retries and the wall time.
+A final run against a server that answers 503 to everything shows the circuit
+breaker switching to degraded stub replies.
+
+    python -m benchmarks.llm_throttle [calls] [concurrency]
+
+The fake server can also stand in for a provider while playing, e.g. with
+`LLM_BACKEND=local LLM_BASE_URL=http://127.0.0.1:8089/v1 flask run`:
+
+    python -m benchmarks.llm_throttle --serve [port]
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import llm_guard
+from llm_backends import LocalOpenAIBackend, StubBackend
+from llm_guard import GuardedBackend
+
+SERVER_RPS = 20 # Fake provider quota (requests per second)
+INJECTED_429_RATE = 0.1 # Share of in-quota requests rejected anyway
+SERVER_LATENCY = 0.05 # Seconds per reply
+NPC_MESSAGES = [
+    {'role': 'system', 'content': "You are Maria Garcia, a Local Resident. End with 'SCORE_CHANGE: +/-n'."},
+    {'role': 'user', 'content': "Your current stance: (Neutral). The developer proposes 200 new homes. Respond."},
+]
+
+
+class FakeProvider(ThreadingHTTPServer):
+    """OpenAI-compatible chat completions with a request quota, injected 429s and optional total outage."""
+    daemon_threads = True
+    request_queue_size = 128 # Accept backlog for bursts of concurrent calls
+
+    def __init__(self, port=0, rps=SERVER_RPS, inject_rate=INJECTED_429_RATE, latency=SERVER_LATENCY, outage=False):
+        super().__init__(('127.0.0.1', port), _FakeProviderHandler)
+        self.bucket = llm_guard.TokenBucket(rps, rps)
+        self.inject_rate = inject_rate
+        self.latency = latency
+        self.outage = outage
+        self.stub = StubBackend()
+        self.rng = random.Random(0)
+        self.counts = {'ok': 0, '429': 0, '503': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def admit(self):
+        """(status, retry_after) for the next request."""
+        with self._lock:
+            if self.outage:
+                status, wait = 503, None
+            else:
+                wait = self.bucket.reserve(1)
+                if wait > 0:
+                    self.bucket.reserve(-1) # Rejected requests don't use quota
+                    status = 429
+                elif self.rng.random() < self.inject_rate:
+                    status, wait = 429, 1
+                else:
+                    status = 200
+            self.counts[{200: 'ok', 429: '429', 503: '503'}[status]] += 1
+            return status, wait
+
+
+class _FakeProviderHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        status, wait = self.server.admit()
+        if status == 429:
+            self._json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                       [('Retry-After', f"{max(wait, 0.05):.2f}")])
+            return
+        if status == 503:
+            self._json(503, {'error': {'message': 'Service unavailable', 'type': 'server_error'}})
+            return
+        time.sleep(self.server.latency)
+        completion = self.server.stub.complete(request['messages'], request.get('model'), request.get('max_tokens'), 0)
+        if request.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            chunk = {'id': 'fake', 'object': 'chat.completion.chunk', 'created': 0, 'model': request.get('model'),
+                     'choices': [{'index': 0, 'delta': {'content': completion.text}, 'finish_reason': None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode('utf-8'))
+            return
+        self._json(200, {
+            'id': 'fake', 'object': 'chat.completion', 'created': 0, 'model': request.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': completion.text}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': completion.prompt_tokens, 'completion_tokens': completion.completion_tokens,
+                      'total_tokens': completion.prompt_tokens + completion.completion_tokens}
+        })
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _retries():
+    return sum(metrics.LLM_RETRIES.labels(reason).value for reason in ('rate_limit', 'server_error', 'connection'))
+
+def run_calls(backend, calls, concurrency, timeout=20):
+    """Sends calls NPC requests with concurrency threads. Returns (ok, errors, degraded, retries, seconds)."""
+    degraded_before, retries_before = metrics.LLM_DEGRADED.labels().value, _retries()
+
+    def call(_):
+        try:
+            backend.complete(NPC_MESSAGES, 'fake-model', 60, 0.7, timeout)
+            return True
+        except Exception:
+            return False
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(calls)))
+    elapsed = time.perf_counter() - started
+    degraded = metrics.LLM_DEGRADED.labels().value - degraded_before
+    return results.count(True) - degraded, results.count(False), degraded, _retries() - retries_before, elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Burst NPC calls at a fake provider that injects 429s, with and without llm_guard.")
+    parser.add_argument('calls', type=int, nargs='?', default=200)
+    parser.add_argument('concurrency', type=int, nargs='?', default=50)
+    parser.add_argument('--serve', type=int, nargs='?', const=8089, metavar='PORT',
+                        help="Only run the fake provider on PORT (default 8089) until Ctrl-C")
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        server = FakeProvider(port=args.serve)
+        print(f"Fake provider at {server.base_url} ({SERVER_RPS} req/s, {INJECTED_429_RATE:.0%} injected 429s). Ctrl-C to stop.")
+        with contextlib.suppress(KeyboardInterrupt):
+            server.serve_forever()
+        return
+
+    calls, concurrency = args.calls, args.concurrency
+    print(f"{calls} NPC calls, {concurrency} at a time; fake provider: {SERVER_RPS} req/s,"
+          f" {INJECTED_429_RATE:.0%} injected 429s, {SERVER_LATENCY * 1000:.0f} ms replies")
+    print(f"{'run':<28}{'ok':>6}{'errors':>8}{'degraded':>10}{'retries':>9}{'seconds':>9}  server 200/429/503")
+    rows = [
+        ('plain (no retries)', lambda url: LocalOpenAIBackend(base_url=url, max_retries=0), False),
+        ('guarded', lambda url: GuardedBackend(LocalOpenAIBackend(base_url=url, max_retries=0), rpm=SERVER_RPS * 60 * 0.9), False),
+        ('guarded, provider down', lambda url: GuardedBackend(LocalOpenAIBackend(base_url=url, max_retries=0),
+                                                              rpm=SERVER_RPS * 60 * 0.9), True),
+    ]
+    for label, make_backend, outage in rows:
+        server = serve(FakeProvider(outage=outage))
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok, errors, degraded, retries, elapsed = run_calls(make_backend(server.base_url), calls, concurrency)
+        server.shutdown()
+        counts = server.counts
+        print(f"{label:<28}{ok:>6}{errors:>8}{degraded:>10}{retries:>9}{elapsed:>9.1f}"
+              f"  {counts['ok']}/{counts['429']}/{counts['503']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Per-round prompt size benchmark.
+
+Plays one scripted game of MAX_ROUNDS rounds against the in-process stub LLM
+backend (no network) and reports the prompt tokens sent per round, with the
+full transcript, with history compaction, with BM25 history retrieval and
+with both.
+
+    python -m benchmarks.prompt_size
+"""
+import argparse
+import os
+import random
+
+os.environ.setdefault("LLM_BACKEND", "stub")
+
+import app
+import engine
+from llm_backends import StubBackend
+from models import Character, Table
+
+PLAYER_STATEMENTS = [
+    "I believe this project will bring many jobs and affordable homes to our community for years to come, and I want to hear your concerns.",
+    "We are prepared to fund a new park and widen the footpaths along the main road if the council supports the second phase of construction.",
+    "Students need housing they can afford, and this plan sets aside a fifth of the units at below market rent for the next fifteen years.",
+    "Traffic studies show the new junction will reduce congestion at peak hours, and we will pay for monitoring during the first two years.",
+]
+
+
+class _RecordingStub(StubBackend):
+    """Stub backend that records the prompt tokens of every call."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = []
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        completion = super().complete(messages, model, max_tokens, temperature, timeout)
+        self.calls.append(completion.prompt_tokens)
+        return completion
+
+
+def run_game(compaction, retrieval, seed=7):
+    """Plays one game and returns a list of (round, calls, prompt tokens) tuples."""
+    random.seed(seed)
+    backend = _RecordingStub(seed=seed)
+    app.llm = backend
+    app.HISTORY_COMPACTION = compaction
+    app.HISTORY_RETRIEVAL = retrieval
+    app.AI_RESPONSE_MODE = 'sequential' # Deterministic call order for the report
+
+    characters = engine.generate_ai_opponents('developer')
+    characters.append(Character(id='player_0', name='Pat Player', role_id='developer', role_name='Developer',
+                                is_player=True, stance_score=engine.INITIAL_SUPPORT_SCORE, influence=2, influence_tokens=10))
+    table = Table(characters)
+    state = {'round': 1, 'history': [], 'outcome': None, 'negotiation_climate': 50}
+
+    per_round = []
+    for round_number in range(1, engine.MAX_ROUNDS + 1):
+        before = len(backend.calls)
+        app.run_negotiation_round(table, state, PLAYER_STATEMENTS[round_number % len(PLAYER_STATEMENTS)])
+        round_calls = backend.calls[before:]
+        per_round.append((round_number, len(round_calls), sum(round_calls)))
+    return per_round
+
+
+MODES = [ # (column, HISTORY_COMPACTION, HISTORY_RETRIEVAL)
+    ('full', False, False),
+    ('compact', True, False),
+    ('retrieval', False, True),
+    ('both', True, True),
+]
+
+
+def main(argv=None):
+    argparse.ArgumentParser(description="Prompt tokens per round for each history mode, against the stub backend.").parse_args(argv)
+    import contextlib
+    import io
+
+    with contextlib.redirect_stdout(io.StringIO()): # Silence the game's debug prints
+        runs = [run_game(compaction, retrieval) for _, compaction, retrieval in MODES]
+
+    print(f"Prompt tokens per round (as reported by the stub backend), budget={app.HISTORY_TOKEN_BUDGET}, verbatim rounds={app.HISTORY_VERBATIM_ROUNDS}")
+    print(f"{'round':>5} | " + ' | '.join(f"{name + ' calls':>15} {name + ' tokens':>16}" for name, _, _ in MODES))
+    for rounds in zip(*runs):
+        print(f"{rounds[0][0]:>5} | " + ' | '.join(f"{calls:>15} {tokens:>16}" for _, calls, tokens in rounds))
+    print(f"{'total':>5} | " + ' | '.join(f"{sum(r[1] for r in run):>15} {sum(r[2] for r in run):>16}" for run in runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Cold-start benchmark.
+
+Starts fresh Python processes, each in its own empty working directory (no
+session files, secret or game store yet), and times the steps a new server
+worker goes through before it answers:
+
+    import      `import app` (routes, templates not compiled yet)
+    create_app  configuration, shared secret and sessions
+    first GET   the role selection page, the first request (opens the game store)
+    second GET  the same page again, warm
+
+No LLM backend is configured and OPENAI_API_KEY is unset: neither is needed
+until an NPC speaks, so they don't count towards start-up. Reports the median
+and worst time of each step, in milliseconds.
+
+    python -m benchmarks.startup [runs]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+WORKER = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+client = app.app.test_client()
+first = client.get('/')
+first_done = time.perf_counter()
+second = client.get('/')
+second_done = time.perf_counter()
+assert first.status_code == second.status_code == 200, (first.status_code, second.status_code)
+print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                  'first GET': first_done - created, 'second GET': second_done - first_done}))
+"""
+
+
+def run_worker():
+    """Times one cold start in a new process and empty directory. Returns {step: seconds}."""
+    env = {k: v for k, v in os.environ.items() if k not in ('OPENAI_API_KEY', 'LLM_BACKEND')}
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(REPO), env.get('PYTHONPATH')]))
+    env['REAPER'] = '0' # A sweep racing the first request would skew it
+    with tempfile.TemporaryDirectory() as workdir:
+        env['GAME_STORE_PATH'] = str(Path(workdir) / 'game_state.sqlite3')
+        output = subprocess.run([sys.executable, '-c', WORKER], cwd=workdir, env=env,
+                                capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time cold starts of the web app in fresh processes.")
+    parser.add_argument('runs', type=int, nargs='?', default=10, help="Fresh processes to start")
+    runs = parser.parse_args(argv).runs
+    results = [run_worker() for _ in range(runs)]
+    print(f"Cold start over {runs} fresh processes (ms)")
+    print(f"{'step':<12}{'median':>9}{'max':>9}")
+    for step in results[0]:
+        times = [result[step] * 1000 for result in results]
+        print(f"{step:<12}{statistics.median(times):>9.1f}{max(times):>9.1f}")
+    totals = [sum(result.values()) * 1000 for result in results]
+    print(f"{'total':<12}{statistics.median(totals):>9.1f}{max(totals):>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
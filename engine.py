@@ -0,0 +1,773 @@
+"""
+Headless negotiation engine: the game rules with no Flask or LLM dependency.
+
+Holds the balance constants, roles and micro-events, and the round logic the
+web app and the simulator share: event triggering, stance and climate
+updates, token regeneration, influence actions and the victory check. How the
+AI characters react to a statement is left to an NPC policy,
+
+    npc_policy(table, negotiation_state, player_statement, rng) -> {ai_id: {'response': str, 'new_score': int}}
+
+(response None: the character stayed silent this round, see schedule_speakers)
+
+which the web app implements with LLM calls (app.py) and the simulator with
+cheaper stand-ins (simulator.py). play_round_async awaits a coroutine policy
+instead, for the async server (async_app.py); both share start_round and
+finish_round. Functions that roll dice take an rng
+(a random.Random, default the module-level random) so games can be seeded.
+
+A game created with a seed (new_game(..., seed=new_seed())) is reproducible:
+the seed generates its table, and round_rng() derives each round's dice from
+the seed and the round number. Such a game also keeps a round log,
+negotiation_state['log'], to which the rules append what they apply, in order
+(see record()):
+
+    snapshot   the table's numbers and the climate (at creation and when seats change)
+    statement  a human's statement, and its token charge
+    event      the micro-event a round rolled (event_id None if none fired)
+    npc        one AI character's reaction: response, new_score, score_change
+    influence  an influence action and its target
+    regen      start-of-round token regeneration
+    outcome    the game ending (victory check, giving up, an abandoned room)
+
+The store persists it append-only (game_store.py) and replay.py rebuilds a
+game from its last snapshot and the entries after it.
+
+The tunable balance constants are gathered in a BalanceConfig; functions that
+use them take a config (default DEFAULT_CONFIG, built from the module
+constants below) so simulations and parameter sweeps can vary them.
+"""
+import base64
+import hashlib
+import json
+import random
+import re
+from dataclasses import asdict, dataclass, field, replace
+
+import metrics
+from models import STANCES, Character, Table
+
+# --- Game Constants --- #
+MAX_ROUNDS = 8
+MIN_STATEMENT_WORDS = 15 # New constant
+EVENT_PROBABILITY = 0.25 # 25% chance of an event each round
+TOKEN_REGEN_RATE = 2 # How many influence tokens characters regain each round
+INITIAL_TRUST = 50 # Default starting trust value (0-100)
+MAX_PLAYER_TOKENS = 10 # Maximum tokens the player can hold
+INFLUENCE_ACTION_COSTS = {
+    "gentle_persuasion": 1,
+    "strong_persuasion": 2,
+    "ally_recruitment": 3,
+    "pressure_opponent": 4,
+    "proxy_speaking": 5 # Note: Proxy speaking logic is complex, implement effects later
+}
+INFLUENCE_ACTION_EFFECTS = {
+    # Stance delta is towards player's general alignment (support/oppose project)
+    # Needs refinement - assumes player wants to pull target towards their stance.
+    # Simple approach: Positive delta = more support, Negative delta = more opposition.
+    # TODO: Make delta relative to player's stance vs target's stance.
+    "gentle_persuasion": {"stance_delta": 5, "trust_delta": 2, "history_log": "gently persuaded"},
+    "strong_persuasion": {"stance_delta": 15, "trust_delta": 10, "history_log": "strongly persuaded"},
+    "ally_recruitment": {"stance_delta": 0, "trust_delta": 15, "history_log": "tried to recruit"}, # Focus on trust gain for now
+    "pressure_opponent": {"stance_delta": -10, "trust_delta": -15, "history_log": "pressured"}, # Makes target more opposed/less supportive
+}
+MAX_INFLUENCE_BATCH = 20 # Most influence actions accepted in one batch
+MAX_TOKENS_FACTOR = 1.5 # Max tokens = initial * factor (prevents infinite hoarding)
+# STANCES, NEUTRAL_SCORE and the stance thresholds live in models.py
+INITIAL_SUPPORT_SCORE = 75
+INITIAL_NEUTRAL_SCORE = 50
+INITIAL_OPPOSE_SCORE = 25
+INFLUENCE_SCORES = {
+    "developer": 2,
+    "local_resident": 1,
+    "council_member": 3,
+    "student_representative": 1
+}
+VICTORY_CONSENSUS_THRESHOLD = 6 # 6 out of 10 participants
+VICTORY_INFLUENCE_THRESHOLD = 9
+FAILURE_SUPPORT_THRESHOLD = 2 # Player + 2 others minimum to avoid instant failure
+CONSENSUS_THRESHOLD_PERCENT = 0.60 # 60% of participants must be 'Support'
+INFLUENCE_THRESHOLD_PERCENT = 0.60 # 60% of *total influence* must come from 'Support'
+FAILURE_SUPPORT_THRESHOLD_PERCENT = 0.25 # If 'Support' participants are <= 25%, it's a failure
+CRITICAL_CLIMATE_THRESHOLD = 20 # If climate drops <= 20, it's a failure
+
+# Sample names for AI characters
+SAMPLE_NAMES = [
+    "Alex Johnson", "Maria Garcia", "Chen Li", "Sam Williams", "Fatima Ahmed",
+    "David Smith", "Sophia Dubois", "Kenji Tanaka", "Olivia Brown", "Mohammed Khan",
+    "Isabelle Moreau", "Ben Carter", "Chloe Davis", "Raj Patel", "Zoe Miller"
+]
+
+# Define role details
+ROLES = {
+    "developer": {
+        "name": "Developer",
+        "description": "Represents the company planning the new development project.",
+        "objective": "Maximize profit while meeting minimum regulatory requirements.",
+        "influence": "Significant financial backing, technical expertise.",
+        "stance_distribution": { STANCES["support"]: 8, STANCES["neutral"]: 2 }, # 80% support, 20% neutral
+        "initial_influence_tokens": 6, # Updated
+        "initial_trust": INITIAL_TRUST
+    },
+    "local_resident": {
+        "name": "Local Resident",
+        "description": "Lives in the neighborhood affected by the development.",
+        "objective": "Preserve community character, minimize disruption, ensure fair compensation.",
+        "influence": "Community support, personal stakes.",
+        "stance_distribution": { STANCES["oppose"]: 6, STANCES["neutral"]: 4 }, # 60% oppose, 40% neutral
+        "initial_influence_tokens": 2, # Updated
+        "initial_trust": INITIAL_TRUST
+    },
+    "council_member": {
+        "name": "Council Member",
+        "description": "An elected official responsible for representing constituent interests.",
+        "objective": "Balance development benefits with community impact, uphold regulations.",
+        "influence": "Political network, regulatory power.",
+        "stance_distribution": { STANCES["neutral"]: 7, STANCES["support"]: 2, STANCES["oppose"]: 1 }, # 70% neutral, 20% support, 10% oppose
+        "initial_influence_tokens": 5, # Updated
+        "initial_trust": INITIAL_TRUST
+    },
+    "student_representative": {
+        "name": "Student Representative",
+        "description": "Advocates for student housing and campus-related needs.",
+        "objective": "Secure affordable housing options, improve campus accessibility.",
+        "influence": "Represents a large demographic, potential for mobilization.",
+        "stance_distribution": { STANCES["neutral"]: 5, STANCES["support"]: 4, STANCES["oppose"]: 1 }, # 50% neutral, 40% support, 10% oppose
+        "initial_influence_tokens": 3, # Updated
+        "initial_trust": INITIAL_TRUST
+    }
+}
+
+# Words that make a statement concern a role (see npc_relevance)
+ROLE_KEYWORDS = {
+    "developer": {"developer", "developers", "company", "builder", "builders", "construction", "investment", "investor",
+                  "profit", "profits", "cost", "costs", "budget"},
+    "local_resident": {"resident", "residents", "neighbour", "neighbours", "neighbor", "neighbors", "neighbourhood",
+                       "neighborhood", "community", "local", "locals", "family", "families", "traffic", "noise", "homes"},
+    "council_member": {"council", "councillor", "councilor", "official", "officials", "regulation", "regulations",
+                       "zoning", "permit", "permits", "planning", "vote", "approval", "constituents"},
+    "student_representative": {"student", "students", "campus", "university", "college", "affordable", "rent",
+                               "housing", "accommodation", "young"}
+}
+
+# NPC turn scheduling: relevance weights (see npc_relevance) and the no-call stance drift
+RELEVANCE_NAME_MENTION = 3.0 # Statement names the character
+RELEVANCE_ROLE_MENTION = 1.5 # Statement uses one of their role's keywords
+RELEVANCE_STANCE_WEIGHT = 1.0 # x distance from neutral (0-1): committed characters react more
+RELEVANCE_INFLUENCE_WEIGHT = 1.0 # x influence relative to the most influential role
+RELEVANCE_SPOKE_LAST_ROUND = -1.0 # Rotates the floor to those who were quiet last round
+LISTENER_DRIFT = 1 # Stance points a non-speaking character drifts with the climate
+
+# Seats per role at the table, player included (the player takes one of their role's seats)
+TABLE_ROLE_COUNTS = {
+    "developer": 2,
+    "local_resident": 3,
+    "student_representative": 2,
+    "council_member": 2
+}
+
+# Micro-Story Events
+MICRO_EVENTS = [
+    {
+        "id": "newspaper_scandal",
+        "text": "Islington Daily exposes potential irregularities in the developer's past projects! Public trust wavers.",
+        "effects": {"target": "role", "role_id": "local_resident", "stance_delta": -15, "climate_delta": -5}
+    },
+    {
+        "id": "student_subsidy",
+        "text": "The city government announces a surprise student housing subsidy program, boosting student optimism!",
+        "effects": {"target": "role", "role_id": "student_representative", "stance_delta": +15, "climate_delta": +5}
+    },
+    {
+        "id": "resident_emergency",
+        "text": "A key Local Resident representative has a sudden family emergency and must skip this round's discussion.",
+        "effects": {"target": "role_specific", "role_id": "local_resident", "skip_round": True} # Target one specific resident
+    },
+    {
+        "id": "unexpected_endorsement",
+        "text": "A respected independent urban planning group unexpectedly endorses the project's core ideas!",
+        "effects": {"target": "all", "stance_delta": +10, "climate_delta": +10}
+    },
+    {
+        "id": "developer_concession",
+        "text": "The Developer offers a minor concession regarding green spaces in the plan.",
+        "effects": {"target": "role", "role_id": "developer", "stance_delta": +5, "climate_delta": +5} # Small boost to developer's perceived score by others
+    },
+    {
+        "id": "budget_cuts_rumor",
+        "text": "Rumors circulate about potential city budget cuts impacting infrastructure needed for the project.",
+        "effects": {"target": "all", "stance_delta": -5, "climate_delta": -10}
+    },
+]
+
+# --- Balance Config --- #
+
+@dataclass(frozen=True)
+class BalanceConfig:
+    """The tunable balance constants, defaulting to the module-level values above."""
+    event_probability: float = EVENT_PROBABILITY
+    token_regen_rate: int = TOKEN_REGEN_RATE
+    max_player_tokens: int = MAX_PLAYER_TOKENS
+    influence_action_costs: dict[str, int] = field(default_factory=lambda: dict(INFLUENCE_ACTION_COSTS))
+    influence_action_effects: dict[str, dict] = field(
+        default_factory=lambda: {action: dict(effect) for action, effect in INFLUENCE_ACTION_EFFECTS.items()})
+    consensus_threshold_percent: float = CONSENSUS_THRESHOLD_PERCENT
+    influence_threshold_percent: float = INFLUENCE_THRESHOLD_PERCENT
+    failure_support_threshold_percent: float = FAILURE_SUPPORT_THRESHOLD_PERCENT
+    critical_climate_threshold: int = CRITICAL_CLIMATE_THRESHOLD
+    stance_distributions: dict[str, dict[str, int]] = field(
+        default_factory=lambda: {role_id: dict(info['stance_distribution']) for role_id, info in ROLES.items()})
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def replace(self, **changes):
+        """A copy with the given fields changed."""
+        return replace(self, **changes)
+
+    def config_hash(self):
+        """Stable content hash, e.g. to cache simulation results per configuration."""
+        payload = json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+DEFAULT_CONFIG = BalanceConfig()
+
+def trigger_and_apply_event(table, climate_score, current_round, rng=random, config=DEFAULT_CONFIG):
+    """
+    Checks if a random event should trigger based on config.event_probability.
+    If triggered, selects a random event, applies its effects to characters
+    and climate score, and returns the updated state and event text.
+    Handles stance clamping (0-100) and skip_round effect.
+    """
+    event_triggered_info = None
+    event_text = None
+
+    if rng.random() < config.event_probability:
+        chosen_event = rng.choice(MICRO_EVENTS)
+        event_text = f"**Event Occurred (Round {current_round}):** {chosen_event['text']}"
+        effects = chosen_event['effects']
+        event_triggered_info = chosen_event # Store for potential later use/logging
+        print(f"--- EVENT TRIGGERED: {chosen_event['id']} ---") # Server log
+        metrics.EVENTS_FIRED.labels(chosen_event['id']).inc()
+
+        # Apply climate delta
+        climate_delta = effects.get('climate_delta', 0)
+        if climate_delta != 0:
+            original_climate = climate_score
+            climate_score = max(0, min(100, climate_score + climate_delta))
+            print(f"EVENT: Climate changed by {climate_delta} from {original_climate} to {climate_score}")
+
+        # Identify affected characters
+        stance_delta = effects.get('stance_delta', 0)
+        target_type = effects.get('target')
+        target_role = effects.get('role_id')
+        apply_skip = effects.get('skip_round', False)
+        affected_chars_for_event = []
+
+        if target_type == 'all':
+            affected_chars_for_event = table
+        elif target_type == 'role' and target_role:
+            affected_chars_for_event = table.by_role(target_role)
+        elif target_type == 'role_specific' and target_role:
+             # Find all eligible characters for the specific role
+             eligible_chars = [char for char in table.by_role(target_role) if not char.skipped_round] # Avoid affecting already skipped
+             if eligible_chars:
+                 # Pick one randomly from eligible ones
+                 char_to_affect = rng.choice(eligible_chars)
+                 affected_chars_for_event = [char_to_affect]
+
+        # Apply effects to identified characters
+        for char in affected_chars_for_event:
+             # Apply stance delta
+             if stance_delta != 0:
+                 char.adjust_stance(stance_delta) # Stance category is derived from the score
+                 print(f"EVENT: Stance for {char.name} ({char.role_id}) changed by {stance_delta} -> {char.stance_score} ({char.stance})")
+
+             # Apply skip_round effect (only applies if target was role_specific)
+             if apply_skip and target_type == 'role_specific':
+                 char.skipped_round = True # Mark character as skipping this round
+                 print(f"EVENT: {char.name} ({char.role_id}) will skip this round due to event.")
+
+    # Return potentially modified table, climate, and the event message
+    return table, climate_score, event_text, event_triggered_info
+
+
+# --- Round Processing --- #
+
+def validate_player_statement(player_statement, player):
+    """Returns a (message, category) flash tuple if the statement can't be submitted, else None."""
+    word_count = len(player_statement.split())
+    if not player_statement: # Handle empty submission separately if needed
+        return ('Please enter your statement.', 'warning')
+    elif word_count < MIN_STATEMENT_WORDS:
+        return (f'Your statement must be at least {MIN_STATEMENT_WORDS} words long (currently {word_count}). Please elaborate.', 'error')
+    if player.influence_tokens < 1:
+        return ('Not enough Influence Tokens to make a statement.', 'error')
+    return None
+
+def charge_statement_token(player, negotiation_state=None, statement=None):
+    """Deducts the 1-token statement cost from the player (and logs the statement, given the game's state)."""
+    if negotiation_state is not None:
+        record(negotiation_state, 'statement', char_id=player.id, text=statement)
+    player.influence_tokens -= 1
+    print(f"Player statement cost: 1 token. Remaining: {player.influence_tokens}")
+
+
+def start_round(table, negotiation_state, rng=random, config=DEFAULT_CONFIG):
+    """
+    First half of a round: records each AI's stance category, clears skip flags
+    and rolls the micro-event. Returns the event text if an event fired, else None.
+    """
+    # --- Store previous stance *category* before potential updates --- #
+    # Note: We store the *category* derived from the score at the start of the round
+    for char in table.ai_characters:
+        # Store category based on score *before* AI response potentially changes it
+        char.previous_stance_category = char.stance
+
+    # --- Clear Previous Skip Flags & Trigger/Apply Event --- #
+    for char in table:
+        char.skipped_round = False # Remove flag from previous round if set
+
+    climate_score = negotiation_state.get('negotiation_climate', 50)
+    # Get current round *before* potential event happens
+    current_round = negotiation_state['round']
+    with metrics.span('event'):
+        table, climate_score, event_text, event_info = trigger_and_apply_event(table, climate_score, current_round, rng, config)
+    negotiation_state['negotiation_climate'] = climate_score # Update climate in state
+    record(negotiation_state, 'event', event_id=event_info['id'] if event_info else None)
+    return event_text
+
+def play_round(table, negotiation_state, player_statement, npc_policy, on_event=None, rng=random, config=DEFAULT_CONFIG):
+    """
+    Plays one round in place: event trigger, NPC reactions (from npc_policy),
+    stance and climate updates, history append, round increment and (after
+    the last round) the victory check. Returns the event text if an event
+    fired, else None. on_event(event_text) fires right after an event
+    triggers, before the policy is asked for any reaction.
+    """
+    event_text = start_round(table, negotiation_state, rng, config)
+    if event_text and on_event:
+        on_event(event_text)
+
+    # --- NPC Reactions --- #
+    with metrics.span('npc_policy'):
+        ai_responses_data = npc_policy(table, negotiation_state, player_statement, rng)
+    finish_round(table, negotiation_state, player_statement, ai_responses_data, config)
+    return event_text
+
+async def play_round_async(table, negotiation_state, player_statement, npc_policy, on_event=None, rng=random,
+                           config=DEFAULT_CONFIG):
+    """play_round with a coroutine NPC policy (same signature, awaited), for the async server."""
+    event_text = start_round(table, negotiation_state, rng, config)
+    if event_text and on_event:
+        on_event(event_text)
+
+    with metrics.span('npc_policy'):
+        ai_responses_data = await npc_policy(table, negotiation_state, player_statement, rng)
+    finish_round(table, negotiation_state, player_statement, ai_responses_data, config)
+    return event_text
+
+def finish_round(table, negotiation_state, player_statement, ai_responses_data, config=DEFAULT_CONFIG):
+    """
+    Second half of a round: applies the NPC reactions to stances and climate,
+    appends the round to the history, advances the round counter and, after
+    the last round, records the outcome. player_statement may also be a
+    {char_id: statement} dict, for a round with several human players.
+    """
+    if isinstance(player_statement, dict):
+        round_dialogue = dict(player_statement) # Start round with the human players
+    else:
+        round_dialogue = {table.player.id: player_statement} # Start round with player
+    # Add AI statements (a character the turn scheduler left silent has response None)
+    round_dialogue.update({ai_id: data['response'] for ai_id, data in ai_responses_data.items() if data['response'] is not None})
+
+    # --- Update Character Stance Scores --- #
+    for ai_id, data in ai_responses_data.items():
+        char = table.get(ai_id)
+        new_score = data['new_score']
+        # Logged against the pre-round score: the policies' results carry only the new score
+        record(negotiation_state, 'npc', char_id=ai_id, response=data['response'], new_score=new_score,
+               score_change=new_score - char.stance_score)
+        if new_score != char.stance_score:
+            print(f"Updating stance score for {char.name}: {char.stance_score} -> {new_score}") # Debug print
+        char.stance_score = new_score # Stance category is derived from the score
+
+    # --- Update Negotiation Climate --- #
+    total_score_change = 0
+    ai_count = 0
+    for ai_id, data in ai_responses_data.items():
+        new_score = table.get(ai_id).stance_score
+        old_score = new_score - data.get('score_change', 0) # Estimate previous score
+        total_score_change += (new_score - old_score)
+        ai_count += 1
+
+    if ai_count > 0:
+        average_change = total_score_change / ai_count
+        climate_change_factor = 2 # How much average score change affects climate
+        climate_change = round(average_change * climate_change_factor)
+        current_climate = negotiation_state.get('negotiation_climate', 50)
+        new_climate = current_climate + climate_change
+        new_climate = max(0, min(100, new_climate)) # Clamp 0-100
+        negotiation_state['negotiation_climate'] = new_climate
+        print(f"Climate Change: {climate_change:+}, New Climate: {new_climate}/100 (Avg Score Change: {average_change:.1f})")
+
+    # Add the complete round dialogue to history
+    negotiation_state['history'].append(round_dialogue)
+
+    # Increment round number *before* checking victory or saving state
+    negotiation_state['round'] += 1
+
+    # Check for victory/end condition *after* updating round number
+    if negotiation_state['round'] > MAX_ROUNDS:
+        negotiation_state['outcome'] = check_victory(table, negotiation_state.get('negotiation_climate', 50), config)
+        record(negotiation_state, 'outcome', outcome=negotiation_state['outcome'])
+
+# --- NPC Turn Scheduling --- #
+
+def statement_words(statement):
+    """Lower-case words of a statement, for relevance matching."""
+    return set(re.findall(r"[a-z']+", statement.lower()))
+
+def npc_relevance(char, words, spoke_last_round):
+    """
+    How much the player's statement (words, see statement_words) calls for a
+    reply from char. Cheap signals only: a name or role-keyword mention, stance
+    distance from neutral, influence, and whether they spoke last round.
+    """
+    score = 0.0
+    if words & set(char.name.lower().split()):
+        score += RELEVANCE_NAME_MENTION
+    if words & ROLE_KEYWORDS.get(char.role_id, set()):
+        score += RELEVANCE_ROLE_MENTION
+    score += RELEVANCE_STANCE_WEIGHT * abs(char.stance_score - INITIAL_NEUTRAL_SCORE) / INITIAL_NEUTRAL_SCORE
+    score += RELEVANCE_INFLUENCE_WEIGHT * char.influence / max(INFLUENCE_SCORES.values())
+    if spoke_last_round:
+        score += RELEVANCE_SPOKE_LAST_ROUND
+    return score
+
+def schedule_speakers(ai_characters, player_statement, history, k):
+    """
+    Splits this round's AI characters into (speakers, listeners): the k most
+    relevant speak (ties keep seat order), the rest only listen. Both lists
+    keep table order. k=None lets everyone speak.
+    """
+    if k is None or k >= len(ai_characters):
+        return list(ai_characters), []
+    words = statement_words(player_statement)
+    last_round = history[-1] if history else {}
+    ranked = sorted(ai_characters, key=lambda char: -npc_relevance(char, words, char.id in last_round))
+    chosen = {char.id for char in ranked[:max(0, k)]}
+    return ([char for char in ai_characters if char.id in chosen],
+            [char for char in ai_characters if char.id not in chosen])
+
+def listener_drift(char, climate_score):
+    """A listening character's new stance score: a small drift with the room's climate, no LLM call."""
+    if climate_score >= 60:
+        return min(100, char.stance_score + LISTENER_DRIFT)
+    if climate_score <= 40:
+        return max(0, char.stance_score - LISTENER_DRIFT)
+    return char.stance_score
+
+def regenerate_tokens(table, negotiation_state, config=DEFAULT_CONFIG):
+    """Start-of-round influence token regeneration for every character (call from round 2 on)."""
+    print("--- Regenerating Influence Tokens ---")
+    record(negotiation_state, 'regen')
+    # --- Award Conversion Bonus (to every human player) --- #
+    bonus_token = 0
+    if negotiation_state.pop('conversion_bonus_pending', None): # Consume the flag
+        bonus_token = 1
+        print("Awarding +1 bonus token for previous NPC conversion!")
+    for char in table:
+        current_tokens = char.influence_tokens
+        if char.is_player:
+            # Player regeneration: +1 per round, up to max_player_tokens
+            regen_amount = 1 # Base regeneration for player
+            total_regen = regen_amount + bonus_token
+            new_tokens = min(current_tokens + total_regen, config.max_player_tokens)
+            char.influence_tokens = new_tokens
+            print(f"Regenerating tokens for Player: {current_tokens} + {regen_amount} (base) + {bonus_token} (bonus) -> {new_tokens} (Max: {config.max_player_tokens})")
+        else:
+            # AI regeneration: Flat rate based on token_regen_rate
+            regen_amount = config.token_regen_rate # Use the flat rate defined
+            new_tokens = min(current_tokens + regen_amount, char.max_tokens)
+            char.influence_tokens = new_tokens
+            if new_tokens > current_tokens:
+                 print(f"Regenerating tokens for AI {char.name}: {current_tokens} -> {new_tokens} (Max: {char.max_tokens})")
+
+def _influence_target_error(table, action, target_id, config):
+    """(message, http_status) if action/target_id isn't a valid influence action, else None."""
+    if action not in config.influence_action_costs:
+        return (f"Unknown influence action '{action}'.", 400)
+    target_npc = table.get(target_id)
+    if not target_npc or target_npc.is_player:
+        return ('Target NPC not found.', 404)
+    return None
+
+def apply_influence(table, negotiation_state, action, target_id, config=DEFAULT_CONFIG):
+    """
+    Spends the player's tokens on an influence action against target_id.
+    Returns (target, None) on success or (None, (message, http_status)) if the
+    action can't be taken.
+    """
+    error = _influence_target_error(table, action, target_id, config)
+    if error:
+        return None, error
+    target_npc = table.get(target_id)
+    player = table.player
+    cost = config.influence_action_costs[action]
+    if player.influence_tokens < cost:
+        return None, ('Not enough Influence Tokens for this action.', 400)
+    action_effect = config.influence_action_effects.get(action, {})
+
+    old_stance_score = target_npc.stance_score
+    old_stance = target_npc.stance
+    old_trust = target_npc.trust_value
+
+    # Apply effects (modify stance and trust)
+    target_npc.adjust_stance(action_effect.get('stance_delta', 0))
+    target_npc.adjust_trust(action_effect.get('trust_delta', 0))
+    new_stance = target_npc.stance # Get new stance AFTER change
+
+    print(f"Applied influence '{action}' to {target_npc.name}. Stance: {old_stance_score} -> {target_npc.stance_score} ({new_stance}), Trust: {old_trust} -> {target_npc.trust_value}")
+
+    # --- Check for Neutral -> Support Conversion --- #
+    if old_stance == STANCES['neutral'] and new_stance == STANCES['support']:
+        negotiation_state['conversion_bonus_pending'] = True
+        print(f"!!! Conversion bonus triggered for turning {target_npc.name} supportive! Pending for next round.")
+    # --- End Conversion Check --- #
+
+    # Update player tokens
+    player.influence_tokens -= cost
+    record(negotiation_state, 'influence', action=action, target_id=target_id)
+    return target_npc, None
+
+def influence_delta(table, char_ids):
+    """The player's tokens and the current stance/trust of char_ids, as sent back to the page."""
+    return {
+        'player_tokens': table.player.influence_tokens,
+        'characters': {char_id: {'stance_score': table.get(char_id).stance_score,
+                                 'stance': table.get(char_id).stance,
+                                 'trust_value': table.get(char_id).trust_value} for char_id in char_ids}
+    }
+
+def apply_influence_batch(table, negotiation_state, operations, config=DEFAULT_CONFIG):
+    """
+    Applies a list of {'action', 'target_id'} influence operations, all or none:
+    every operation and their total cost are checked before any is applied.
+    Returns (delta, None) or (None, (message, http_status)); delta is
+    influence_delta() for the targets plus 'spent' and 'conversions' (the ids
+    turned Neutral -> Support, each of which sets the conversion bonus).
+    """
+    if not isinstance(operations, list) or not operations:
+        return None, ('No influence actions given.', 400)
+    if len(operations) > MAX_INFLUENCE_BATCH:
+        return None, (f"At most {MAX_INFLUENCE_BATCH} influence actions can be sent at once.", 400)
+    for operation in operations:
+        if not isinstance(operation, dict):
+            return None, ('Each influence action needs an action and a target_id.', 400)
+        error = _influence_target_error(table, operation.get('action'), operation.get('target_id'), config)
+        if error:
+            return None, error
+    spent = sum(config.influence_action_costs[operation['action']] for operation in operations)
+    if table.player.influence_tokens < spent:
+        return None, (f"Not enough Influence Tokens for these actions ({spent} needed).", 400)
+
+    targets = []
+    conversions = []
+    for operation in operations:
+        target_npc = table.get(operation['target_id'])
+        old_stance = target_npc.stance
+        apply_influence(table, negotiation_state, operation['action'], target_npc.id, config)
+        if old_stance == STANCES['neutral'] and target_npc.stance == STANCES['support']:
+            conversions.append(target_npc.id)
+        if target_npc.id not in targets:
+            targets.append(target_npc.id)
+    delta = influence_delta(table, targets)
+    delta.update({'spent': spent, 'conversions': conversions})
+    return delta, None
+
+# --- Victory Check Logic --- #
+def check_victory(characters, climate_score, config=DEFAULT_CONFIG):
+    """Determines the outcome of the negotiation based on final stances and potentially climate."""
+    # Use derived stance category for final check
+    supporters = []
+    opposers = []
+    total_influence = 0
+    supporter_influence = 0
+    total_participants = len(characters)
+
+    for char in characters:
+        stance = char.stance
+        influence = char.influence
+        total_influence += influence
+        if stance == STANCES['support']:
+            supporters.append(char)
+            supporter_influence += influence
+        elif stance == STANCES['oppose']:
+            opposers.append(char)
+
+    # --- Implement New Victory/Failure Conditions --- #
+    # 1. Consensus Victory
+    if total_participants > 0 and (len(supporters) / total_participants) >= config.consensus_threshold_percent:
+        return f"Consensus Victory: Project approved with broad agreement ({len(supporters)}/{total_participants} supporters)!"
+
+    # 2. Influence Victory
+    if total_influence > 0 and (supporter_influence / total_influence) >= config.influence_threshold_percent:
+        return f"Influence Victory: Key figures secured project approval (Supporting Influence: {supporter_influence}/{total_influence})!"
+
+    # 3. Compromise Victory (Placeholder - requires tracking specific proposals)
+    # if conditions_for_compromise_met(characters, history):
+    #    return "Compromise Victory: A middle ground was found!"
+
+    # 4. Total Failure (Critically Low Support OR Bad Climate)
+    support_ratio = (len(supporters) / total_participants) if total_participants > 0 else 0
+    if support_ratio <= config.failure_support_threshold_percent:
+        return f"Total Failure: Project rejected due to overwhelming opposition or apathy (Support: {len(supporters)}/{total_participants})."
+    if climate_score <= config.critical_climate_threshold:
+        return f"Total Failure: Negotiations collapsed due to a toxic climate (Climate Score: {climate_score})."
+
+    # 5. Partial Failure (Stalemate - Default if no other condition met)
+    return f"Partial Failure: Negotiation ended in stalemate. Insufficient consensus or influence reached (Support: {len(supporters)}/{total_participants}, Influence: {supporter_influence}/{total_influence}, Climate: {climate_score})."
+
+    # 6. Public Backlash (Placeholder - requires separate mechanic)
+    # if public_opinion_low:
+    #    return "Failure: Public backlash halted the project."
+
+def generate_ai_opponents(player_role_id, rng=random, config=DEFAULT_CONFIG):
+    """Generates the 9 AI opponents with profiles, including initial stance and influence."""
+    opponents = []
+    used_names = set()
+    role_counts = dict(TABLE_ROLE_COUNTS)
+
+    # Decrease count for player's role
+    if player_role_id in role_counts:
+        role_counts[player_role_id] -= 1 # Player takes one spot
+
+    opponent_id_counter = 1 # Start AI IDs from 1
+    for role_id, count in role_counts.items():
+        role_info = ROLES[role_id]
+        for _ in range(count):
+            # Ensure unique name
+            name = rng.choice(SAMPLE_NAMES)
+            while name in used_names:
+                name = rng.choice(SAMPLE_NAMES)
+            used_names.add(name)
+
+            # Determine initial stance randomly based on role distribution
+            stance_dist = config.stance_distributions.get(role_id) or { STANCES["neutral"]: 1 } # Default to neutral if undefined
+            possible_stances = list(stance_dist.keys())
+            weights = list(stance_dist.values())
+            chosen_initial_stance = rng.choices(possible_stances, weights=weights, k=1)[0]
+
+            # Map chosen stance to initial score
+            initial_score_map = {
+                STANCES["support"]: INITIAL_SUPPORT_SCORE,
+                STANCES["neutral"]: INITIAL_NEUTRAL_SCORE,
+                STANCES["oppose"]: INITIAL_OPPOSE_SCORE
+            }
+            chosen_initial_score = initial_score_map.get(chosen_initial_stance, INITIAL_NEUTRAL_SCORE)
+
+            # Generate simple random profile for AI
+            ai_profile = {
+                'id': f'ai_{opponent_id_counter}', # Unique ID for AI
+                'role_id': role_id,
+                'role_name': role_info['name'],
+                'name': name,
+                'age': rng.randint(20, 70),
+                'gender': rng.choice(['Male', 'Female', 'Other']),
+                'local_born': rng.choice(['Yes', 'No']),
+                'has_children': rng.choice(['Yes', 'No']),
+                # Add simplified backstory/details based on role
+                'backstory': f"Objective: {role_info['objective']}", # Simplified backstory
+                'is_player': False, # Flag to differentiate AI from player
+                'influence': INFLUENCE_SCORES.get(role_id, 1), # Add influence score
+                'initial_stance': chosen_initial_stance, # Store the randomly chosen stance
+                'stance_score': chosen_initial_score, # Set score based on chosen stance
+                'influence_tokens': ROLES[role_id]['initial_influence_tokens'],
+                'max_tokens': int(ROLES[role_id]['initial_influence_tokens'] * MAX_TOKENS_FACTOR),
+                'trust_value': INITIAL_TRUST,
+            }
+            # Add simple logic for num_children if needed, or omit for AI
+            if ai_profile['has_children'] == 'Yes':
+                ai_profile['num_children'] = rng.randint(1, 4)
+            else:
+                ai_profile['num_children'] = 0
+            # Add marital status if needed
+            ai_profile['marital_status'] = rng.choice(['Single', 'Married', 'Other'])
+
+            opponents.append(Character(**ai_profile))
+            opponent_id_counter += 1
+
+    return opponents
+
+def create_player(role_id, config=DEFAULT_CONFIG, player_id='player_0', **profile):
+    """The player's Character for role_id, from the customization form fields (name, age, backstory...)."""
+    initial_stance = STANCES["support"] # Player always supports their own goal initially
+    return Character(
+        id=player_id, # Unique ID for player (player_1, player_2... for other humans in a room)
+        role_id=role_id,
+        role_name=ROLES[role_id]['name'],
+        is_player=True,
+        influence=INFLUENCE_SCORES.get(role_id, 1), # Get influence score
+        initial_stance=initial_stance,
+        stance_score={
+            STANCES["support"]: INITIAL_SUPPORT_SCORE,
+            STANCES["neutral"]: INITIAL_NEUTRAL_SCORE,
+            STANCES["oppose"]: INITIAL_OPPOSE_SCORE
+        }.get(initial_stance, INITIAL_NEUTRAL_SCORE), # Default to neutral if somehow invalid
+        influence_tokens=ROLES[role_id]['initial_influence_tokens'],
+        max_tokens=config.max_player_tokens, # Use the new constant
+        trust_value=INITIAL_TRUST,
+        **profile
+    )
+
+def new_game(player, rng=random, config=DEFAULT_CONFIG, seed=None):
+    """
+    Seats the player with freshly generated AI opponents. Returns (table, negotiation_state).
+    With a seed, the table is generated from it (rng is ignored) and the game
+    is seeded and logged (see the module docstring).
+    """
+    if seed is not None:
+        rng = random.Random(seed)
+    all_characters = generate_ai_opponents(player.role_id, rng, config) + [player] # Player added last before shuffle
+    rng.shuffle(all_characters) # Shuffle characters for display order
+    negotiation_state = {
+        'round': 1,
+        'history': [], # List of rounds, each round is a dict: {'character_id': statement}
+        'outcome': None, # Will store win/loss reason
+        'negotiation_climate': 50 # Initial climate score (0-100)
+    }
+    table = Table(all_characters)
+    if seed is not None:
+        negotiation_state.update({'seed': seed, 'log': []})
+        record_snapshot(table, negotiation_state)
+    return table, negotiation_state
+
+# --- Seeding & Round Log --- #
+
+def new_seed():
+    """A fresh random game seed (fits a signed 64-bit integer)."""
+    return random.SystemRandom().getrandbits(63)
+
+def round_rng(negotiation_state):
+    """The dice for the game's current round, derived from its seed (the module-level random if it has none)."""
+    seed = negotiation_state.get('seed')
+    if seed is None:
+        return random
+    return random.Random(f"{seed}:{negotiation_state['round']}")
+
+def record(negotiation_state, kind, **data):
+    """Appends an entry to the game's round log, if it keeps one (seeded games do)."""
+    log = negotiation_state.get('log')
+    if log is not None:
+        log.append({'kind': kind, 'round': negotiation_state['round'], **data})
+
+def record_snapshot(table, negotiation_state):
+    """Logs the table's numbers and per-seat state and the climate, from which replay.py can start."""
+    record(negotiation_state, 'snapshot', numbers=base64.b64encode(table.numbers().tobytes()).decode('ascii'),
+           char_state=table.state_records(), climate=negotiation_state.get('negotiation_climate', 50),
+           outcome=negotiation_state.get('outcome'), seed=negotiation_state.get('seed'))
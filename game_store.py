@@ -0,0 +1,486 @@
+"""
+SQLite game-state store.
+
+The Flask session only carries a game id; everything else lives here, in a
+SQLite database in WAL mode:
+
+    games       one row per game: round, outcome, climate, the packed numeric
+                fields of every seat, per-seat round state and the small
+                remaining negotiation_state keys (JSON)
+    characters  one row per seat with its static profile, written once
+    rounds      one row per played round, with the rendered transcript text and
+                the seats' numeric fields as they were when it was saved
+    statements  one row per statement, in speaking order
+    round_log   the game's round log (see engine.py), append-only: one row per
+                entry, in the order the rules applied them
+
+load_game() returns a Game holding the Table (see models.py) and the
+negotiation_state dict plus a snapshot of what was read, and save_game()
+writes back only what changed: new rounds are appended and the games row is
+rewritten only if its state differs. Write cost per request therefore stays
+constant as games get longer. Likewise, negotiation_state['log'] only holds
+the log entries added since the game was loaded; saving appends them and
+load_log() reads the whole log back (for replay.py).
+
+Concurrency: every games row carries a version that save_game() bumps with a
+compare-and-set, so a save based on a stale load raises StaleGameError instead
+of silently overwriting someone else's write (update_game() reloads and
+retries). Within a process, lock(game_id) serializes the slow mutations, i.e.
+rounds, so quick ones such as influence actions wait instead of conflicting.
+
+The schema version is kept in PRAGMA user_version. Opening a file written by
+an older version migrates it in place (MIGRATIONS: additive steps, so its
+games are kept), inside one write transaction so concurrent openers don't
+race; only the pre-Table layout (before version MIGRATIONS starts at) is reset.
+
+AsyncGameStore exposes the same calls as coroutines for the async server: each
+runs on a small dedicated thread pool, so SQLite I/O never blocks the event loop.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from models import Table
+
+SCHEMA_VERSION = 5
+UPDATE_RETRIES = 3 # update_game() attempts before a version conflict is raised
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id TEXT PRIMARY KEY,
+    round INTEGER NOT NULL,
+    outcome TEXT,
+    climate INTEGER NOT NULL,
+    numbers BLOB NOT NULL,
+    char_state TEXT NOT NULL,
+    extra TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS characters (
+    game_id TEXT NOT NULL,
+    char_id TEXT NOT NULL,
+    seat INTEGER NOT NULL,
+    profile TEXT NOT NULL,
+    PRIMARY KEY (game_id, char_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rounds (
+    game_id TEXT NOT NULL,
+    round_number INTEGER NOT NULL,
+    rendered TEXT,
+    numbers BLOB,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (game_id, round_number)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS statements (
+    game_id TEXT NOT NULL,
+    round_number INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    char_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (game_id, round_number, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS round_log (
+    game_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    round_number INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (game_id, seq)
+) WITHOUT ROWID;
+"""
+
+# Schema version -> statements that bring a file at that version to the next one. Tables
+# added by a version need no step: SCHEMA creates whatever is missing after migrating.
+MIGRATIONS = {
+    2: ["ALTER TABLE games ADD COLUMN version INTEGER NOT NULL DEFAULT 1"],
+    3: ["ALTER TABLE rounds ADD COLUMN numbers BLOB"], # Rounds saved before have no snapshot: deltas send every seat
+    4: [], # round_log
+}
+_TABLES = ('games', 'characters', 'rounds', 'statements', 'round_log')
+
+# negotiation_state keys with their own columns/tables; everything else goes in games.extra
+_STATE_COLUMNS = ('round', 'outcome', 'negotiation_climate', 'history', 'transcript', 'log')
+# negotiation_state keys that are in-memory caches, rebuilt on demand and never stored
+_TRANSIENT_STATE = ('history_index',)
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+class StaleGameError(Exception):
+    """Raised by save_game() when the game was saved by someone else since it was loaded."""
+
+
+class Game:
+    """A loaded game. Mutate table / negotiation_state in place, then save_game()."""
+
+    def __init__(self, game_id, table, negotiation_state, history_loaded, version=1):
+        self.id = game_id
+        self.table = table
+        self.negotiation_state = negotiation_state
+        self.history_loaded = history_loaded
+        self.version = version # Stored version this copy is based on
+        self._replaced_seats = set()
+        self._log_persisted = 0 # Round log entries stored before this copy's negotiation_state['log']
+        self._snapshot(rounds_persisted=None)
+
+    def replace_character(self, seat, char):
+        """Seats char in place of the character at seat; its profile is written on the next save."""
+        self.table.replace(seat, char)
+        self._replaced_seats.add(seat)
+
+    def _snapshot(self, rounds_persisted):
+        """Records what is stored, so the next save writes only the difference."""
+        self._row = self._games_row()
+        if rounds_persisted is not None:
+            self._rounds_persisted = rounds_persisted
+
+    def _log_saved(self):
+        """Moves the saved log entries out of negotiation_state['log']."""
+        log = self.negotiation_state.get('log')
+        if log:
+            self._log_persisted += len(log)
+            log.clear()
+
+    def _games_row(self):
+        state = self.negotiation_state
+        extra = {k: v for k, v in state.items() if k not in _STATE_COLUMNS and k not in _TRANSIENT_STATE}
+        return (state['round'], state.get('outcome'), state.get('negotiation_climate', 50),
+                self.table.numbers().tobytes(), _dumps(self.table.state_records()), _dumps(extra))
+
+
+class GameStore:
+    """Thread-safe SQLite store for games. One connection per thread; WAL allows concurrent readers."""
+
+    def __init__(self, path, render_round=None):
+        """
+        render_round(round_number, round_statements, characters_lookup) -> str, if given,
+        is stored with each new round so the prompt transcript can be rebuilt on load
+        without re-rendering past rounds.
+        """
+        self.path = path
+        self.render_round = render_round
+        self._local = threading.local()
+        self._locks = weakref.WeakValueDictionary()
+        self._locks_guard = threading.Lock()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE") # Other processes opening the file wait, then find it migrated
+        try:
+            self._migrate(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _migrate(self, conn):
+        """Brings the file to SCHEMA_VERSION: creates it, applies MIGRATIONS or resets a pre-Table layout."""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f"{self.path} has game store schema {version}; this code knows up to {SCHEMA_VERSION}.")
+        if version < SCHEMA_VERSION and conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'games'").fetchone():
+            if version < min(MIGRATIONS):
+                print(f"Game store {self.path}: schema {version} predates migrations; resetting it")
+                for table in _TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+            else:
+                print(f"Game store {self.path}: migrating schema {version} -> {SCHEMA_VERSION}")
+                for from_version in range(version, SCHEMA_VERSION):
+                    for statement in MIGRATIONS[from_version]:
+                        conn.execute(statement)
+        for statement in SCHEMA.split(';'): # executescript() would commit the transaction
+            if statement.strip():
+                conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create_game(self, table, negotiation_state):
+        """Stores a new game and returns it (with a fresh game id)."""
+        game = Game(uuid.uuid4().hex, table, negotiation_state, history_loaded=True)
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO games (id, round, outcome, climate, numbers, char_state, extra, version, created_at,"
+                         " updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (game.id, *game._games_row(), game.version, now, now))
+            conn.executemany("INSERT INTO characters (game_id, char_id, seat, profile) VALUES (?, ?, ?, ?)",
+                             [(game.id, char.id, seat, _dumps(char.profile_record())) for seat, char in enumerate(table)])
+            self._append_rounds(conn, game, 0, now)
+            self._append_log(conn, game)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        game._snapshot(rounds_persisted=len(negotiation_state.get('history', [])))
+        game._log_saved()
+        return game
+
+    def load_game(self, game_id, with_history=True):
+        """
+        Returns the Game with this id, or None. With with_history=False the
+        statements aren't read (negotiation_state['history'] is absent); use it
+        for requests that never look at the dialogue.
+        """
+        if not game_id:
+            return None
+        with metrics.GAME_STORE_SECONDS.labels('load').time(), metrics.span('store.load'):
+            return self._load_game(game_id, with_history)
+
+    def _load_game(self, game_id, with_history):
+        conn = self._conn()
+        row = conn.execute("SELECT round, outcome, climate, numbers, char_state, extra, version FROM games WHERE id = ?",
+                           (game_id,)).fetchone()
+        if row is None:
+            return None
+        negotiation_state = json.loads(row[5])
+        negotiation_state.update({'round': row[0], 'outcome': row[1], 'negotiation_climate': row[2]})
+        log_persisted = conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM round_log WHERE game_id = ?",
+                                     (game_id,)).fetchone()[0]
+        if 'seed' in negotiation_state: # Seeded games keep a round log; new entries collect here until saved
+            negotiation_state['log'] = []
+        profiles = [json.loads(profile) for (profile,) in conn.execute(
+            "SELECT profile FROM characters WHERE game_id = ? ORDER BY seat", (game_id,))]
+        table = Table.from_records(profiles, row[3], json.loads(row[4]))
+
+        rounds_persisted = conn.execute("SELECT COUNT(*) FROM rounds WHERE game_id = ?", (game_id,)).fetchone()[0]
+        if with_history:
+            history = [{} for _ in range(rounds_persisted)]
+            for round_number, char_id, text in conn.execute(
+                    "SELECT round_number, char_id, text FROM statements WHERE game_id = ? ORDER BY round_number, seq",
+                    (game_id,)):
+                history[round_number - 1][char_id] = text
+            negotiation_state['history'] = history
+            rendered = [r for (r,) in conn.execute(
+                "SELECT rendered FROM rounds WHERE game_id = ? ORDER BY round_number", (game_id,))]
+            if rendered and all(r is not None for r in rendered):
+                negotiation_state['transcript'] = {'rounds': len(rendered), 'text': ''.join(rendered)}
+
+        game = Game(game_id, table, negotiation_state, history_loaded=with_history, version=row[6])
+        game._rounds_persisted = rounds_persisted
+        game._log_persisted = log_persisted
+        return game
+
+    def save_game(self, game):
+        """
+        Writes back what changed since the game was loaded (or last saved) and
+        bumps its version. Raises StaleGameError, writing nothing, if the stored
+        game is no longer at game.version.
+        """
+        with metrics.GAME_STORE_SECONDS.labels('save').time(), metrics.span('store.save'):
+            self._save_game(game)
+
+    def _save_game(self, game):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = game._games_row()
+            new_rounds = game.history_loaded and len(game.negotiation_state['history']) > game._rounds_persisted
+            # New log entries bump the version too, so two saves can't both append at the same seq
+            new_log = bool(game.negotiation_state.get('log'))
+            if row != game._row or new_rounds or game._replaced_seats or new_log:
+                updated = conn.execute("UPDATE games SET round = ?, outcome = ?, climate = ?, numbers = ?, char_state = ?,"
+                                       " extra = ?, version = version + 1, updated_at = ? WHERE id = ? AND version = ?",
+                                       (*row, now, game.id, game.version)).rowcount
+                if not updated:
+                    metrics.GAME_STORE_CONFLICTS.inc()
+                    raise StaleGameError(f"Game {game.id} changed since version {game.version} was loaded.")
+                game.version += 1
+            else:
+                conn.execute("UPDATE games SET updated_at = ? WHERE id = ?", (now, game.id))
+
+            if new_rounds:
+                self._append_rounds(conn, game, game._rounds_persisted, now)
+            self._append_log(conn, game)
+            conn.executemany("UPDATE characters SET char_id = ?, profile = ? WHERE game_id = ? AND seat = ?",
+                             [(game.table[seat].id, _dumps(game.table[seat].profile_record()), game.id, seat)
+                              for seat in sorted(game._replaced_seats)])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        game._replaced_seats.clear()
+        game._snapshot(rounds_persisted=len(game.negotiation_state['history']) if game.history_loaded else None)
+        game._log_saved()
+
+    def update_game(self, game_id, mutate, with_history=False, retries=UPDATE_RETRIES):
+        """
+        Loads the game, applies mutate(game) and saves it, reloading and re-applying
+        on a version conflict. mutate must only touch the game (it may run more
+        than once). Returns (game, mutate's result), or (None, None) if there is
+        no such game; raises StaleGameError once retries are used up.
+        """
+        for attempt in range(retries):
+            game = self.load_game(game_id, with_history=with_history)
+            if game is None:
+                return None, None
+            result = mutate(game)
+            try:
+                self.save_game(game)
+            except StaleGameError:
+                if attempt == retries - 1:
+                    raise
+                print(f"Game {game_id} changed during an update; retrying ({attempt + 1}/{retries}).")
+                continue
+            return game, result
+
+    def game_version(self, game_id):
+        """The stored version of the game, or None; a one-row read for conditional requests."""
+        row = self._conn().execute("SELECT version FROM games WHERE id = ?", (game_id,)).fetchone()
+        return row[0] if row else None
+
+    def round_numbers(self, game_id, round_number):
+        """The seats' numbers() bytes as saved with this round, or None."""
+        row = self._conn().execute("SELECT numbers FROM rounds WHERE game_id = ? AND round_number = ?",
+                                   (game_id, round_number)).fetchone()
+        return row[0] if row else None
+
+    def lock(self, game_id):
+        """The game's lock, shared by every thread in this process (held by whoever plays its round)."""
+        with self._locks_guard:
+            lock = self._locks.get(game_id)
+            if lock is None:
+                lock = self._locks[game_id] = threading.Lock()
+            return lock
+
+    def _append_rounds(self, conn, game, start, now):
+        history = game.negotiation_state.get('history', [])
+        if len(history) <= start:
+            return
+        numbers = game.table.numbers().tobytes()
+        for index in range(start, len(history)):
+            round_number = index + 1
+            rendered = self.render_round(round_number, history[index], game.table) if self.render_round else None
+            conn.execute("INSERT INTO rounds (game_id, round_number, rendered, numbers, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (game.id, round_number, rendered, numbers, now))
+            conn.executemany("INSERT INTO statements (game_id, round_number, seq, char_id, text) VALUES (?, ?, ?, ?, ?)",
+                             [(game.id, round_number, seq, char_id, text)
+                              for seq, (char_id, text) in enumerate(history[index].items())])
+
+    def _append_log(self, conn, game):
+        log = game.negotiation_state.get('log')
+        if log:
+            conn.executemany("INSERT INTO round_log (game_id, seq, round_number, kind, data) VALUES (?, ?, ?, ?, ?)",
+                             [(game.id, game._log_persisted + index, entry['round'], entry['kind'],
+                               _dumps({k: v for k, v in entry.items() if k not in ('kind', 'round')}))
+                              for index, entry in enumerate(log)])
+
+    def load_log(self, game_id):
+        """The game's whole round log, oldest entry first, as engine.record() wrote the entries."""
+        return [{'kind': kind, 'round': round_number, **json.loads(data)} for round_number, kind, data in self._conn().execute(
+            "SELECT round_number, kind, data FROM round_log WHERE game_id = ? ORDER BY seq", (game_id,))]
+
+    def usage(self):
+        """
+        (game_id, bytes, last_used, finished) for every stored game, for the
+        reaper (reaper.py). bytes counts the game's row data, without SQLite's
+        page and index overhead.
+        """
+        return self._conn().execute(
+            "SELECT g.id, length(g.numbers) + length(CAST(g.char_state AS BLOB)) + length(CAST(g.extra AS BLOB))"
+            " + COALESCE((SELECT SUM(length(CAST(profile AS BLOB))) FROM characters WHERE game_id = g.id), 0)"
+            " + COALESCE((SELECT SUM(COALESCE(length(CAST(rendered AS BLOB)), 0) + COALESCE(length(numbers), 0))"
+            " FROM rounds WHERE game_id = g.id), 0)"
+            " + COALESCE((SELECT SUM(length(CAST(text AS BLOB))) FROM statements WHERE game_id = g.id), 0)"
+            " + COALESCE((SELECT SUM(length(CAST(data AS BLOB))) FROM round_log WHERE game_id = g.id), 0),"
+            " g.updated_at, g.outcome IS NOT NULL FROM games g").fetchall()
+
+    def evict(self, game_id, last_used):
+        """
+        Deletes the game if it is still as usage() reported it, i.e. unsaved
+        since last_used (a compare-and-set, so a save from any process wins),
+        and this process isn't playing a round of it. Returns whether it was deleted.
+        """
+        lock = self.lock(game_id)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            return self._delete_game(game_id, last_used)
+        finally:
+            lock.release()
+
+    def delete_game(self, game_id):
+        """Removes a game and all its rows."""
+        self._delete_game(game_id)
+
+    def _delete_game(self, game_id, updated_at=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if updated_at is None:
+                deleted = conn.execute("DELETE FROM games WHERE id = ?", (game_id,)).rowcount
+            else:
+                deleted = conn.execute("DELETE FROM games WHERE id = ? AND updated_at = ?", (game_id, updated_at)).rowcount
+            if deleted or updated_at is None:
+                for table in ('round_log', 'statements', 'rounds', 'characters'):
+                    conn.execute(f"DELETE FROM {table} WHERE game_id = ?", (game_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return bool(deleted)
+
+
+class AsyncGameStore:
+    """Awaitable facade over a GameStore; calls run on max_workers store threads."""
+
+    def __init__(self, store, max_workers=4):
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='store')
+        self._locks = weakref.WeakValueDictionary()
+
+    async def _run(self, method, *args, **kwargs):
+        # Run in a copy of the caller's context so metrics spans join its trace
+        call = functools.partial(contextvars.copy_context().run, method, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def create_game(self, table, negotiation_state):
+        return await self._run(self.store.create_game, table, negotiation_state)
+
+    async def load_game(self, game_id, with_history=True):
+        return await self._run(self.store.load_game, game_id, with_history=with_history)
+
+    async def save_game(self, game):
+        await self._run(self.store.save_game, game)
+
+    async def update_game(self, game_id, mutate, with_history=False, retries=UPDATE_RETRIES):
+        """GameStore.update_game; mutate runs on a store thread, so it must not await."""
+        return await self._run(self.store.update_game, game_id, mutate, with_history, retries)
+
+    async def delete_game(self, game_id):
+        await self._run(self.store.delete_game, game_id)
+
+    async def game_version(self, game_id):
+        return await self._run(self.store.game_version, game_id)
+
+    async def round_numbers(self, game_id, round_number):
+        return await self._run(self.store.round_numbers, game_id, round_number)
+
+    def lock(self, game_id):
+        """The game's asyncio.Lock: the event loop's counterpart of GameStore.lock()."""
+        lock = self._locks.get(game_id)
+        if lock is None:
+            lock = self._locks[game_id] = asyncio.Lock()
+        return lock
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,94 @@
+"""
+In-memory BM25 index over a game's dialogue history.
+
+Each statement of each round is one document. The index is built
+incrementally: sync(history) adds only the rounds appended since the last
+call, so a round costs one pass over its own statements. search() ranks
+earlier statements against a query (the player's statement, plus the asking
+NPC's role keywords) with Okapi BM25, and can leave out the recent rounds
+that a prompt already quotes word for word.
+
+    index = HistoryIndex()
+    index.sync(negotiation_state['history'])
+    index.search("affordable rent for students", limit=4, before_round=5)
+    # -> [(score, round_number, char_id, statement), ...]
+
+Pure Python, no external service. The app keeps one index per loaded game in
+negotiation_state['history_index'] (never stored, rebuilt from the history
+when a game is loaded).
+"""
+import math
+import re
+from collections import Counter
+
+BM25_K1 = 1.5 # Term-frequency saturation
+BM25_B = 0.75 # Document-length normalisation
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be because been but by can could did do does for from had has have he
+her here him his how i if in into is it its just let me more most my no not of on or our out over she should so some
+than that the their them then there these they this those to too up us very was we were what when where which who
+why will with would you your
+""".split())
+
+def tokenize(text):
+    """Lower-case content words of a text (stopwords and single letters dropped)."""
+    return [word for word in re.findall(r"[a-z0-9']+", text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+
+class HistoryIndex:
+    """BM25 inverted index of (round_number, char_id, statement) documents."""
+
+    def __init__(self):
+        self.rounds = 0 # History rounds indexed so far
+        self._docs = [] # (round_number, char_id, statement)
+        self._lengths = []
+        self._total_length = 0
+        self._postings = {} # term -> {doc id: term frequency}
+
+    def sync(self, history):
+        """Indexes the rounds of history not seen yet (starting over if the history was replaced)."""
+        if self.rounds > len(history):
+            self.__init__()
+        for round_index in range(self.rounds, len(history)):
+            for char_id, statement in history[round_index].items():
+                self.add(round_index + 1, char_id, statement)
+        self.rounds = len(history)
+        return self
+
+    def add(self, round_number, char_id, statement):
+        doc_id = len(self._docs)
+        terms = tokenize(statement)
+        self._docs.append((round_number, char_id, statement))
+        self._lengths.append(len(terms))
+        self._total_length += len(terms)
+        for term, frequency in Counter(terms).items():
+            self._postings.setdefault(term, {})[doc_id] = frequency
+
+    def __len__(self):
+        return len(self._docs)
+
+    def search(self, query, limit=4, before_round=None, exclude_ids=()):
+        """
+        The limit statements scoring highest for query (only rounds before
+        before_round, and not by exclude_ids), best first, as
+        (score, round_number, char_id, statement). Statements sharing no term
+        with the query are never returned.
+        """
+        if not self._docs:
+            return []
+        doc_count = len(self._docs)
+        average_length = self._total_length / doc_count or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                round_number, char_id, _ = self._docs[doc_id]
+                if (before_round is not None and round_number >= before_round) or char_id in exclude_ids:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(score, *self._docs[doc_id]) for doc_id, score in ranked]
@@ -0,0 +1,355 @@
+"""
+LLM backends used to generate NPC dialogue.
+
+The game only needs "send these chat messages, get text back", so every
+backend implements the same two calls:
+
+    complete(messages, model, max_tokens, temperature, timeout) -> Completion
+    stream(messages, model, max_tokens, temperature, timeout)   -> iterator of text pieces
+
+plus awaitable twins for the async server, acomplete() and astream() (an
+async iterator). Backends without a native async client run the blocking
+call in a worker thread.
+
+Backends:
+    'openai' - the OpenAI API (needs OPENAI_API_KEY)
+    'local'  - any OpenAI-compatible HTTP server (vLLM, llama.cpp, Ollama...) at LLM_BASE_URL
+    'stub'   - in-process, seeded canned dialogue with configurable latency, for
+               offline load testing, profiling and CI (no network, no key)
+
+create_backend() picks one from the environment (LLM_BACKEND, default 'openai'),
+wraps network backends in the rate limiter / retry / circuit breaker of
+llm_guard.py and, if LLM_CACHE is set, in a response cache (see llm_cache.py).
+LazyBackend(create_backend) defers all of that to the first call.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+
+
+class LLMTimeoutError(Exception):
+    """Raised when a backend call exceeds its timeout."""
+
+
+class Completion:
+    """Text returned by a backend plus token usage (None if the backend doesn't report it).
+
+    cached is True when the reply was served from a response cache rather than the provider.
+    """
+    __slots__ = ('text', 'prompt_tokens', 'completion_tokens', 'cached')
+
+    def __init__(self, text, prompt_tokens=None, completion_tokens=None, cached=False):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached = cached
+
+    def __repr__(self):
+        return f"Completion({self.text[:40]!r}..., prompt_tokens={self.prompt_tokens}, completion_tokens={self.completion_tokens})"
+
+
+class LLMBackend:
+    """Interface shared by all backends."""
+    name = 'base'
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        raise NotImplementedError
+
+    def stream(self, messages, model, max_tokens, temperature, timeout=None):
+        # Backends without native streaming deliver the whole reply as one piece
+        yield self.complete(messages, model, max_tokens, temperature, timeout).text
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None):
+        # Backends without a native async client block a worker thread instead of the event loop
+        return await asyncio.to_thread(self.complete, messages, model, max_tokens, temperature, timeout)
+
+    async def astream(self, messages, model, max_tokens, temperature, timeout=None):
+        yield (await self.acomplete(messages, model, max_tokens, temperature, timeout)).text
+
+
+# --- OpenAI & OpenAI-compatible servers --- #
+
+class OpenAIBackend(LLMBackend):
+    """The OpenAI chat completions API."""
+    name = 'openai'
+
+    def __init__(self, api_key=None, base_url=None, max_retries=2):
+        if not api_key:
+            raise ValueError("ERROR: OPENAI_API_KEY environment variable not set. Please set it in your environment or in a .env file.")
+        from openai import OpenAI # Imported lazily so the stub backend works without the package configured
+        # max_retries is the client's own retry count; 0 when GuardedBackend (llm_guard.py) does the retrying
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries)
+        self._client_args = {'api_key': api_key, 'base_url': base_url, 'max_retries': max_retries}
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        """AsyncOpenAI client, created on first use (inside the running event loop)."""
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(**self._client_args)
+        return self._async_client
+
+    @staticmethod
+    def _completion(completion):
+        usage = getattr(completion, 'usage', None)
+        return Completion(
+            (completion.choices[0].message.content or '').strip(),
+            getattr(usage, 'prompt_tokens', None),
+            getattr(usage, 'completion_tokens', None)
+        )
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        return self._completion(self.client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, timeout=timeout
+        ))
+
+    def stream(self, messages, model, max_tokens, temperature, timeout=None):
+        for chunk in self.client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, timeout=timeout, stream=True
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None):
+        return self._completion(await self.async_client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, timeout=timeout
+        ))
+
+    async def astream(self, messages, model, max_tokens, temperature, timeout=None):
+        async for chunk in await self.async_client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, timeout=timeout, stream=True
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class LocalOpenAIBackend(OpenAIBackend):
+    """An OpenAI-compatible server (vLLM, llama.cpp server, Ollama, LM Studio...)."""
+    name = 'local'
+
+    def __init__(self, base_url='http://localhost:8000/v1', api_key=None, max_retries=2):
+        # Local servers usually ignore the key, but the client insists on having one
+        super().__init__(api_key=api_key or 'not-needed', base_url=base_url, max_retries=max_retries)
+
+
+# --- Offline stub --- #
+
+STUB_LINES = {
+    'support': [
+        "This proposal moves us forward, and I'm glad to see it taking shape.",
+        "I can support this if we keep the timeline realistic.",
+        "The benefits here outweigh the costs, in my view.",
+        "Let's not lose momentum; this is a reasonable plan.",
+    ],
+    'neutral': [
+        "I need more detail before I can commit either way.",
+        "There are good points on both sides, and I'm still weighing them.",
+        "What guarantees do we have that these promises will be kept?",
+        "I'd like to hear from the residents before deciding.",
+    ],
+    'oppose': [
+        "I'm not convinced this serves the people who actually live here.",
+        "The disruption this would cause is being badly underestimated.",
+        "We've heard these promises before, and they rarely hold.",
+        "I can't support this plan in its current form.",
+    ],
+}
+_STANCE_PATTERN = re.compile(r'\((Support|Neutral|Oppose)\)')
+_BATCH_ID_PATTERN = re.compile(r'id: (\S+) \|')
+
+
+class StubBackend(LLMBackend):
+    """
+    Deterministic in-process backend. Replies are chosen from STUB_LINES by a
+    RNG seeded with (seed, prompt), so the same prompt always gets the same
+    reply regardless of call order or concurrency. Every reply ends with a
+    'SCORE_CHANGE: +/-n' line, or is a JSON array when the prompt asks for the
+    batched table format. latency (+ uniform jitter) seconds are slept per call
+    to model provider round-trips.
+    """
+    name = 'stub'
+
+    def __init__(self, seed=0, latency=0.0, jitter=0.0, score_range=(-5, 5)):
+        self.seed = seed
+        self.latency = latency
+        self.jitter = jitter
+        self.score_range = score_range
+
+    def _rng(self, messages):
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+        return random.Random(f"{self.seed}:{digest}")
+
+    def _delay_for(self, rng, timeout):
+        """(seconds to wait, whether the call times out)."""
+        delay = self.latency + (rng.uniform(0, self.jitter) if self.jitter else 0)
+        if timeout is not None and delay > timeout:
+            return timeout, True
+        return delay, False
+
+    def _delay(self, rng, timeout):
+        delay, timed_out = self._delay_for(rng, timeout)
+        if delay > 0:
+            time.sleep(delay)
+        if timed_out:
+            raise LLMTimeoutError(f"Stub call exceeded timeout of {timeout}s")
+
+    async def _adelay(self, rng, timeout):
+        delay, timed_out = self._delay_for(rng, timeout)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if timed_out:
+            raise LLMTimeoutError(f"Stub call exceeded timeout of {timeout}s")
+
+    def _line(self, rng, prompt_text):
+        match = _STANCE_PATTERN.search(prompt_text)
+        stance = match.group(1).lower() if match else 'neutral'
+        return rng.choice(STUB_LINES[stance])
+
+    def _reply(self, rng, messages):
+        system_text = messages[0]['content'] if messages else ''
+        user_text = messages[-1]['content'] if messages else ''
+        if 'JSON array' in system_text:
+            # Batched table format: one entry per participant id listed in the prompt
+            entries = []
+            for line in user_text.splitlines():
+                match = _BATCH_ID_PATTERN.search(line)
+                if match:
+                    entries.append({'id': match.group(1), 'dialogue': self._line(rng, line),
+                                    'score_change': rng.randint(*self.score_range)})
+            return json.dumps(entries)
+        if 'SCORE_CHANGE' not in system_text:
+            # Free-form request (e.g. a history summary)
+            return self._line(rng, user_text)
+        return f"{self._line(rng, user_text)}\nSCORE_CHANGE: {rng.randint(*self.score_range):+d}"
+
+    def _completion(self, rng, messages):
+        text = self._reply(rng, messages)
+        prompt_tokens = sum(len(m['content']) for m in messages) // 4 + 1
+        return Completion(text, prompt_tokens, len(text) // 4 + 1)
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        rng = self._rng(messages)
+        self._delay(rng, timeout)
+        return self._completion(rng, messages)
+
+    def stream(self, messages, model, max_tokens, temperature, timeout=None):
+        rng = self._rng(messages)
+        self._delay(rng, timeout)
+        text = self._reply(rng, messages)
+        for i in range(0, len(text), 8):
+            yield text[i:i + 8]
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None):
+        rng = self._rng(messages)
+        await self._adelay(rng, timeout)
+        return self._completion(rng, messages)
+
+    async def astream(self, messages, model, max_tokens, temperature, timeout=None):
+        rng = self._rng(messages)
+        await self._adelay(rng, timeout)
+        text = self._reply(rng, messages)
+        for i in range(0, len(text), 8):
+            yield text[i:i + 8]
+
+
+# --- Lazy construction --- #
+
+class LazyBackend(LLMBackend):
+    """
+    Stands in for the backend factory() returns, building it on the first call.
+    Lets a server import the app (and fork workers, e.g. gunicorn --preload)
+    without creating API clients or failing on a missing key until a call is made.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._backend = None
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = self.factory()
+        return self._backend
+
+    def __getattr__(self, attr): # name, stats(), ... of the real backend
+        return getattr(self.backend, attr)
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        return self.backend.complete(messages, model, max_tokens, temperature, timeout)
+
+    def stream(self, messages, model, max_tokens, temperature, timeout=None):
+        return self.backend.stream(messages, model, max_tokens, temperature, timeout)
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None):
+        return await self.backend.acomplete(messages, model, max_tokens, temperature, timeout)
+
+    def astream(self, messages, model, max_tokens, temperature, timeout=None):
+        return self.backend.astream(messages, model, max_tokens, temperature, timeout)
+
+
+def _env_flag(name, default='0'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+def create_backend(name=None):
+    """
+    Builds the backend named by `name` or the LLM_BACKEND environment variable.
+
+    openai: OPENAI_API_KEY
+    local:  LLM_BASE_URL (default http://localhost:8000/v1), LLM_API_KEY (optional)
+    stub:   STUB_SEED (default 0), STUB_LATENCY_MS (default 0), STUB_JITTER_MS (default 0)
+
+    Rate limiting, retries and circuit breaker (openai/local, on unless LLM_GUARD=0; see
+    llm_guard.py): LLM_RPM (default 500), LLM_TPM (default 200000), LLM_MAX_CONCURRENCY
+    (default 32), LLM_TARGET_LATENCY_MS (default 8000).
+
+    Response cache (off unless LLM_CACHE=1): LLM_CACHE_SIZE (entries, default 1024),
+    LLM_CACHE_PATH (SQLite file, default in-memory only), LLM_CACHE_TTL (seconds),
+    LLM_CACHE_SAMPLED=1 to also cache temperature > 0 calls.
+    """
+    name = (name or os.environ.get('LLM_BACKEND') or 'openai').lower()
+    guarded = name in ('openai', 'local') and _env_flag('LLM_GUARD', '1')
+    max_retries = 0 if guarded else 2
+    if name == 'openai':
+        backend = OpenAIBackend(api_key=os.environ.get('OPENAI_API_KEY'), max_retries=max_retries)
+    elif name == 'local':
+        backend = LocalOpenAIBackend(base_url=os.environ.get('LLM_BASE_URL', 'http://localhost:8000/v1'),
+                                     api_key=os.environ.get('LLM_API_KEY'), max_retries=max_retries)
+    elif name == 'stub':
+        backend = StubBackend(
+            seed=int(os.environ.get('STUB_SEED', 0)),
+            latency=float(os.environ.get('STUB_LATENCY_MS', 0)) / 1000,
+            jitter=float(os.environ.get('STUB_JITTER_MS', 0)) / 1000
+        )
+    else:
+        raise ValueError(f"Unknown LLM_BACKEND '{name}'. Use 'openai', 'local' or 'stub'.")
+
+    if guarded:
+        from llm_guard import GuardedBackend # Imported here: llm_guard builds on this module
+        backend = GuardedBackend(
+            backend,
+            rpm=float(os.environ.get('LLM_RPM', 500)),
+            tpm=float(os.environ.get('LLM_TPM', 200000)),
+            max_concurrency=int(os.environ.get('LLM_MAX_CONCURRENCY', 32)),
+            target_latency=float(os.environ.get('LLM_TARGET_LATENCY_MS', 8000)) / 1000
+        )
+
+    if _env_flag('LLM_CACHE'): # Outside the guard: cache hits don't use quota
+        from llm_cache import CachedBackend # Imported here: llm_cache builds on this module
+        ttl = os.environ.get('LLM_CACHE_TTL')
+        backend = CachedBackend(
+            backend,
+            max_entries=int(os.environ.get('LLM_CACHE_SIZE', 1024)),
+            path=os.environ.get('LLM_CACHE_PATH') or None,
+            ttl=float(ttl) if ttl else None,
+            cache_sampled=_env_flag('LLM_CACHE_SAMPLED')
+        )
+    return backend
@@ -0,0 +1,230 @@
+"""
+Content-addressed cache for LLM completions.
+
+CachedBackend wraps any LLMBackend. Calls are keyed on a SHA-256 of
+(model, messages, temperature, max_tokens); hits are served from a bounded
+in-memory LRU, then from an optional SQLite file with a TTL, and never touch
+the wrapped backend. Replays, QA runs and scripted openings repeat prompts
+exactly, so they are the main beneficiaries.
+
+By default calls with temperature > 0 bypass the cache: in normal play a
+sampled reply is expected to vary. Set cache_sampled=True (LLM_CACHE_SAMPLED=1)
+to cache those too, e.g. for QA and replay runs.
+
+The async calls read and write the SQLite file on a worker thread, so a disk
+lookup never blocks the event loop; memory hits are served inline.
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from llm_backends import Completion, LLMBackend
+
+
+def cache_key(model, messages, temperature, max_tokens):
+    """Stable content hash of everything that determines a completion."""
+    payload = json.dumps(
+        {'model': model, 'messages': messages, 'temperature': temperature, 'max_tokens': max_tokens},
+        sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _DiskStore:
+    """SQLite-backed key/value store for completions, with a TTL (seconds, None = forever)."""
+
+    PURGE_EVERY = 256 # Writes between expired-row sweeps
+
+    def __init__(self, path, ttl=None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, text TEXT NOT NULL, prompt_tokens INTEGER,"
+            " completion_tokens INTEGER, created_at REAL NOT NULL)"
+        )
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, prompt_tokens, completion_tokens, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and row[3] + self.ttl < time.time():
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            return Completion(row[0], row[1], row[2])
+
+    def put(self, key, completion):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, text, prompt_tokens, completion_tokens, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, completion.text, completion.prompt_tokens, completion.completion_tokens, time.time())
+            )
+            self._writes += 1
+            if self.ttl is not None and self._writes % self.PURGE_EVERY == 0:
+                self._conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - self.ttl,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedBackend(LLMBackend):
+    """LLM backend wrapper serving repeated prompts from an LRU (and optional SQLite) cache."""
+
+    def __init__(self, backend, max_entries=1024, path=None, ttl=None, cache_sampled=False):
+        self.backend = backend
+        self.name = f"cached:{backend.name}"
+        self.max_entries = max_entries
+        self.cache_sampled = cache_sampled
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = _DiskStore(path, ttl) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def _cacheable(self, temperature):
+        return self.cache_sampled or not temperature
+
+    def _lookup(self, key):
+        return self._memory_lookup(key) or self._disk_lookup(key)
+
+    async def _alookup(self, key):
+        completion = self._memory_lookup(key)
+        if completion is None and self._disk:
+            return await asyncio.to_thread(self._disk_lookup, key)
+        return completion or self._disk_lookup(key)
+
+    def _memory_lookup(self, key):
+        with self._lock:
+            completion = self._memory.get(key)
+            if completion is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+            return completion
+
+    def _disk_lookup(self, key):
+        """The disk tier's entry (kept in memory from now on), counting the miss if there is none."""
+        completion = self._disk.get(key) if self._disk else None
+        with self._lock:
+            if completion is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._remember(key, completion)
+        return completion
+
+    def _remember(self, key, completion):
+        with self._lock:
+            self._memory[key] = completion
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+                self.evictions += 1
+
+    def _store(self, key, completion):
+        self._remember(key, completion)
+        if self._disk:
+            self._disk.put(key, completion)
+
+    async def _astore(self, key, completion):
+        self._remember(key, completion)
+        if self._disk:
+            await asyncio.to_thread(self._disk.put, key, completion)
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        if not self._cacheable(temperature):
+            with self._lock:
+                self.bypassed += 1
+            return self.backend.complete(messages, model, max_tokens, temperature, timeout)
+
+        key = cache_key(model, messages, temperature, max_tokens)
+        cached = self._lookup(key)
+        if cached is not None:
+            return Completion(cached.text, cached.prompt_tokens, cached.completion_tokens, cached=True)
+        completion = self.backend.complete(messages, model, max_tokens, temperature, timeout)
+        self._store(key, completion)
+        return completion
+
+    def stream(self, messages, model, max_tokens, temperature, timeout=None):
+        if not self._cacheable(temperature):
+            with self._lock:
+                self.bypassed += 1
+            yield from self.backend.stream(messages, model, max_tokens, temperature, timeout)
+            return
+
+        key = cache_key(model, messages, temperature, max_tokens)
+        cached = self._lookup(key)
+        if cached is not None:
+            yield cached.text
+            return
+        pieces = []
+        for piece in self.backend.stream(messages, model, max_tokens, temperature, timeout):
+            pieces.append(piece)
+            yield piece
+        # Only complete streams are cached; usage isn't reported for streamed replies
+        self._store(key, Completion(''.join(pieces)))
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None):
+        if not self._cacheable(temperature):
+            with self._lock:
+                self.bypassed += 1
+            return await self.backend.acomplete(messages, model, max_tokens, temperature, timeout)
+
+        key = cache_key(model, messages, temperature, max_tokens)
+        cached = await self._alookup(key)
+        if cached is not None:
+            return Completion(cached.text, cached.prompt_tokens, cached.completion_tokens, cached=True)
+        completion = await self.backend.acomplete(messages, model, max_tokens, temperature, timeout)
+        await self._astore(key, completion)
+        return completion
+
+    async def astream(self, messages, model, max_tokens, temperature, timeout=None):
+        if not self._cacheable(temperature):
+            with self._lock:
+                self.bypassed += 1
+            async for piece in self.backend.astream(messages, model, max_tokens, temperature, timeout):
+                yield piece
+            return
+
+        key = cache_key(model, messages, temperature, max_tokens)
+        cached = await self._alookup(key)
+        if cached is not None:
+            yield cached.text
+            return
+        pieces = []
+        async for piece in self.backend.astream(messages, model, max_tokens, temperature, timeout):
+            pieces.append(piece)
+            yield piece
+        await self._astore(key, Completion(''.join(pieces)))
+
+    def stats(self):
+        """Counters for monitoring: hits (memory + disk), disk_hits, misses, bypassed, evictions, entries."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'evictions': self.evictions,
+                'entries': len(self._memory),
+            }
+
+    def clear(self):
+        """Drops the in-memory entries (the disk store is left alone)."""
+        with self._lock:
+            self._memory.clear()
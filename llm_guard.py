@@ -0,0 +1,455 @@
+"""
+Rate limiting, retries and a circuit breaker for LLM calls.
+
+GuardedBackend wraps any LLMBackend, and app.py keeps one for the whole
+process, so every game shares the provider quota. Each call goes through
+these steps in order:
+
+1. Quota. Token buckets sized to the provider's requests-per-minute and
+   tokens-per-minute quota (rpm, tpm) hold the call until it fits. The token
+   cost is estimated from the prompt length plus max_tokens.
+2. Concurrency. An AIMD limit caps the calls in flight. It grows by one per
+   "window" of calls that come back within target_latency. It halves on a
+   throttle (HTTP 429) or a slow reply, at most once per DECREASE_INTERVAL.
+3. Retry. Rate limits (429), server errors (5xx) and connection errors are
+   retried with jittered exponential backoff, or after the provider's
+   Retry-After. Retries stay within the call's timeout.
+4. Circuit breaker. After FAILURE_THRESHOLD calls in a row fail even after
+   their retries, the circuit opens for COOLDOWN_SECONDS. While it is open,
+   NPC calls get a degraded reply from the local stub backend: an in-character
+   line that doesn't move stances (SCORE_CHANGE +0). Other calls, e.g. the
+   history summary, fail fast so their callers' own fallbacks apply. After
+   the cooldown, one probe call decides whether the circuit closes again.
+
+Streams are retried only before their first piece arrives. A stream keeps
+its concurrency slot until it is exhausted or closed, and its outcome (and
+latency, for the limit) is recorded then, so a failure mid-stream counts
+against the circuit like any other. A cancelled async call or stream frees its
+slot without recording an outcome.
+
+create_backend() (llm_backends.py) adds this wrapper for the openai and local
+backends unless LLM_GUARD=0. The limits come from LLM_RPM, LLM_TPM,
+LLM_MAX_CONCURRENCY and LLM_TARGET_LATENCY_MS. To try it against a local fake
+server that injects 429s:
+
+    python -m benchmarks.llm_throttle
+"""
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+import metrics
+from llm_backends import Completion, LLMBackend, LLMTimeoutError, StubBackend
+
+MAX_RETRIES = 3 # Retries per call after the first attempt
+BASE_DELAY = 0.5 # Seconds; backoff before retry n is uniform(0, BASE_DELAY * 2**n), capped at MAX_DELAY
+MAX_DELAY = 20
+FAILURE_THRESHOLD = 5 # Consecutive failed calls that open the circuit
+COOLDOWN_SECONDS = 30 # Time the circuit stays open before a probe call
+BURST_SECONDS = 1 # Bucket capacity in seconds of quota: providers enforce per-minute quotas in short slices
+DECREASE_INTERVAL = 1.0 # Seconds between multiplicative decreases, so one burst of 429s halves the limit once
+MIN_CONCURRENCY = 1
+ACQUIRE_POLL = 0.02 # Seconds between slot checks for async callers
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while the circuit breaker is open."""
+
+
+# --- Error Classification --- #
+
+def _status_code(error):
+    return getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+
+def retry_reason(error):
+    """Why a failed call is worth retrying ('rate_limit', 'server_error', 'connection'), or None if it isn't."""
+    status = _status_code(error)
+    if status == 429:
+        return 'rate_limit'
+    if status is not None and status >= 500:
+        return 'server_error'
+    if isinstance(error, ConnectionError) or type(error).__name__ == 'APIConnectionError':
+        return 'connection'
+    return None
+
+def is_provider_failure(error):
+    """Whether the error counts against the circuit breaker (retryable errors and timeouts, not bad requests)."""
+    return retry_reason(error) is not None or isinstance(error, (LLMTimeoutError, TimeoutError)) \
+        or type(error).__name__ == 'APITimeoutError'
+
+def _overloaded(error):
+    """Whether the error says the provider is overloaded (throttled or too slow), so concurrency should back off."""
+    return retry_reason(error) == 'rate_limit' or isinstance(error, (LLMTimeoutError, TimeoutError)) \
+        or type(error).__name__ == 'APITimeoutError'
+
+def retry_after(error):
+    """Seconds the provider asked us to wait (Retry-After / retry-after-ms headers), or None."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or getattr(error, 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError: # An HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, error, rng=random):
+    """Wait before retry number attempt (0-based): Retry-After if given, else full-jitter exponential backoff."""
+    requested = retry_after(error)
+    if requested is not None:
+        return min(MAX_DELAY, requested) + rng.uniform(0, BASE_DELAY) # Jitter so waiters don't return together
+    return rng.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+def estimate_tokens(messages, max_tokens):
+    """Tokens a call counts against the TPM quota: ~4 characters per prompt token plus the completion budget."""
+    return sum(len(message['content']) for message in messages) // 4 + (max_tokens or 0)
+
+# --- Limiters --- #
+
+class TokenBucket:
+    """
+    Rate limiter: rate units per second, up to capacity saved up. reserve()
+    takes the units at once and returns how long the caller must wait for
+    them, so waiting callers are served in order without polling.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        amount = min(amount, self.capacity) # A call bigger than the bucket waits for a full bucket
+        with self._lock:
+            now = time.monotonic()
+            self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+            self._updated = now
+            self._level -= amount
+            return 0.0 if self._level >= 0 else -self._level / self.rate
+
+
+class AIMDLimiter:
+    """
+    Adaptive cap on calls in flight. The limit grows additively by one per
+    limit's worth of fast successes. It shrinks multiplicatively on a throttle
+    or a reply slower than target_latency, at most once per DECREASE_INTERVAL.
+    """
+
+    def __init__(self, max_limit, target_latency, min_limit=MIN_CONCURRENCY):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.target_latency = target_latency
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        metrics.LLM_CONCURRENCY_LIMIT.set(max_limit)
+
+    def try_acquire(self):
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def aacquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(ACQUIRE_POLL)
+
+    def release(self, latency=None, throttled=False):
+        """Frees the slot and adapts the limit: latency of a finished call, or throttled for a 429 or timeout."""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled or (latency is not None and latency > self.target_latency):
+                if now - self._last_decrease >= DECREASE_INTERVAL:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            elif latency is not None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            metrics.LLM_CONCURRENCY_LIMIT.set(int(self.limit))
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """closed -> open after failure_threshold failures in a row -> half_open (one probe) after cooldown."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"LLM circuit breaker: {self.state} -> {state}")
+            self.state = state
+            metrics.LLM_CIRCUIT_CHANGES.labels(state).inc()
+
+    def allow(self):
+        """Whether a call may go to the provider now: True, False, or 'probe' for the half-open probe call."""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+                self._set_state('half_open')
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True # The one probe call
+                return 'probe'
+            return self.state == 'closed'
+
+    def end_probe(self):
+        """Lets another call probe after a probe that ended without an outcome (e.g. it never reached the provider)."""
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state('closed')
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state('open')
+
+# --- Guarded Backend --- #
+
+class GuardedBackend(LLMBackend):
+    """Wraps a backend with the quota, concurrency, retry and circuit-breaker policy described above."""
+
+    def __init__(self, backend, rpm=500, tpm=200000, max_concurrency=32, target_latency=8.0,
+                 breaker=None, fallback=None, rng=None):
+        self.backend = backend
+        self.name = f"guarded:{backend.name}"
+        self.requests = TokenBucket(rpm / 60, max(1, rpm / 60 * BURST_SECONDS))
+        self.tokens = TokenBucket(tpm / 60, max(1, tpm / 60 * BURST_SECONDS))
+        self.concurrency = AIMDLimiter(max_concurrency, target_latency)
+        self.breaker = breaker or CircuitBreaker()
+        self.fallback = fallback or StubBackend(score_range=(0, 0)) # Degraded replies don't move stances
+        self._rng = rng or random.Random()
+
+    def _quota_wait(self, messages, max_tokens):
+        wait = max(self.requests.reserve(1), self.tokens.reserve(estimate_tokens(messages, max_tokens)))
+        if wait > 0:
+            metrics.LLM_THROTTLES.labels('quota').inc()
+        return wait
+
+    def _degraded(self, messages, model, max_tokens, temperature, error=None):
+        """The stub's reply for NPC prompts while the circuit is open; other calls raise error (fail fast)."""
+        system_text = messages[0]['content'] if messages else ''
+        if 'SCORE_CHANGE' not in system_text and 'JSON array' not in system_text:
+            raise error or CircuitOpenError("LLM provider unavailable (circuit open).")
+        metrics.LLM_DEGRADED.inc()
+        return Completion(self.fallback.complete(messages, model, max_tokens, temperature).text)
+
+    def _remaining(self, deadline):
+        return None if deadline is None else deadline - time.monotonic()
+
+    def _after_failure(self, error, attempt, deadline):
+        """Seconds to wait before retrying error, or None to give up (and let the caller raise it)."""
+        reason = retry_reason(error)
+        if reason is None or attempt >= MAX_RETRIES or self.breaker.state == 'open':
+            return None
+        delay = backoff_delay(attempt, error, self._rng)
+        remaining = self._remaining(deadline)
+        if remaining is not None and delay >= remaining:
+            return None # No time left in this call's budget
+        if reason == 'rate_limit':
+            metrics.LLM_THROTTLES.labels('provider').inc()
+        metrics.LLM_RETRIES.labels(reason).inc()
+        return delay
+
+    def _settle(self, called, error=None):
+        """Frees a call's concurrency slot and records its outcome: its latency, or the error it failed with."""
+        if error is None:
+            self.concurrency.release(latency=time.monotonic() - called)
+            self.breaker.record_success()
+            return
+        self.concurrency.release(throttled=_overloaded(error))
+        if is_provider_failure(error):
+            self.breaker.record_failure()
+        else: # The provider answered (e.g. a 400 for a bad request), so it is up
+            self.breaker.record_success()
+
+    def _call(self, attempt_call, messages, model, max_tokens, temperature, timeout, hold=False):
+        """
+        Runs attempt_call(remaining seconds) under the policy. With hold, a
+        success returns (result, called) and keeps the concurrency slot: the
+        caller _settle()s it once it is done with the result (a stream).
+        """
+        allowed = self.breaker.allow()
+        if not allowed:
+            return self._degraded(messages, model, max_tokens, temperature)
+        held = False
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            started = time.monotonic()
+            time.sleep(self._quota_wait(messages, max_tokens))
+            self.concurrency.acquire()
+            metrics.LLM_QUOTA_WAIT_SECONDS.observe(time.monotonic() - started)
+            attempt = 0
+            while True:
+                called = time.monotonic()
+                remaining = self._remaining(deadline)
+                if remaining is not None and remaining <= 0:
+                    # Spent waiting for quota here: not the provider's failure
+                    self.concurrency.release()
+                    raise LLMTimeoutError(f"LLM call exceeded timeout of {timeout}s waiting for quota")
+                try:
+                    result = attempt_call(remaining)
+                except Exception as e:
+                    delay = self._after_failure(e, attempt, deadline)
+                    if delay is None:
+                        self._settle(called, e)
+                        if is_provider_failure(e) and self.breaker.state == 'open':
+                            # This failure, or another call's, opened the circuit
+                            return self._degraded(messages, model, max_tokens, temperature, e)
+                        raise
+                    self.concurrency.release(throttled=_overloaded(e))
+                    time.sleep(delay)
+                    attempt += 1
+                    self.concurrency.acquire()
+                    continue
+                if hold:
+                    held = True
+                    return result, called
+                self._settle(called)
+                return result
+        finally:
+            if allowed == 'probe' and not held:
+                self.breaker.end_probe() # A no-op once the probe recorded an outcome
+
+    async def _acall(self, attempt_call, messages, model, max_tokens, temperature, timeout, hold=False):
+        allowed = self.breaker.allow()
+        if not allowed:
+            return self._degraded(messages, model, max_tokens, temperature)
+        held = False
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            started = time.monotonic()
+            await asyncio.sleep(self._quota_wait(messages, max_tokens))
+            await self.concurrency.aacquire()
+            metrics.LLM_QUOTA_WAIT_SECONDS.observe(time.monotonic() - started)
+            attempt = 0
+            while True:
+                called = time.monotonic()
+                remaining = self._remaining(deadline)
+                if remaining is not None and remaining <= 0:
+                    # Spent waiting for quota here: not the provider's failure
+                    self.concurrency.release()
+                    raise LLMTimeoutError(f"LLM call exceeded timeout of {timeout}s waiting for quota")
+                try:
+                    result = await attempt_call(remaining)
+                except asyncio.CancelledError:
+                    self.concurrency.release() # The caller gave up on it (e.g. a round deadline): no outcome to record
+                    raise
+                except Exception as e:
+                    delay = self._after_failure(e, attempt, deadline)
+                    if delay is None:
+                        self._settle(called, e)
+                        if is_provider_failure(e) and self.breaker.state == 'open':
+                            # This failure, or another call's, opened the circuit
+                            return self._degraded(messages, model, max_tokens, temperature, e)
+                        raise
+                    self.concurrency.release(throttled=_overloaded(e))
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    await self.concurrency.aacquire()
+                    continue
+                if hold:
+                    held = True
+                    return result, called
+                self._settle(called)
+                return result
+        finally:
+            if allowed == 'probe' and not held:
+                self.breaker.end_probe()
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        return self._call(lambda remaining: self.backend.complete(messages, model, max_tokens, temperature, remaining),
+                          messages, model, max_tokens, temperature, timeout)
+
+    def stream(self, messages, model, max_tokens, temperature, timeout=None):
+        def first_piece(remaining):
+            pieces = iter(self.backend.stream(messages, model, max_tokens, temperature, remaining))
+            return next(pieces, ''), pieces
+        result = self._call(first_piece, messages, model, max_tokens, temperature, timeout, hold=True)
+        if isinstance(result, Completion): # Degraded: the whole reply at once
+            yield result.text
+            return
+        (first, pieces), called = result
+        error = None
+        try: # The slot is held until the stream is exhausted, fails or is closed (GeneratorExit: not a failure)
+            if first:
+                yield first
+            yield from pieces
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._settle(called, error)
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None):
+        return await self._acall(
+            lambda remaining: self.backend.acomplete(messages, model, max_tokens, temperature, remaining),
+            messages, model, max_tokens, temperature, timeout)
+
+    async def astream(self, messages, model, max_tokens, temperature, timeout=None):
+        async def first_piece(remaining):
+            pieces = self.backend.astream(messages, model, max_tokens, temperature, remaining).__aiter__()
+            try:
+                return await pieces.__anext__(), pieces
+            except StopAsyncIteration:
+                return '', None
+        result = await self._acall(first_piece, messages, model, max_tokens, temperature, timeout, hold=True)
+        if isinstance(result, Completion):
+            yield result.text
+            return
+        (first, pieces), called = result
+        error = cancelled = None
+        try:
+            if first:
+                yield first
+            if pieces is not None:
+                async for piece in pieces:
+                    yield piece
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if cancelled:
+                self.concurrency.release()
+            else:
+                self._settle(called, error)
+
+    def stats(self):
+        """Current limiter and breaker state, for logging."""
+        return {'concurrency_limit': int(self.concurrency.limit), 'in_flight': self.concurrency.in_flight,
+                'circuit': self.breaker.state, 'consecutive_failures': self.breaker.failures}
@@ -0,0 +1,327 @@
+"""
+Process-local metrics in the Prometheus text format, plus optional trace spans.
+
+Counters, gauges and histograms are module-level objects, optionally labelled:
+
+    LLM_ERRORS.labels('npc').inc()
+    with GAME_STORE_SECONDS.labels('save').time():
+        ...
+
+REGISTRY.render() produces the text served at /metrics. Values live in this
+process only; with several server processes each one exposes its own.
+
+Tracing: start_trace(name) begins a trace for the current context, and every
+span(name) entered while it is active (in this thread, or in threads started
+with contextvars.copy_context().run) is recorded with its parent, start
+offset and duration. finish_trace() returns the Trace; format() renders the
+span tree for the log and server_timing() a Server-Timing header. Outside a
+trace, span() only costs a context-variable lookup.
+"""
+import contextvars
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # Seconds
+
+# --- Metric Types --- #
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        """The child series for these label values (in labelnames order)."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} has labels {self.labelnames}; use .labels(...)")
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.samples(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters only go up.")
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, values):
+        return [f"{name}_total{_format_labels(labelnames, values)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    """Monotonic count. The exposed series gets a _total suffix."""
+    kind = 'counter'
+    _new_child = _CounterChild
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labelnames, values):
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    """Current value that can go up and down."""
+    kind = 'gauge'
+    _new_child = _GaugeChild
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """Observes the duration of the with-block, in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self, name, labelnames, values):
+        with self._lock:
+            counts, total = list(itertools.accumulate(self.counts)), self.sum
+        lines = [f"{name}_bucket{_format_labels(labelnames, values, [('le', _format_value(bound))])} {count}"
+                 for bound, count in zip(self.buckets, counts)]
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {counts[-1]}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets (a +Inf bucket is always added)."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Registry:
+    """The set of metrics rendered together at /metrics."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric '{metric.name}' is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# --- Game Metrics --- #
+
+ROUND_SECONDS = Histogram('negotiation_round_seconds', "Time to play one negotiation round, events and NPC replies included.",
+                          ['engine'])
+LLM_NPC_SECONDS = Histogram('llm_npc_response_seconds', "LLM call latency for one NPC's reply (per_npc) or the whole table (batched).",
+                            ['engine'])
+LLM_SUMMARY_SECONDS = Histogram('llm_summary_seconds', "LLM call latency for the rolling history summary.")
+GAME_STORE_SECONDS = Histogram('game_store_seconds', "Game-state load/save time.", ['op'],
+                               buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+GAME_STORE_CONFLICTS = Counter('game_store_conflicts', "Saves rejected because the game changed since it was loaded.")
+LLM_ERRORS = Counter('llm_errors', "LLM calls that failed or timed out.", ['kind'])
+SCORE_PARSE_FAILURES = Counter('score_change_parse_failures', "NPC replies whose SCORE_CHANGE could not be parsed.", ['reason'])
+EVENTS_FIRED = Counter('micro_events_fired', "Micro-events triggered, by event id.", ['event_id'])
+LLM_TOKENS = Counter('llm_tokens', "Tokens reported in completion usage (cache hits excluded).", ['kind', 'type'])
+ROUND_JOBS = Counter('round_jobs', "Round jobs by outcome: queued, retried, done, failed.", ['status'])
+ROUND_JOB_WAIT_SECONDS = Histogram('round_job_wait_seconds', "Time a round job waited in the queue before its first claim.")
+NPC_CALLS_SAVED = Histogram('npc_calls_saved_per_round', "AI characters per round left to listen by the turn scheduler (LLM calls saved).",
+                            buckets=(0, 1, 2, 3, 4, 5, 6, 7, 8, 9))
+LLM_THROTTLES = Counter('llm_throttles', "LLM calls held back: provider rate limits (HTTP 429) and local quota waits.", ['source'])
+LLM_RETRIES = Counter('llm_retries', "LLM call attempts retried, by reason.", ['reason'])
+LLM_DEGRADED = Counter('llm_degraded_responses', "Replies served by the local stub while the LLM circuit breaker was open.")
+LLM_CIRCUIT_CHANGES = Counter('llm_circuit_changes', "LLM circuit breaker state changes, by new state.", ['state'])
+LLM_CONCURRENCY_LIMIT = Gauge('llm_concurrency_limit', "Current adaptive limit on simultaneous LLM calls.")
+LLM_QUOTA_WAIT_SECONDS = Histogram('llm_quota_wait_seconds', "Time LLM calls waited for the request/token quota or a concurrency slot.")
+STORAGE_LIVE = Gauge('storage_live_entries', "Games or session files kept by the last reaper sweep, by store.", ['store'])
+STORAGE_BYTES = Gauge('storage_bytes', "Bytes held by the live entries at the last reaper sweep, by store.", ['store'])
+STORAGE_EVICTIONS = Counter('storage_evictions', "Entries evicted by the reaper, by store and reason (finished, idle, size).",
+                            ['store', 'reason'])
+STORAGE_SWEEP_SECONDS = Histogram('storage_sweep_seconds', "Time one reaper sweep took.")
+
+def record_usage(completion, kind):
+    """Adds a Completion's reported prompt/completion tokens to LLM_TOKENS (skips cache hits and missing usage)."""
+    if getattr(completion, 'cached', False):
+        return
+    if completion.prompt_tokens:
+        LLM_TOKENS.labels(kind, 'prompt').inc(completion.prompt_tokens)
+    if completion.completion_tokens:
+        LLM_TOKENS.labels(kind, 'completion').inc(completion.completion_tokens)
+
+# --- Trace Spans --- #
+
+class Trace:
+    """Spans recorded for one request or round: (span_id, parent_id, name, start offset, duration, attrs)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _add(self, span_id, parent_id, name, start, duration, attrs):
+        with self._lock:
+            self.spans.append((span_id, parent_id, name, start - self.started, duration, attrs))
+
+    def to_list(self):
+        """Spans as dicts ordered by start time (for JSON)."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s[3])
+        return [{'id': s[0], 'parent': s[1], 'name': s[2], 'start': round(s[3], 4), 'duration': round(s[4], 4), **s[5]}
+                for s in spans]
+
+    def format(self):
+        """The span tree as indented text, one line per span."""
+        spans = self.to_list()
+        children = {}
+        for s in spans:
+            children.setdefault(s['parent'], []).append(s)
+        lines = [f"TRACE {self.name}: {self.duration or 0:.3f}s"]
+
+        def walk(parent, depth):
+            for s in children.get(parent, []):
+                attrs = ' '.join(f"{k}={v}" for k, v in s.items() if k not in ('id', 'parent', 'name', 'start', 'duration'))
+                lines.append(f"{'  ' * depth}+{s['start']:.3f}s {s['name']} {s['duration']:.3f}s {attrs}".rstrip())
+                walk(s['id'], depth + 1)
+        walk(None, 1)
+        return '\n'.join(lines)
+
+    def server_timing(self):
+        """Top-level spans as a Server-Timing header value (durations summed per name)."""
+        totals = {}
+        for s in self.to_list():
+            if s['parent'] is None:
+                totals[s['name']] = totals.get(s['name'], 0) + s['duration']
+        return ', '.join(f"{name.replace(' ', '_')};dur={duration * 1000:.1f}" for name, duration in totals.items())
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+
+def start_trace(name):
+    """Begins a trace for the current context and returns it."""
+    trace = Trace(name)
+    _current_trace.set(trace)
+    _current_span.set(None)
+    return trace
+
+def finish_trace():
+    """Ends the current context's trace and returns it (None if none was started)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.duration = time.perf_counter() - trace.started
+        _current_trace.set(None)
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+@contextmanager
+def span(name, **attrs):
+    """Records the with-block as a span of the current trace, if one is active."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = next(trace._ids)
+    parent_id = _current_span.get()
+    token = _current_span.set(span_id)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        trace._add(span_id, parent_id, name, started, time.perf_counter() - started, attrs)
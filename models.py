@@ -0,0 +1,190 @@
+"""
+Character model and the negotiation table.
+
+A Character is a slotted object: fixed profile fields (name, role, backstory...),
+numeric game fields (stance_score, trust_value, influence_tokens, max_tokens,
+influence) and a little per-round state. The stance category is derived from
+stance_score on access, so it can never go stale.
+
+A Table holds the seated characters in speaking order, indexes them by id and
+by role_id, and keeps the one canonical player entry. It serializes to a
+compact form for the game store: profiles as positional lists (written once
+per game), the numeric fields of every seat packed into a single array, and
+the small per-round state as positional lists.
+"""
+from array import array
+
+STANCES = { # Using descriptive keys
+    "support": "Support",
+    "oppose": "Oppose",
+    "neutral": "Neutral",
+    "compromise": "Compromise"
+}
+NEUTRAL_SCORE = 50
+SUPPORT_THRESHOLD_LOW = 61 # Score >= this means Support
+OPPOSE_THRESHOLD_HIGH = 39 # Score <= this means Oppose
+
+# --- Helper function to derive stance category from score --- #
+def get_stance_category(score):
+    if score <= OPPOSE_THRESHOLD_HIGH:
+        return STANCES["oppose"]
+    elif score >= SUPPORT_THRESHOLD_LOW:
+        return STANCES["support"]
+    else:
+        return STANCES["neutral"]
+
+
+PROFILE_FIELDS = ('id', 'name', 'role_id', 'role_name', 'is_player', 'age', 'gender', 'local_born',
+                  'has_children', 'num_children', 'marital_status', 'backstory', 'initial_stance')
+NUMERIC_FIELDS = ('stance_score', 'trust_value', 'influence_tokens', 'max_tokens', 'influence')
+STATE_FIELDS = ('previous_stance_category', 'skipped_round', 'position_memory')
+NUMERIC_TYPECODE = 'h' # Signed 16-bit: scores are 0-100 and token counts stay small
+
+_DEFAULTS = {
+    'is_player': False,
+    'num_children': 0,
+    'stance_score': NEUTRAL_SCORE,
+    'trust_value': NEUTRAL_SCORE,
+    'influence_tokens': 0,
+    'max_tokens': 0,
+    'influence': 1,
+    'skipped_round': False,
+}
+
+
+class Character:
+    """One seat at the negotiation table (AI or player)."""
+    __slots__ = PROFILE_FIELDS + NUMERIC_FIELDS + STATE_FIELDS
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, _DEFAULTS.get(name)))
+        if fields:
+            raise TypeError(f"Unknown character field(s): {', '.join(sorted(fields))}")
+        if self.position_memory is None:
+            self.position_memory = []
+
+    @property
+    def stance(self):
+        """Stance category derived from the current stance_score."""
+        return get_stance_category(self.stance_score)
+
+    def adjust_stance(self, delta):
+        """Adds delta to stance_score, clamped to 0-100. Returns the new score."""
+        self.stance_score = max(0, min(100, self.stance_score + delta))
+        return self.stance_score
+
+    def adjust_trust(self, delta):
+        """Adds delta to trust_value, clamped to 0-100. Returns the new value."""
+        self.trust_value = max(0, min(100, self.trust_value + delta))
+        return self.trust_value
+
+    def to_dict(self):
+        """Profile and numeric fields as a plain dict (for templates and JSON)."""
+        return {name: getattr(self, name) for name in PROFILE_FIELDS + NUMERIC_FIELDS}
+
+    def profile_record(self):
+        return [getattr(self, name) for name in PROFILE_FIELDS]
+
+    def state_record(self):
+        return [getattr(self, name) for name in STATE_FIELDS]
+
+    def __repr__(self):
+        return f"Character({self.id!r}, {self.name!r}, {self.role_id!r}, stance_score={self.stance_score})"
+
+
+class Table:
+    """The seated characters in speaking order, indexed by id and role_id."""
+    __slots__ = ('characters', 'player', '_by_id', '_by_role')
+
+    def __init__(self, characters):
+        self.characters = list(characters)
+        self._index()
+
+    def _index(self):
+        self.player = None # The first human seat (the only one outside multiplayer rooms)
+        self._by_id = {}
+        self._by_role = {}
+        for char in self.characters:
+            if char.id in self._by_id:
+                raise ValueError(f"Duplicate character id '{char.id}'")
+            self._by_id[char.id] = char
+            self._by_role.setdefault(char.role_id, []).append(char)
+            if char.is_player and self.player is None:
+                self.player = char
+
+    def replace(self, seat, char):
+        """Seats char in place of the character at seat."""
+        self.characters[seat] = char
+        self._index()
+
+    def __iter__(self):
+        return iter(self.characters)
+
+    def __len__(self):
+        return len(self.characters)
+
+    def __getitem__(self, seat):
+        return self.characters[seat]
+
+    def get(self, char_id, default=None):
+        """The character with this id, or default."""
+        return self._by_id.get(char_id, default)
+
+    def by_role(self, role_id):
+        """Characters holding role_id, in seat order."""
+        return self._by_role.get(role_id, [])
+
+    @property
+    def ai_characters(self):
+        return [char for char in self.characters if not char.is_player]
+
+    @property
+    def humans(self):
+        return [char for char in self.characters if char.is_player]
+
+    def ids(self):
+        return [char.id for char in self.characters]
+
+    # --- Compact serialization --- #
+
+    def profile_records(self):
+        return [char.profile_record() for char in self.characters]
+
+    def numbers(self):
+        """The numeric fields of every seat packed into one array (seat-major, NUMERIC_FIELDS order)."""
+        packed = array(NUMERIC_TYPECODE)
+        for char in self.characters:
+            packed.extend(getattr(char, name) for name in NUMERIC_FIELDS)
+        return packed
+
+    def state_records(self):
+        return [char.state_record() for char in self.characters]
+
+    def changed_since(self, numbers):
+        """Characters whose numeric fields differ from an earlier numbers() snapshot (array or bytes)."""
+        if not isinstance(numbers, array):
+            packed = array(NUMERIC_TYPECODE)
+            packed.frombytes(numbers)
+            numbers = packed
+        current = self.numbers()
+        width = len(NUMERIC_FIELDS)
+        return [char for seat, char in enumerate(self.characters)
+                if current[seat * width:(seat + 1) * width] != numbers[seat * width:(seat + 1) * width]]
+
+    @classmethod
+    def from_records(cls, profiles, numbers, states=None):
+        """Rebuilds a table from profile_records(), numbers() (array or bytes) and state_records()."""
+        if not isinstance(numbers, array):
+            packed = array(NUMERIC_TYPECODE)
+            packed.frombytes(numbers)
+            numbers = packed
+        width = len(NUMERIC_FIELDS)
+        characters = []
+        for seat, profile in enumerate(profiles):
+            fields = dict(zip(PROFILE_FIELDS, profile))
+            fields.update(zip(NUMERIC_FIELDS, numbers[seat * width:(seat + 1) * width]))
+            if states:
+                fields.update(zip(STATE_FIELDS, states[seat]))
+            characters.append(Character(**fields))
+        return cls(characters)
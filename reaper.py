@@ -0,0 +1,168 @@
+"""
+Background expiry for stored games and session files.
+
+Nothing else ever deletes a game, and Flask-Session's files outlive the
+browser sessions that wrote them, so a long-running server would keep every
+abandoned game and session on disk. A Reaper thread sweeps its stores every
+interval seconds and evicts:
+
+    finished    games with an outcome, unused for finished_ttl seconds
+    idle        anything unused for idle_ttl seconds
+    size        the least recently used entries, while the stores together
+                hold more than max_bytes (entries used in the last
+                ACTIVE_GRACE_SECONDS are never evicted for size)
+
+A store is anything with two methods, so other state backends can be added
+alongside the built-in ones:
+
+    usage()                -> iterable of (key, bytes, last_used, finished)
+    evict(key, last_used)  -> True if the entry was removed (False: in use or
+                              used since usage() reported last_used, try later)
+
+GameStore (game_store.py) implements them over SQLite; SessionFiles below does
+for a Flask-Session file directory. Sweeps run on the reaper's own thread and
+never hold a request's lock: a game whose round is being played is skipped
+until the next sweep. Every worker process may run its own reaper: eviction
+only removes an entry that is unchanged since the sweep read it, so a
+concurrent save or session write wins. stats() and the storage_* metrics report what is live
+and what was evicted.
+"""
+import os
+import threading
+import time
+
+import metrics
+
+FINISHED_TTL = 6 * 3600 # Seconds a finished game is kept after its last use
+IDLE_TTL = 7 * 24 * 3600 # Seconds an unfinished game or session is kept after its last use
+MAX_BYTES = 512 * 1024 * 1024 # Cap on the stores' combined size (0 = no cap)
+SWEEP_INTERVAL = 300 # Seconds between sweeps
+ACTIVE_GRACE_SECONDS = 600 # Entries used this recently are never evicted to meet MAX_BYTES
+
+
+class SessionFiles:
+    """A Flask-Session (cachelib) file directory as a reaper store: one entry per session file."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def usage(self):
+        try:
+            scan = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return []
+        entries = []
+        for entry in scan:
+            if entry.name.startswith('__') or not entry.is_file(): # cachelib's own bookkeeping file
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError: # Removed since the scan
+                continue
+            entries.append((entry.name, stat.st_size, stat.st_mtime, False))
+        return entries
+
+    def evict(self, key, last_used):
+        path = os.path.join(self.directory, key)
+        try:
+            if os.stat(path).st_mtime != last_used: # Written since the sweep read it
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+
+class Reaper:
+    """Periodically evicts expired entries from named stores; see the module docstring for the rules."""
+
+    def __init__(self, stores, finished_ttl=FINISHED_TTL, idle_ttl=IDLE_TTL, max_bytes=MAX_BYTES,
+                 interval=SWEEP_INTERVAL):
+        self.stores = stores # {name: store}
+        self.finished_ttl = finished_ttl
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'sweeps': 0, 'last_sweep': None,
+                       'stores': {name: {'live': 0, 'bytes': 0, 'evicted': {}} for name in stores}}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='reaper', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"ERROR in reaper sweep: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def sweep(self, now=None):
+        """Runs one sweep. Returns {store name: {reason: entries evicted}}."""
+        now = time.time() if now is None else now
+        with metrics.STORAGE_SWEEP_SECONDS.time():
+            evicted = {name: {} for name in self.stores}
+            kept = [] # (last_used, name, key, bytes)
+            live = {name: [0, 0] for name in self.stores} # name -> [entries, bytes]
+
+            for name, store in self.stores.items():
+                for key, size, last_used, finished in store.usage():
+                    age = now - last_used
+                    reason = 'finished' if finished and age > self.finished_ttl else 'idle' if age > self.idle_ttl else None
+                    if reason and store.evict(key, last_used):
+                        evicted[name][reason] = evicted[name].get(reason, 0) + 1
+                        continue
+                    kept.append((last_used, name, key, size))
+                    live[name][0] += 1
+                    live[name][1] += size
+
+            total = sum(size for _, size in live.values())
+            if self.max_bytes:
+                for last_used, name, key, size in sorted(kept): # Least recently used first
+                    if total <= self.max_bytes or now - last_used < ACTIVE_GRACE_SECONDS:
+                        break
+                    if self.stores[name].evict(key, last_used):
+                        evicted[name]['size'] = evicted[name].get('size', 0) + 1
+                        live[name][0] -= 1
+                        live[name][1] -= size
+                        total -= size
+
+        self._record(now, live, evicted)
+        return evicted
+
+    def _record(self, now, live, evicted):
+        with self._lock:
+            self._stats['sweeps'] += 1
+            self._stats['last_sweep'] = now
+            for name, (entries, size) in live.items():
+                store_stats = self._stats['stores'][name]
+                store_stats['live'], store_stats['bytes'] = entries, size
+                metrics.STORAGE_LIVE.labels(name).set(entries)
+                metrics.STORAGE_BYTES.labels(name).set(size)
+                for reason, count in evicted[name].items():
+                    store_stats['evicted'][reason] = store_stats['evicted'].get(reason, 0) + count
+                    metrics.STORAGE_EVICTIONS.labels(name, reason).inc(count)
+        if any(evicted.values()):
+            print(f"Reaper evicted {evicted}; live: { {name: entries for name, (entries, _) in live.items()} }")
+
+    def stats(self):
+        """Live entries and bytes per store as of the last sweep, and evictions so far by reason."""
+        with self._lock:
+            return {
+                'sweeps': self._stats['sweeps'],
+                'last_sweep': self._stats['last_sweep'],
+                'max_bytes': self.max_bytes,
+                'stores': {name: {'live': s['live'], 'bytes': s['bytes'], 'evicted': dict(s['evicted'])}
+                           for name, s in self._stats['stores'].items()}
+            }
@@ -0,0 +1,181 @@
+"""
+Deterministic replay of stored games from their round log.
+
+A seeded game (see engine.py) logs every rule it applies: statements and
+their token charges, rolled micro-events, each NPC's reaction, influence
+actions, token regeneration and the outcome. Replay rebuilds the table from
+the log's last snapshot and applies the entries after it with the same
+engine functions; each round's dice come from round_rng(), i.e. from the
+game's seed, so the events and their targets come out the same. Only the NPC
+reactions need a policy:
+
+    log   the reactions the log recorded: reproduces the stored game exactly,
+          so any difference points at a rules change or a logging bug
+    stub  asks the NPCs again through the web app's LLM path, against the
+          offline stub backend
+    llm   the same against the LLM_BACKEND backend; with LLM_CACHE=1 and the
+          production LLM_CACHE_PATH, prompts seen before are answered from the
+          response cache (temperature > 0 calls need LLM_CACHE_SAMPLED=1)
+
+The replay writes its own log, which is compared entry by entry with the
+stored one, and its final table with the stored game's.
+
+    python -m replay <game_id> [--policy log|stub|llm] [--store game_state.sqlite3] [--verbose]
+"""
+import argparse
+import base64
+import contextlib
+import io
+import os
+import sys
+
+import engine
+import rooms
+from game_store import GameStore
+from models import Table
+
+# --- Replay --- #
+
+def rebuild(profiles, snapshot):
+    """The table and negotiation_state as of a 'snapshot' log entry (profiles: the seats' profile records)."""
+    table = Table.from_records(profiles, base64.b64decode(snapshot['numbers']), snapshot['char_state'])
+    negotiation_state = {
+        'round': snapshot['round'],
+        'history': [], # Snapshots are taken before the first round is played
+        'outcome': snapshot['outcome'],
+        'negotiation_climate': snapshot['climate'],
+        'seed': snapshot['seed'],
+        'log': []
+    }
+    return table, negotiation_state
+
+def logged_policy(npc_entries):
+    """An NPC policy that answers with the reactions logged for the round."""
+    def policy(table, negotiation_state, player_statement, rng):
+        return {entry['char_id']: {'response': entry['response'], 'new_score': entry['new_score']}
+                for entry in npc_entries}
+    return policy
+
+def replay_log(table, negotiation_state, entries, npc_policy=None, multiplayer=False, config=engine.DEFAULT_CONFIG):
+    """
+    Applies the log entries that follow a snapshot to the table and
+    negotiation_state rebuilt from it, in place. npc_policy None replays the
+    logged NPC reactions; multiplayer passes each round's statements as a
+    {char_id: statement} dict, as rooms do.
+    """
+    statements = {}
+    index = 0
+    while index < len(entries):
+        entry = entries[index]
+        index += 1
+        kind = entry['kind']
+        if kind == 'statement':
+            engine.charge_statement_token(table.get(entry['char_id']), negotiation_state, entry['text'])
+            statements[entry['char_id']] = entry['text']
+        elif kind == 'influence':
+            engine.apply_influence(table, negotiation_state, entry['action'], entry['target_id'], config)
+        elif kind == 'regen':
+            engine.regenerate_tokens(table, negotiation_state, config)
+        elif kind == 'event': # A round starts: play it with the NPC reactions logged after the event
+            npc_entries = []
+            while index < len(entries) and entries[index]['kind'] == 'npc':
+                npc_entries.append(entries[index])
+                index += 1
+            statement = statements if multiplayer else statements.get(table.player.id, '')
+            engine.play_round(table, negotiation_state, statement, npc_policy or logged_policy(npc_entries),
+                              rng=engine.round_rng(negotiation_state), config=config)
+            statements = {}
+        elif kind == 'outcome' and not negotiation_state.get('outcome'): # Ended outside a round (gave up, abandoned)
+            negotiation_state['outcome'] = entry['outcome']
+            engine.record(negotiation_state, 'outcome', outcome=entry['outcome'])
+    return negotiation_state
+
+def first_divergence(logged, replayed):
+    """Index of the first entry where two logs differ (None if they are identical)."""
+    for index, (a, b) in enumerate(zip(logged, replayed)):
+        if a != b:
+            return index
+    return None if len(logged) == len(replayed) else min(len(logged), len(replayed))
+
+def replay_game(store, game_id, npc_policy=None):
+    """
+    Replays a stored game from its last snapshot. Returns a report: entries
+    replayed, the first diverging entry (index, logged, replayed) or None, and
+    whether the final numbers, climate, round and outcome match the store.
+    """
+    game = store.load_game(game_id, with_history=False)
+    if game is None:
+        raise LookupError(f"Game {game_id} not found.")
+    log = store.load_log(game_id)
+    starts = [index for index, entry in enumerate(log) if entry['kind'] == 'snapshot']
+    if not starts:
+        raise LookupError(f"Game {game_id} has no round log (it was not created with a seed).")
+    entries = log[starts[-1] + 1:]
+    table, negotiation_state = rebuild(game.table.profile_records(), log[starts[-1]])
+    replay_log(table, negotiation_state, entries, npc_policy, multiplayer=rooms.is_room(game))
+
+    replayed = negotiation_state['log']
+    divergence = first_divergence(entries, replayed)
+    stored = game.negotiation_state
+    return {
+        'game_id': game_id,
+        'entries': len(entries),
+        'divergence': None if divergence is None else (
+            divergence, entries[divergence] if divergence < len(entries) else None,
+            replayed[divergence] if divergence < len(replayed) else None),
+        'numbers_match': table.numbers().tobytes() == game.table.numbers().tobytes(),
+        'climate': (stored['negotiation_climate'], negotiation_state['negotiation_climate']),
+        'round': (stored['round'], negotiation_state['round']),
+        'outcome': (stored.get('outcome'), negotiation_state.get('outcome'))
+    }
+
+def format_report(report):
+    lines = [f"Game {report['game_id']}: {report['entries']} log entries replayed"]
+    for field in ('round', 'climate', 'outcome'):
+        stored, replayed = report[field]
+        lines.append(f"  {field:<8} stored {stored!r:<24} replayed {replayed!r}" + ('' if stored == replayed else '  <-- differs'))
+    lines.append(f"  numbers  {'identical' if report['numbers_match'] else 'DIFFER'}")
+    if report['divergence'] is None:
+        lines.append("  log      identical")
+    else:
+        index, logged, replayed = report['divergence']
+        lines.append(f"  log      first differs at entry {index}:\n    logged   {logged}\n    replayed {replayed}")
+    return '\n'.join(lines)
+
+def _room_aware(policy):
+    """The NPC policy, also taking a room's round as app.run_negotiation_round hands it over ({char_id: statement})."""
+    def npc_policy(table, negotiation_state, player_statement, rng):
+        if isinstance(player_statement, dict):
+            player_statement = rooms.statements_text(table, player_statement)
+        return policy(table, negotiation_state, player_statement, rng)
+    return npc_policy
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a stored game from its round log and compare the result.")
+    parser.add_argument('game_id')
+    parser.add_argument('--policy', choices=['log', 'stub', 'llm'], default='log')
+    parser.add_argument('--store', default=os.environ.get('GAME_STORE_PATH', './game_state.sqlite3'))
+    parser.add_argument('--verbose', action='store_true', help="Keep the engine's per-round log output")
+    args = parser.parse_args(argv)
+
+    if args.policy == 'log':
+        npc_policy = None
+    else:
+        from simulator import llm_policy # Imported here: the log policy doesn't need Flask or an LLM client
+        backend = 'stub' if args.policy == 'stub' else os.environ.get('LLM_BACKEND') or 'openai'
+        npc_policy = _room_aware(llm_policy(backend))
+
+    store = GameStore(args.store)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with quiet:
+            report = replay_game(store, args.game_id, npc_policy)
+    except LookupError as e:
+        parser.exit(1, f"{e}\n")
+    print(format_report(report))
+    sys.exit(0 if report['divergence'] is None and report['numbers_match'] else 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Multiplayer rooms: several human players seated at one negotiation table.
+
+A room is an ordinary stored game (game_store.py) whose negotiation_state
+carries a 'room' entry, so every participant reads and writes the same shared
+state and the Flask session only remembers which seat each browser holds:
+
+    {'host': 'player_0', 'status': 'lobby' | 'playing', 'round_seconds': 120,
+     'deadline': <time.time()> or None, 'submitted': {char_id: statement}}
+
+The host creates the room with a freshly generated table; while the room is in
+its lobby, other humans join by taking over an AI seat of the role they pick
+(join_room). Once the host starts it, each round collects one statement per
+human (submit_statement); the round resolves, with the NPCs reacting to every
+statement, when all humans have submitted or the deadline passes. The app
+plays rounds through the round queue (round_queue.py), with the deadline as the
+job's not_before, and pushes state changes to every participant over SSE.
+
+Like engine.py, this module has no Flask or LLM dependency.
+"""
+import threading
+import time
+
+from engine import (MAX_ROUNDS, ROLES, create_player, new_game, new_seed, record_snapshot, validate_player_statement,
+                    charge_statement_token)
+
+ROOM_MAX_HUMANS = 4 # Human seats per room, host included
+ROUND_SECONDS = 120 # Default time humans get to submit each round's statements
+MIN_ROUND_SECONDS = 30
+MAX_ROUND_SECONDS = 600
+
+# --- Room Rules --- #
+
+def new_room(host, round_seconds=ROUND_SECONDS):
+    """Seats the host with generated AI opponents. Returns (table, negotiation_state) for GameStore.create_game."""
+    table, negotiation_state = new_game(host, seed=new_seed())
+    negotiation_state['room'] = {
+        'host': host.id,
+        'status': 'lobby',
+        'round_seconds': max(MIN_ROUND_SECONDS, min(MAX_ROUND_SECONDS, int(round_seconds))),
+        'deadline': None,
+        'submitted': {}
+    }
+    return table, negotiation_state
+
+def is_room(game):
+    return 'room' in game.negotiation_state
+
+def open_roles(game):
+    """Role ids a new human can still take (an AI seat holds them), or [] once the room is full or started."""
+    room = game.negotiation_state['room']
+    if room['status'] != 'lobby' or len(game.table.humans) >= ROOM_MAX_HUMANS:
+        return []
+    return [role_id for role_id in ROLES if any(not char.is_player for char in game.table.by_role(role_id))]
+
+def join_room(game, role_id, profile):
+    """
+    Seats a new human in place of an AI character holding role_id.
+    Returns (character, None) or (None, (message, http_status)).
+    """
+    if role_id not in open_roles(game):
+        return None, ('That seat is no longer available.', 409)
+    seat = next(seat for seat, char in enumerate(game.table) if char.role_id == role_id and not char.is_player)
+    human = create_player(role_id, player_id=f"player_{len(game.table.humans)}", **profile)
+    game.replace_character(seat, human)
+    record_snapshot(game.table, game.negotiation_state) # Replays start from the seats as they are now
+    return human, None
+
+def start_room(game, char_id):
+    """The host starts the first round. Returns None, or (message, http_status) if the room can't start."""
+    room = game.negotiation_state['room']
+    if char_id != room['host']:
+        return 'Only the host can start the room.', 403
+    if room['status'] != 'lobby':
+        return 'The room has already started.', 409
+    room['status'] = 'playing'
+    open_round(game)
+    return None
+
+def open_round(game):
+    """Starts collecting statements for the current round, until its deadline."""
+    room = game.negotiation_state['room']
+    room['submitted'] = {}
+    room['deadline'] = time.time() + room['round_seconds']
+
+def submit_statement(game, char_id, statement, submitted_round=None):
+    """
+    Records a human's statement for the current round and charges its token.
+    Returns None, or (message, http_status) if it can't be accepted.
+    """
+    negotiation_state = game.negotiation_state
+    room = negotiation_state['room']
+    char = game.table.get(char_id)
+    if room['status'] != 'playing' or negotiation_state.get('outcome') or negotiation_state['round'] > MAX_ROUNDS:
+        return 'The room is not taking statements.', 409
+    if submitted_round is not None and submitted_round != negotiation_state['round']:
+        return f"Round {submitted_round} has already been resolved.", 409
+    if char_id in room['submitted']:
+        return 'You have already spoken this round.', 409
+    statement_error = validate_player_statement(statement, char)
+    if statement_error:
+        return statement_error[0], 400
+    charge_statement_token(char, negotiation_state, statement)
+    room['submitted'][char_id] = statement
+    return None
+
+def all_submitted(game):
+    room = game.negotiation_state['room']
+    return all(char.id in room['submitted'] for char in game.table.humans)
+
+def round_statements(game):
+    """The current round's submitted statements in seat order ({char_id: statement}, for engine.finish_round)."""
+    submitted = game.negotiation_state['room']['submitted']
+    return {char.id: submitted[char.id] for char in game.table.humans if char.id in submitted}
+
+def statements_text(table, statements):
+    """Several humans' statements as one text for the NPC prompts."""
+    return ' '.join(f"{table.get(char_id).name} ({table.get(char_id).role_name}): \"{statement}\""
+                    for char_id, statement in statements.items())
+
+def room_view(game, char_id):
+    """The room part of a participant's state: seats, who has spoken, the deadline and what they may do."""
+    room = game.negotiation_state['room']
+    return {
+        'status': room['status'],
+        'host': room['host'],
+        'you': char_id,
+        'round_seconds': room['round_seconds'],
+        'deadline': room['deadline'],
+        'seconds_left': max(0, round(room['deadline'] - time.time())) if room['deadline'] else None,
+        'humans': [{'id': char.id, 'name': char.name, 'role_name': char.role_name,
+                    'submitted': char.id in room['submitted']} for char in game.table.humans],
+        'open_roles': open_roles(game)
+    }
+
+# --- Broadcast --- #
+
+class RoomUpdates:
+    """
+    Wakes this process's event streams when a room is saved here. Streams also
+    re-check the stored version every poll interval, which covers rounds played
+    by round workers in another process.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._changes = 0
+
+    def notify(self):
+        with self._condition:
+            self._changes += 1
+            self._condition.notify_all()
+
+    def wait(self, seen, timeout):
+        """Blocks until a change after `seen` (a value from a previous wait) or the timeout; returns the new value."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._changes != seen, timeout)
+            return self._changes
@@ -0,0 +1,280 @@
+"""
+Background round-processing queue backed by SQLite (no external broker).
+
+A web request that submits a player statement only records a round job
+(game id, round number, statement) and returns its id; worker threads claim
+jobs and run the round pipeline (statement charge, event, NPC replies,
+climate, victory check, save) outside the request.
+
+Delivery is at-least-once: a claimed job holds a lease, and a job whose
+worker died before acknowledging it is claimed again once the lease runs
+out (up to MAX_ATTEMPTS). Jobs are unique per (game id, round number), so
+re-submitting a round returns the existing job rather than queueing the
+round twice, and the processor skips a round the game has already moved
+past, so a retried job never plays a round twice.
+
+A job can also be held until a time (not_before), e.g. a multiplayer room's
+round deadline, and released early with expedite().
+
+    queue = RoundQueue('game_state.sqlite3')
+    job, created = queue.submit(game_id, round_number, statement)
+    pool = RoundWorkerPool(queue, process_job, workers=4).start()
+    queue.get(job.id).status # 'queued' -> 'running' -> 'done' / 'failed'
+
+Workers can run in the web process (RoundWorkerPool) or separately, sized
+independently of the web workers:
+
+    python -m round_queue --workers 8
+"""
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import metrics
+
+LEASE_SECONDS = 120 # A running job not acknowledged within this is handed to another worker
+MAX_ATTEMPTS = 3 # Claims before a job that keeps failing is marked failed
+POLL_INTERVAL = 0.5 # Seconds an idle worker waits before checking for jobs again
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS round_jobs (
+    id TEXT PRIMARY KEY,
+    game_id TEXT NOT NULL,
+    round_number INTEGER NOT NULL,
+    statement TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    not_before REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (game_id, round_number)
+);
+CREATE INDEX IF NOT EXISTS round_jobs_claim ON round_jobs (status, created_at);
+"""
+
+_COLUMNS = ('id, game_id, round_number, statement, status, attempts, lease_until, not_before, result, error,'
+            ' created_at, updated_at')
+
+Job = namedtuple('Job', 'id game_id round_number statement status attempts lease_until not_before result error created_at'
+                        ' updated_at')
+
+def _job(row):
+    if row is None:
+        return None
+    job = Job(*row)
+    return job._replace(result=json.loads(job.result) if job.result else None)
+
+def job_status(job):
+    """The public view of a job, for the job-status endpoint."""
+    return {'id': job.id, 'status': job.status, 'round': job.round_number, 'attempts': job.attempts,
+            'result': job.result, 'error': job.error}
+
+
+class JobFailed(Exception):
+    """Raised by a job processor for a permanent failure: the job is marked failed without a retry."""
+
+
+class RoundQueue:
+    """Round jobs in a SQLite table. Thread-safe: one connection per thread, WAL mode."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.wakeup = threading.Event() # Set on submit so in-process workers don't wait out POLL_INTERVAL
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        if 'not_before' not in [column[1] for column in conn.execute("PRAGMA table_info(round_jobs)")]:
+            conn.execute("ALTER TABLE round_jobs ADD COLUMN not_before REAL") # Table from before deadlines
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def submit(self, game_id, round_number, statement, not_before=None):
+        """
+        Queues the round, or returns the job already queued for it. A failed job
+        for the same round is replaced. With not_before (a time.time() value) it
+        isn't claimed before then. Returns (job, created).
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            existing = _job(conn.execute(f"SELECT {_COLUMNS} FROM round_jobs WHERE game_id = ? AND round_number = ?",
+                                         (game_id, round_number)).fetchone())
+            if existing and existing.status != 'failed':
+                conn.execute("COMMIT")
+                return existing, False
+            if existing:
+                conn.execute("DELETE FROM round_jobs WHERE id = ?", (existing.id,))
+            job_id = uuid.uuid4().hex
+            conn.execute("INSERT INTO round_jobs (id, game_id, round_number, statement, status, not_before, created_at,"
+                         " updated_at) VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                         (job_id, game_id, round_number, statement, not_before, now, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        metrics.ROUND_JOBS.labels('queued').inc()
+        self.wakeup.set()
+        return self.get(job_id), True
+
+    def get(self, job_id):
+        return _job(self._conn().execute(f"SELECT {_COLUMNS} FROM round_jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def job_for(self, game_id, round_number):
+        """The job for this round of the game, in any status, or None."""
+        return _job(self._conn().execute(f"SELECT {_COLUMNS} FROM round_jobs WHERE game_id = ? AND round_number = ?",
+                                         (game_id, round_number)).fetchone())
+
+    def active_job(self, game_id):
+        """The game's queued or running job, if any."""
+        return _job(self._conn().execute(
+            f"SELECT {_COLUMNS} FROM round_jobs WHERE game_id = ? AND status IN ('queued', 'running')"
+            " ORDER BY round_number DESC LIMIT 1", (game_id,)).fetchone())
+
+    def claim(self, lease=LEASE_SECONDS):
+        """Takes the oldest queued job (or one whose lease expired) and marks it running; None if there is none."""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT {_COLUMNS} FROM round_jobs WHERE (status = 'queued' AND (not_before IS NULL OR not_before <= ?))"
+                " OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1", (now, now)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            job = _job(row)
+            if job.status == 'running' and job.attempts >= MAX_ATTEMPTS:
+                # Its last worker died too: give up rather than retry forever
+                conn.execute("UPDATE round_jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                             ('Round processing did not finish.', now, job.id))
+                conn.execute("COMMIT")
+                metrics.ROUND_JOBS.labels('failed').inc()
+                return self.claim(lease)
+            conn.execute("UPDATE round_jobs SET status = 'running', attempts = attempts + 1, lease_until = ?,"
+                         " updated_at = ? WHERE id = ?", (now + lease, now, job.id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if job.attempts == 0:
+            metrics.ROUND_JOB_WAIT_SECONDS.observe(now - max(job.created_at, job.not_before or 0))
+        return job._replace(status='running', attempts=job.attempts + 1, lease_until=now + lease)
+
+    def expedite(self, job_id):
+        """Lets a queued job held by not_before be claimed now."""
+        now = time.time()
+        self._conn().execute("UPDATE round_jobs SET not_before = ?, updated_at = ? WHERE id = ? AND status = 'queued'"
+                             " AND not_before > ?", (now, now, job_id, now))
+        self.wakeup.set()
+
+    def complete(self, job_id, result):
+        self._finish(job_id, 'done', result=json.dumps(result))
+
+    def fail(self, job_id, error, retry=True):
+        """Records a failed attempt: the job is queued again while attempts remain (if retry), else marked failed."""
+        job = self.get(job_id)
+        if retry and job is not None and job.attempts < MAX_ATTEMPTS:
+            self._finish(job_id, 'queued', error=error)
+            metrics.ROUND_JOBS.labels('retried').inc()
+        else:
+            self._finish(job_id, 'failed', error=error)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        self._conn().execute("UPDATE round_jobs SET status = ?, result = ?, error = ?, lease_until = NULL, updated_at = ?"
+                             " WHERE id = ?", (status, result, error, time.time(), job_id))
+        if status != 'queued':
+            metrics.ROUND_JOBS.labels(status).inc()
+
+    def counts(self):
+        """Jobs per status."""
+        return dict(self._conn().execute("SELECT status, COUNT(*) FROM round_jobs GROUP BY status").fetchall())
+
+
+class RoundWorkerPool:
+    """Threads that claim jobs from a RoundQueue and run process(job) -> result dict."""
+
+    def __init__(self, queue, process, workers=4):
+        self.queue = queue
+        self.process = process
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'round-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        """Stops claiming new jobs and waits for running ones to finish."""
+        self._stop.set()
+        self.queue.wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.queue.claim()
+            if job is None:
+                self.queue.wakeup.wait(POLL_INTERVAL)
+                self.queue.wakeup.clear()
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        try:
+            result = self.process(job)
+        except JobFailed as e:
+            print(f"Round job {job.id} failed: {e}")
+            self.queue.fail(job.id, str(e), retry=False)
+        except Exception as e:
+            print(f"ERROR in round job {job.id} (attempt {job.attempts}): {e}")
+            self.queue.fail(job.id, 'An error occurred while processing the round.')
+        else:
+            self.queue.complete(job.id, result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run round workers against the game store's job queue.")
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    os.environ['ROUND_WORKERS'] = '0' # This process is the worker pool; don't start another one in app
+    import app # Imported here: the queue itself doesn't need Flask or an LLM client
+    # Run as `python -m round_queue` this module is __main__, a second copy: take the pool from the
+    # round_queue module app imported, so it catches the JobFailed that app raises
+    from round_queue import RoundWorkerPool
+    pool = RoundWorkerPool(app.get_round_queue(), app.process_round_job, args.workers).start()
+    print(f"Round workers: {args.workers} on {app.GAME_STORE_PATH}. Ctrl-C to stop.")
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    print("Stopping round workers (waiting for running rounds)...")
+    pool.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Headless game simulator for balance testing.
+
+Plays many seeded games with the engine (engine.py), no Flask request cycle,
+across a process pool, and reports the outcome distribution by player role
+plus throughput in games/second.
+
+    python -m simulator --games 10000 --policy random --strategy greedy
+
+NPC policies (how AI characters react to the player's statement):
+    random - uniform score change in RANDOM_SCORE_RANGE per active AI; no LLM
+    stub   - the web app's LLM path against the offline stub backend
+    llm    - the web app's LLM path against the backend named by LLM_BACKEND (costs money!)
+
+Player strategies:
+    passive - only makes the round statement
+    greedy  - also spends spare tokens persuading the AI closest to Support
+
+Every game draws from its own random.Random seeded with (seed, game index),
+so results don't depend on the worker count or chunking.
+
+--engine batch plays random-policy games with the NumPy batch engine
+(batch_engine.py) instead: same rules and strategies, different (vectorized)
+dice, so the distributions agree but individual games don't.
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+
+SIM_STATEMENT = ("I believe this project will bring many jobs and affordable homes to our community "
+                 "for years to come, and I want to hear your concerns.")
+RANDOM_SCORE_RANGE = (-5, 5) # Score change per round for the random policy
+OUTCOME_CATEGORIES = ['Consensus Victory', 'Influence Victory', 'Partial Failure', 'Total Failure', 'Player Gave Up']
+
+# --- NPC Policies --- #
+
+def random_policy(table, negotiation_state, player_statement, rng):
+    """Each active AI character shifts its score by a uniform random amount."""
+    responses = {}
+    for ai in table.ai_characters:
+        if ai.skipped_round:
+            continue
+        change = rng.randint(*RANDOM_SCORE_RANGE)
+        responses[ai.id] = {'response': '', 'new_score': max(0, min(100, ai.stance_score + change))}
+    return responses
+
+def llm_policy(backend_name):
+    """The web app's LLM NPC policy with the given backend (imports app, so Flask must be installed)."""
+    os.environ['LLM_BACKEND'] = backend_name
+    import app # Imported here: the random policy doesn't need Flask or an LLM client
+    if backend_name == 'stub':
+        app.AI_RESPONSE_MODE = 'sequential' # No latency to hide, so skip the thread pool
+    return app.llm_npc_policy
+
+def make_policy(name):
+    if name == 'random':
+        return random_policy
+    if name == 'stub':
+        return llm_policy('stub')
+    if name == 'llm':
+        return llm_policy(os.environ.get('LLM_BACKEND') or 'openai')
+    raise ValueError(f"Unknown policy '{name}'. Use 'random', 'stub' or 'llm'.")
+
+# --- Player Strategies --- #
+
+def passive_strategy(table, negotiation_state, rng, config=engine.DEFAULT_CONFIG):
+    """Spends nothing beyond the statement."""
+
+def greedy_strategy(table, negotiation_state, rng, config=engine.DEFAULT_CONFIG):
+    """Keeps one token for the statement and spends the rest persuading the AI closest to Support."""
+    player = table.player
+    costs = config.influence_action_costs
+    while True:
+        spare = player.influence_tokens - 1
+        targets = [ai for ai in table.ai_characters if ai.stance != engine.STANCES['support']]
+        if not targets or spare < costs['gentle_persuasion']:
+            return
+        target = max(targets, key=lambda ai: ai.stance_score)
+        action = 'strong_persuasion' if spare >= costs['strong_persuasion'] else 'gentle_persuasion'
+        engine.apply_influence(table, negotiation_state, action, target.id, config)
+
+STRATEGIES = {'passive': passive_strategy, 'greedy': greedy_strategy}
+
+# --- Games --- #
+
+def play_game(seed, role_id, npc_policy, strategy, config=engine.DEFAULT_CONFIG):
+    """Plays one full game and returns its outcome text."""
+    rng = random.Random(seed)
+    table, negotiation_state = engine.new_game(engine.create_player(role_id, config, name='Sim Player'), rng, config)
+    while not negotiation_state.get('outcome'):
+        if negotiation_state['round'] > 1:
+            engine.regenerate_tokens(table, negotiation_state, config)
+        strategy(table, negotiation_state, rng, config)
+        if engine.validate_player_statement(SIM_STATEMENT, table.player):
+            negotiation_state['outcome'] = 'Player Gave Up' # Out of tokens: the round can't be played
+            break
+        engine.charge_statement_token(table.player)
+        engine.play_round(table, negotiation_state, SIM_STATEMENT, npc_policy, rng=rng, config=config)
+    return negotiation_state['outcome']
+
+def outcome_category(outcome):
+    return outcome.split(':', 1)[0]
+
+_worker_policy = None
+
+def _init_worker(policy_name, quiet):
+    global _worker_policy
+    if quiet:
+        sys.stdout = open(os.devnull, 'w') # The engine logs every round with print()
+    _worker_policy = make_policy(policy_name)
+
+def _run_chunk(args):
+    seed, start, count, roles, strategy_name, config = args
+    counts = Counter()
+    for index in range(start, start + count):
+        role_id = roles[index % len(roles)]
+        outcome = play_game(f"{seed}:{index}", role_id, _worker_policy, STRATEGIES[strategy_name], config)
+        counts[(role_id, outcome_category(outcome))] += 1
+    return counts
+
+def simulate(games, policy='random', strategy='greedy', roles=None, seed=0, workers=None, chunk_size=200, quiet=True,
+             config=engine.DEFAULT_CONFIG):
+    """
+    Plays `games` games (player roles assigned round-robin) with the given
+    BalanceConfig and returns (Counter of (role_id, outcome category) -> games,
+    elapsed seconds).
+    """
+    roles = list(roles or engine.ROLES)
+    chunks = [(seed, start, min(chunk_size, games - start), roles, strategy, config)
+              for start in range(0, games, chunk_size)]
+    counts = Counter()
+    started = time.perf_counter()
+    if workers == 1:
+        with contextlib.redirect_stdout(open(os.devnull, 'w') if quiet else sys.stdout):
+            _init_worker(policy, quiet=False)
+            for chunk in chunks:
+                counts.update(_run_chunk(chunk))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(policy, quiet)) as executor:
+            for chunk_counts in executor.map(_run_chunk, chunks):
+                counts.update(chunk_counts)
+    return counts, time.perf_counter() - started
+
+def format_report(counts, elapsed):
+    roles = sorted({role_id for role_id, _ in counts})
+    lines = [f"{'role':<24} {'games':>7} " + ' '.join(f"{category:>18}" for category in OUTCOME_CATEGORIES)]
+    for role_id in roles:
+        total = sum(n for (r, _), n in counts.items() if r == role_id)
+        cells = ' '.join(f"{100 * counts[(role_id, category)] / total:>17.1f}%" for category in OUTCOME_CATEGORIES)
+        lines.append(f"{role_id:<24} {total:>7} {cells}")
+    games = sum(counts.values())
+    lines.append(f"{games} games in {elapsed:.2f}s ({games / elapsed:.0f} games/s)")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play seeded headless games and report outcome distributions by role.")
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--policy', choices=['random', 'stub', 'llm'], default='random')
+    parser.add_argument('--strategy', choices=sorted(STRATEGIES), default='greedy')
+    parser.add_argument('--roles', help="Comma-separated player roles (default: all)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Processes (1 = run in this process)")
+    parser.add_argument('--chunk-size', type=int, default=200, help="Games per worker task")
+    parser.add_argument('--engine', choices=['scalar', 'batch'], default='scalar',
+                        help="'batch' = NumPy batch engine (random policy only)")
+    parser.add_argument('--verbose', action='store_true', help="Keep the engine's per-round log output")
+    args = parser.parse_args(argv)
+
+    roles = args.roles.split(',') if args.roles else None
+    unknown = [r for r in roles or [] if r not in engine.ROLES]
+    if unknown:
+        parser.error(f"unknown role(s): {', '.join(unknown)}")
+
+    if args.engine == 'batch':
+        if args.policy != 'random':
+            parser.error("--engine batch supports only --policy random")
+        from batch_engine import simulate_batch # Imported here: NumPy is only needed for the batch engine
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, 'w')):
+            counts = simulate_batch(args.games, roles, args.seed, score_range=RANDOM_SCORE_RANGE, strategy=args.strategy)
+        elapsed = time.perf_counter() - started
+    else:
+        counts, elapsed = simulate(args.games, args.policy, args.strategy, roles, args.seed, args.workers,
+                                   args.chunk_size, quiet=not args.verbose)
+    print(f"engine={args.engine} policy={args.policy} strategy={args.strategy} seed={args.seed} workers={args.workers}")
+    print(format_report(counts, elapsed))
+
+
+if __name__ == '__main__':
+    main()
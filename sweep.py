@@ -0,0 +1,274 @@
+"""
+Parameter sweep over the balance constants.
+
+Each point of the sweep is a BalanceConfig (engine.py): the defaults with some
+fields overridden by dotted paths into the config, e.g.
+
+    token_regen_rate
+    influence_action_costs.strong_persuasion
+    influence_action_effects.gentle_persuasion.stance_delta
+    stance_distributions.local_resident.Oppose
+
+A search space maps such paths to candidate values: a list of values (grid
+mode takes their cartesian product, random mode picks one per point) or
+{"range": [low, high]} (random mode only; integer bounds sample integers). Every
+point is played with the NumPy batch engine (batch_engine.py, random NPC
+policy) across a process pool, with the same seed for every config so
+differences between points aren't sampling noise. Per-role win rates
+(Consensus + Influence Victory) are cached in SQLite by config hash, so
+re-running or extending a sweep only plays the new points.
+
+    python -m sweep --mode random --points 10000 --games 2000 --target 0.35:0.55
+    python -m sweep --space space.json --target developer=0.3:0.5 --target 0.4:0.6
+
+The report lists the configs whose win rate is inside the target band for
+every role, closest to the band centres first.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+
+WIN_CATEGORIES = ('Consensus Victory', 'Influence Victory')
+DEFAULT_TARGET = (0.35, 0.55) # Win-rate band every role should land in
+CACHE_WRITE_BATCH = 100 # Results per cache transaction (and progress report)
+DEFAULT_SPACE = {
+    'token_regen_rate': [1, 2],
+    'event_probability': [0.15, 0.25, 0.35],
+    'influence_action_costs.gentle_persuasion': [1, 2],
+    'influence_action_costs.strong_persuasion': [2, 3, 4],
+    'influence_action_effects.gentle_persuasion.stance_delta': [3, 5, 8],
+    'influence_action_effects.strong_persuasion.stance_delta': [8, 10, 15],
+    'consensus_threshold_percent': [0.6, 0.7, 0.8],
+    'stance_distributions.local_resident.Oppose': [2, 4, 6],
+}
+
+# --- Search Space --- #
+
+def apply_params(base, params):
+    """A copy of base (BalanceConfig) with each dotted-path param set. Raises ValueError on a bad path or value."""
+    data = base.to_dict()
+    for path, value in params.items():
+        node = data
+        *parents, leaf = path.split('.')
+        for key in parents:
+            if not isinstance(node.get(key), dict):
+                raise ValueError(f"Unknown config path '{path}'")
+            node = node[key]
+        if leaf not in node and node is data:
+            raise ValueError(f"Unknown config path '{path}'")
+        node[leaf] = value
+    config = engine.BalanceConfig.from_dict(data)
+    if any(cost < 1 for cost in config.influence_action_costs.values()):
+        raise ValueError("Influence action costs must be at least 1 token.")
+    return config
+
+def grid_points(space):
+    """Every combination of the listed values, as {path: value} dicts."""
+    for path, values in space.items():
+        if not isinstance(values, list):
+            raise ValueError(f"Grid mode needs a list of values for '{path}'")
+    paths = list(space)
+    for values in itertools.product(*(space[path] for path in paths)):
+        yield dict(zip(paths, values))
+
+def random_points(space, count, rng):
+    """count random points: one listed value per path, or a uniform draw from a {"range": [low, high]} entry."""
+    for _ in range(count):
+        point = {}
+        for path, values in space.items():
+            if isinstance(values, dict):
+                low, high = values['range']
+                point[path] = rng.randint(low, high) if isinstance(low, int) and isinstance(high, int) else round(rng.uniform(low, high), 4)
+            else:
+                point[path] = rng.choice(values)
+        yield point
+
+def load_space(path):
+    """Reads a JSON space: {path: [values...] or {"range": [low, high]}}."""
+    with open(path) as f:
+        return json.load(f)
+
+# --- Evaluation --- #
+
+def evaluate(config, games, seed=0, strategy='greedy'):
+    """Plays games batch-engine games with config and returns {role_id: win rate}."""
+    from batch_engine import simulate_batch # Imported here: NumPy is only needed to evaluate points
+    counts = simulate_batch(games, seed=seed, strategy=strategy, config=config)
+    rates = {}
+    for role_id in engine.ROLES:
+        total = sum(n for (r, _), n in counts.items() if r == role_id)
+        wins = sum(counts[(role_id, category)] for category in WIN_CATEGORIES)
+        rates[role_id] = wins / total if total else 0.0
+    return rates
+
+def _evaluate_point(args):
+    config_hash, config, games, seed, strategy = args
+    return config_hash, evaluate(config, games, seed, strategy)
+
+
+class SweepCache:
+    """SQLite cache of win rates, keyed by config hash plus the simulation settings."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sweep_results ("
+            " config_hash TEXT NOT NULL, games INTEGER NOT NULL, seed INTEGER NOT NULL, strategy TEXT NOT NULL,"
+            " win_rates TEXT NOT NULL, created_at REAL NOT NULL,"
+            " PRIMARY KEY (config_hash, games, seed, strategy))"
+        )
+
+    def get(self, config_hash, games, seed, strategy):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT win_rates FROM sweep_results WHERE config_hash = ? AND games = ? AND seed = ? AND strategy = ?",
+                (config_hash, games, seed, strategy)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_many(self, rows, games, seed, strategy):
+        """rows: (config_hash, win_rates) pairs, written in one transaction."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sweep_results (config_hash, games, seed, strategy, win_rates, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(config_hash, games, seed, strategy, json.dumps(rates), now) for config_hash, rates in rows]
+            )
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _quiet_worker():
+    sys.stdout = open(os.devnull, 'w') # The engine logs with print()
+
+def sweep(points, games=2000, seed=0, strategy='greedy', workers=None, cache=None, base=engine.DEFAULT_CONFIG,
+          on_progress=None):
+    """
+    Evaluates every point ({path: value}) and returns a list of (params, config, win_rates).
+    Cached points aren't replayed; new results are written to cache by this process only.
+    on_progress(done, total), if given, is called as batches of results arrive.
+    """
+    results = []
+    pending = {}
+    for params in points:
+        config = apply_params(base, params)
+        config_hash = config.config_hash()
+        rates = cache.get(config_hash, games, seed, strategy) if cache else None
+        results.append([params, config, rates])
+        if rates is None:
+            pending.setdefault(config_hash, config)
+
+    evaluated = {}
+    tasks = [(config_hash, config, games, seed, strategy) for config_hash, config in pending.items()]
+    with contextlib.ExitStack() as stack:
+        if workers == 1:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+            outputs = map(_evaluate_point, tasks)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=_quiet_worker))
+            outputs = executor.map(_evaluate_point, tasks, chunksize=8)
+        batch = []
+        for config_hash, rates in outputs:
+            evaluated[config_hash] = rates
+            batch.append((config_hash, rates))
+            if len(batch) == CACHE_WRITE_BATCH or len(evaluated) == len(tasks):
+                if cache:
+                    cache.put_many(batch, games, seed, strategy)
+                batch = []
+                if on_progress:
+                    on_progress(len(evaluated), len(tasks))
+
+    for result in results:
+        if result[2] is None:
+            result[2] = evaluated[result[1].config_hash()]
+    return [tuple(result) for result in results]
+
+# --- Report --- #
+
+def parse_targets(specs):
+    """['0.3:0.5', 'developer=0.2:0.4'] -> {role_id: (low, high)} for every role (unnamed = all roles)."""
+    targets = {role_id: DEFAULT_TARGET for role_id in engine.ROLES}
+    for spec in specs or []:
+        role_id, _, band = spec.rpartition('=')
+        low, high = (float(x) for x in band.split(':'))
+        if role_id and role_id not in engine.ROLES:
+            raise ValueError(f"Unknown role '{role_id}' in target '{spec}'")
+        for r in ([role_id] if role_id else engine.ROLES):
+            targets[r] = (low, high)
+    return targets
+
+def matching(results, targets):
+    """Results whose every role is within its target band, closest to the band centres first."""
+    def deviation(rates):
+        return sum(abs(rates[r] - (low + high) / 2) for r, (low, high) in targets.items())
+    hits = [result for result in results
+            if all(low <= result[2][r] <= high for r, (low, high) in targets.items())]
+    unique = {result[1].config_hash(): result for result in hits}
+    return sorted(unique.values(), key=lambda result: deviation(result[2]))
+
+def format_report(results, targets, top=10):
+    roles = list(engine.ROLES)
+    hits = matching(results, targets)
+    lines = ["targets: " + ', '.join(f"{r} {low:.0%}-{high:.0%}" for r, (low, high) in targets.items()),
+             f"{len(hits)} of {len({result[1].config_hash() for result in results})} configs hit every target"]
+    for params, config, rates in hits[:top]:
+        lines.append(f"  {config.config_hash()[:12]}  " + ' '.join(f"{r}={rates[r]:.1%}" for r in roles))
+        lines.extend(f"      {path} = {value}" for path, value in params.items())
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep balance constants and report configs that hit target win rates.")
+    parser.add_argument('--mode', choices=['grid', 'random'], default='random')
+    parser.add_argument('--space', help="JSON file mapping config paths to value lists (default: built-in space)")
+    parser.add_argument('--points', type=int, default=1000, help="Points to draw in random mode")
+    parser.add_argument('--games', type=int, default=2000, help="Games per point (roles round-robin)")
+    parser.add_argument('--strategy', choices=['passive', 'greedy'], default='greedy')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Processes (1 = run in this process)")
+    parser.add_argument('--cache', default='sweep_cache.sqlite3', help="SQLite result cache ('' = no cache)")
+    parser.add_argument('--target', action='append', help="Win-rate band, 'low:high' or 'role=low:high' (repeatable)")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    space = load_space(args.space) if args.space else DEFAULT_SPACE
+    try:
+        targets = parse_targets(args.target)
+        points = list(grid_points(space) if args.mode == 'grid' else random_points(space, args.points, random.Random(args.seed)))
+    except ValueError as e:
+        parser.error(str(e))
+
+    cache = SweepCache(args.cache) if args.cache else None
+    started = time.perf_counter()
+    try:
+        results = sweep(points, args.games, args.seed, args.strategy, args.workers, cache,
+                        on_progress=lambda done, total: print(f"  {done}/{total} new points", file=sys.stderr))
+    except ValueError as e:
+        parser.error(str(e))
+    elapsed = time.perf_counter() - started
+    if cache:
+        cache.close()
+    print(f"mode={args.mode} points={len(points)} games/point={args.games} strategy={args.strategy} seed={args.seed}"
+          f" in {elapsed:.1f}s")
+    print(format_report(results, targets, args.top))
+
+
+if __name__ == '__main__':
+    main()
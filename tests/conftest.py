@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO) # The modules are flat files at the repo root
+
+STATEMENT = "I believe this project will bring many jobs and affordable homes to our community for years to come."
+PROFILE = {'name': 'Pat', 'age': '30', 'gender': 'Other', 'local_born': 'Yes', 'has_children': 'No',
+           'marital_status': 'Single', 'backstory': 'A long-time resident.'}
+
+
+@pytest.fixture
+def game_app(tmp_path, tmp_path_factory, monkeypatch):
+    """The sync app on a throwaway game store: stub LLM backend, fixed game seed, no reaper, no round workers."""
+    import app
+    from llm_backends import StubBackend
+    monkeypatch.setattr(app, 'GAME_STORE_PATH', str(tmp_path / 'games.sqlite3'))
+    monkeypatch.setattr(app, 'REAPER_ENABLED', False)
+    monkeypatch.setattr(app, '_game_store', None)
+    monkeypatch.setattr(app, '_round_queue', None)
+    monkeypatch.setattr(app, 'ROUND_WORKERS', 0) # Tests run queued rounds themselves
+    monkeypatch.setattr(app, 'llm', StubBackend())
+    monkeypatch.setattr(app, 'new_seed', lambda: 7)
+    monkeypatch.setattr(app.rooms, 'new_seed', lambda: 7)
+    # Configures once per process, so the session directory outlives this test
+    app.create_app({'SECRET_KEY': 'test', 'SESSION_FILE_DIR': str(tmp_path_factory.getbasetemp() / 'sessions')})
+    return app
+
+
+def start_game(client, role='developer'):
+    """Starts a game in the sync test client's session and returns its id."""
+    client.post('/', data={'role': role})
+    client.post('/customize', data=PROFILE)
+    with client.session_transaction() as session:
+        return session['game_id']
@@ -0,0 +1,106 @@
+import asyncio
+import re
+
+import pytest
+
+import app
+import engine
+from conftest import PROFILE, STATEMENT, start_game
+from llm_backends import StubBackend
+from llm_guard import GuardedBackend
+
+
+@pytest.fixture
+def async_app(game_app, monkeypatch):
+    """async_app over the same throwaway store and stub backend as game_app."""
+    import async_app
+    monkeypatch.setattr(async_app, '_store', None)
+    monkeypatch.setattr(async_app, 'new_seed', lambda: 7)
+    monkeypatch.setattr(async_app.app, 'secret_key', 'test')
+    return async_app.app
+
+
+def first_npc_id(page):
+    return re.search(r'data-char-id="(ai_\d+)"', page).group(1)
+
+
+class Hanging(StubBackend):
+    """Stub backend whose calls never return (ignoring their timeout) while hang is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.hang = True
+        self.calls = 0
+
+    async def acomplete(self, messages, model, max_tokens, temperature, timeout=None):
+        self.calls += 1
+        if self.hang:
+            await asyncio.sleep(3600)
+        return await super().acomplete(messages, model, max_tokens, temperature, timeout)
+
+
+def test_round_after_a_deadline_still_gets_llm_calls(monkeypatch):
+    backend = Hanging()
+    guarded = GuardedBackend(backend, max_concurrency=app.AI_SPEAKERS_PER_ROUND)
+    monkeypatch.setattr(app, 'llm', guarded)
+    monkeypatch.setattr(app, 'AI_RESPONSE_TIMEOUT', 0.05) # Round deadline: about a second
+    table, _ = engine.new_game(engine.create_player('developer', name='Pat'))
+
+    timed_out = asyncio.run(app.aget_ai_responses(table, [], STATEMENT, 50))
+    assert backend.calls == app.AI_SPEAKERS_PER_ROUND
+    assert guarded.concurrency.in_flight == 0 # The cancelled calls gave their slots back
+
+    backend.hang = False
+    responses = asyncio.run(asyncio.wait_for(app.aget_ai_responses(table, [], STATEMENT, 50), 5))
+    assert backend.calls == 2 * app.AI_SPEAKERS_PER_ROUND
+    spoken = [data['response'] for data in responses.values() if data['response'] is not None]
+    assert spoken and all('SCORE_CHANGE' not in text for text in spoken)
+    assert timed_out.keys() == responses.keys()
+
+
+def test_async_round_matches_the_sync_app(game_app, async_app):
+    client = game_app.app.test_client()
+    start_game(client)
+    assert client.post('/negotiation', data={'player_statement': STATEMENT}).status_code == 302
+    target_id = first_npc_id(client.get('/negotiation').get_data(as_text=True))
+    influenced = client.post('/influence', json={'action': 'gentle_persuasion', 'target_id': target_id}).get_json()
+    state = client.get('/negotiation/state').get_json()
+
+    async def play():
+        async with async_app.test_app():
+            client = async_app.test_client()
+            await client.post('/', form={'role': 'developer'})
+            await client.post('/customize', form=PROFILE)
+            response = await client.post('/negotiation', form={'player_statement': STATEMENT})
+            assert response.status_code == 302
+            page = await (await client.get('/negotiation')).get_data(as_text=True)
+            assert first_npc_id(page) == target_id
+            response = await client.post('/influence', json={'action': 'gentle_persuasion', 'target_id': target_id})
+            return await response.get_json(), await (await client.get('/negotiation/state')).get_json()
+
+    async_influenced, async_state = asyncio.run(play())
+    assert state['round'] == 2 and influenced['success']
+    assert async_influenced == influenced
+    assert async_state == state # Same seed, same stub replies: the same game
+
+
+def test_async_profile_and_missing_game(async_app):
+    async def play():
+        async with async_app.test_app():
+            client = async_app.test_client()
+            assert (await client.get('/negotiation')).status_code == 302 # No game yet: back to role selection
+            assert (await client.get('/profile/ai_1')).status_code == 404
+            response = await client.post('/influence', json={'action': 'gentle_persuasion', 'target_id': 'ai_1'})
+            assert response.status_code == 400
+
+            await client.post('/', form={'role': 'developer'})
+            await client.post('/customize', form=PROFILE)
+            target_id = first_npc_id(await (await client.get('/negotiation')).get_data(as_text=True))
+            response = await client.get('/profile/' + target_id)
+            assert response.status_code == 200
+            assert (await client.get('/profile/ai_999')).status_code == 404
+            assert (await client.get('/negotiation/state?since=-1')).status_code == 400
+            response = await client.post('/influence', form={'action': 'no_such_action', 'target_id': target_id})
+            assert response.status_code == 400 and not (await response.get_json())['success']
+
+    asyncio.run(play())
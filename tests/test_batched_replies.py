@@ -0,0 +1,15 @@
+import json
+
+import app
+import engine
+
+
+def test_non_finite_score_changes_are_dropped_not_raised():
+    table, _ = engine.new_game(engine.create_player('developer', name='Pat'))
+    first, second, third = table.ai_characters[:3]
+    entries = json.loads(f'[{{"id": "{first.id}", "dialogue": "Too big.", "score_change": 1e999}},'
+                         f' {{"id": "{second.id}", "dialogue": "Not a number.", "score_change": Infinity}},'
+                         f' {{"id": "{third.id}", "dialogue": "Fine.", "score_change": 3}}]')
+    results = app._parse_batched_entries(table.ai_characters, entries)
+    assert list(results) == [third.id]
+    assert results[third.id]['new_score'] == min(100, third.stance_score + 3)
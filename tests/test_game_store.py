@@ -0,0 +1,64 @@
+import sqlite3
+
+import engine
+from conftest import STATEMENT, start_game
+from game_store import SCHEMA_VERSION, GameStore
+
+
+def downgrade_to_schema_2(path):
+    """Rewrites a current store file into the schema 2 layout: no games.version, rounds.numbers or round_log."""
+    conn = sqlite3.connect(path)
+    conn.execute("ALTER TABLE games DROP COLUMN version")
+    conn.execute("ALTER TABLE rounds DROP COLUMN numbers")
+    conn.execute("DROP TABLE round_log")
+    conn.execute("PRAGMA user_version = 2")
+    conn.commit()
+    conn.close()
+
+
+def test_older_schema_is_migrated_keeping_games(tmp_path):
+    path = str(tmp_path / 'game_state.sqlite3')
+    table, negotiation_state = engine.new_game(engine.create_player('developer', name='Pat'))
+    game_id = GameStore(path).create_game(table, negotiation_state).id
+    downgrade_to_schema_2(path)
+
+    store = GameStore(path)
+    assert store._conn().execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    game = store.load_game(game_id)
+    assert game is not None and game.version == 1
+    game.negotiation_state['negotiation_climate'] = 70
+    store.save_game(game)
+    assert store.game_version(game_id) == 2
+    assert store.load_game(game_id).negotiation_state['negotiation_climate'] == 70
+
+
+def test_evict_loses_to_a_save_since_the_sweep_read_the_game(tmp_path):
+    store = GameStore(str(tmp_path / 'game_state.sqlite3'))
+    table, negotiation_state = engine.new_game(engine.create_player('developer', name='Pat'))
+    game = store.create_game(table, negotiation_state)
+    (_, _, last_used, _), = store.usage()
+
+    game.negotiation_state['negotiation_climate'] = 70 # Another worker saves the game after the sweep read it
+    store.save_game(game)
+    assert not store.evict(game.id, last_used)
+    assert store.load_game(game.id) is not None
+
+    (_, _, last_used, _), = store.usage()
+    assert store.evict(game.id, last_used)
+    assert store.load_game(game.id) is None and store.load_log(game.id) == []
+
+
+def test_round_for_a_game_evicted_while_waiting_for_its_lock_starts_over(game_app, monkeypatch):
+    client = game_app.app.test_client()
+    start_game(client)
+    store = game_app.get_game_store()
+    lock = store.lock
+
+    def lock_after_a_sweep(game_id):
+        store.delete_game(game_id) # The reaper evicts the game before the round takes its lock
+        return lock(game_id)
+
+    monkeypatch.setattr(store, 'lock', lock_after_a_sweep)
+    response = client.post('/negotiation', data={'player_statement': STATEMENT})
+    assert response.status_code == 302
+    assert response.headers['Location'] == '/'
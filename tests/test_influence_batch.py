@@ -0,0 +1,69 @@
+import pytest
+
+from conftest import start_game
+
+
+@pytest.fixture
+def client(game_app):
+    client = game_app.app.test_client()
+    start_game(client)
+    return client
+
+
+def state(client):
+    return client.get('/negotiation/state').get_json()
+
+
+def npc_ids(game_state):
+    return [char['id'] for char in game_state['characters'] if char['id'].startswith('ai_')]
+
+
+def test_batch_applies_every_action_in_one_save(client):
+    before = state(client)
+    first, second = npc_ids(before)[:2]
+    actions = [{'action': 'gentle_persuasion', 'target_id': first}, {'action': 'strong_persuasion', 'target_id': second}]
+
+    response = client.post('/influence/batch', json={'actions': actions})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['success'] and body['spent'] == 3
+    after = state(client)
+    assert after['player_tokens'] == before['player_tokens'] - 3 == body['player_tokens']
+    assert after['version'] == before['version'] + 1
+
+
+@pytest.mark.parametrize('invalid, status, message', [('over_budget', 400, 'Not enough Influence Tokens'),
+                                                     ('bad_action', 400, 'Unknown influence action'),
+                                                     ('bad_target', 404, 'Target NPC not found')])
+def test_invalid_batch_changes_nothing(client, invalid, status, message):
+    before = state(client)
+    target_id = npc_ids(before)[0]
+    actions = [{'action': 'gentle_persuasion', 'target_id': target_id}]
+    if invalid == 'over_budget':
+        actions += [{'action': 'gentle_persuasion', 'target_id': target_id}] * before['player_tokens']
+    elif invalid == 'bad_action':
+        actions.append({'action': 'bribery', 'target_id': target_id})
+    else:
+        actions.append({'action': 'gentle_persuasion', 'target_id': 'ai_999'})
+
+    response = client.post('/influence/batch', json={'actions': actions})
+
+    assert response.status_code == status
+    assert response.get_json()['message'].startswith(message)
+    assert state(client) == before # Not even the first, valid action was applied
+
+
+@pytest.mark.parametrize('body', [[{'action': 'gentle_persuasion', 'target_id': 'ai_1'}], 'actions', 3, None, {},
+                                  {'actions': []}, {'actions': 'gentle_persuasion'}, {'actions': ['ai_1']}])
+def test_malformed_batch_is_400(client, body):
+    before = state(client)
+    response = client.post('/influence/batch', json=body)
+    assert response.status_code == 400
+    assert not response.get_json()['success']
+    assert state(client) == before
+
+
+def test_form_post_is_400(client):
+    response = client.post('/influence/batch', data={'action': 'gentle_persuasion', 'target_id': 'ai_1'})
+    assert response.status_code == 400
@@ -0,0 +1,41 @@
+import asyncio
+import threading
+
+from llm_backends import StubBackend
+from llm_cache import CachedBackend
+
+MESSAGES = [{'role': 'system', 'content': "End with 'SCORE_CHANGE: +/-n'."}, {'role': 'user', 'content': "(Neutral) Hi."}]
+
+
+class LoopWatchingStore:
+    """Wraps the disk tier, recording whether it was called on the event loop's thread."""
+
+    def __init__(self, disk):
+        self.disk = disk
+        self.threads = set()
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return self.disk.get(key)
+
+    def put(self, key, completion):
+        self.threads.add(threading.get_ident())
+        self.disk.put(key, completion)
+
+
+def test_async_calls_use_the_disk_tier_off_the_event_loop(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cached = CachedBackend(StubBackend(), path=path)
+    cached._disk = watcher = LoopWatchingStore(cached._disk)
+
+    async def run():
+        first = await cached.acomplete(MESSAGES, 'model', 50, 0)
+        cached.clear() # Memory dropped: the next call is served from disk
+        second = await cached.acomplete(MESSAGES, 'model', 50, 0)
+        pieces = [piece async for piece in cached.astream(MESSAGES, 'model', 50, 0)]
+        return threading.get_ident(), first, second, pieces
+
+    loop_thread, first, second, pieces = asyncio.run(run())
+    assert second.cached and second.text == first.text and ''.join(pieces) == first.text
+    assert cached.stats()['disk_hits'] == 1 and cached.stats()['misses'] == 1
+    assert watcher.threads and loop_thread not in watcher.threads
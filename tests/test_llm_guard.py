@@ -0,0 +1,121 @@
+import asyncio
+
+from llm_backends import LLMBackend, StubBackend
+from llm_guard import CircuitBreaker, GuardedBackend
+
+NPC_MESSAGES = [
+    {'role': 'system', 'content': "You are Maria Garcia. End with 'SCORE_CHANGE: +/-n'."},
+    {'role': 'user', 'content': "Your current stance: (Neutral). Respond."},
+]
+
+
+class BadRequest(Exception):
+    status_code = 400
+
+
+class Scripted(LLMBackend):
+    """Raises the queued errors in turn, then answers like the stub."""
+    name = 'scripted'
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.stub = StubBackend()
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.stub.complete(messages, model, max_tokens, temperature, timeout)
+
+    def stream(self, messages, model, max_tokens, temperature, timeout=None):
+        yield 'first '
+        if self.errors:
+            raise self.errors.pop(0)
+        yield 'second'
+
+
+def open_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0)
+    breaker.record_failure()
+    return breaker
+
+
+def test_probe_answered_with_a_bad_request_closes_the_circuit():
+    guarded = GuardedBackend(Scripted(BadRequest('bad request')), breaker=open_breaker())
+    try:
+        guarded.complete(NPC_MESSAGES, 'model', 50, 0.5)
+    except BadRequest:
+        pass
+    assert guarded.breaker.state == 'closed'
+    assert not guarded.complete(NPC_MESSAGES, 'model', 50, 0.5).text.endswith('SCORE_CHANGE: +0')
+
+
+def test_probe_that_times_out_waiting_for_quota_lets_the_next_call_probe():
+    guarded = GuardedBackend(Scripted(), rpm=600, breaker=open_breaker())
+    guarded.requests.reserve(10) # Quota spent: the probe times out before calling the provider
+    try:
+        guarded.complete(NPC_MESSAGES, 'model', 50, 0.5, timeout=0.01)
+    except Exception:
+        pass
+    assert guarded.breaker.state == 'half_open'
+    assert guarded.breaker.allow() == 'probe'
+
+
+def test_stream_holds_its_slot_until_exhausted():
+    guarded = GuardedBackend(Scripted())
+    pieces = guarded.stream(NPC_MESSAGES, 'model', 50, 0.5)
+    assert next(pieces) == 'first '
+    assert guarded.concurrency.in_flight == 1
+    assert list(pieces) == ['second']
+    assert guarded.concurrency.in_flight == 0
+
+
+def test_stream_failing_midway_counts_against_the_circuit():
+    guarded = GuardedBackend(Scripted(ConnectionError('reset')), breaker=CircuitBreaker(failure_threshold=1))
+    try:
+        list(guarded.stream(NPC_MESSAGES, 'model', 50, 0.5))
+    except ConnectionError:
+        pass
+    assert guarded.concurrency.in_flight == 0
+    assert guarded.breaker.state == 'open'
+
+
+def test_closed_stream_frees_its_slot():
+    guarded = GuardedBackend(StubBackend())
+
+    async def read_one():
+        pieces = guarded.astream(NPC_MESSAGES, 'model', 50, 0.5)
+        await pieces.__anext__()
+        in_flight = guarded.concurrency.in_flight
+        await pieces.aclose()
+        return in_flight
+
+    assert asyncio.run(read_one()) == 1
+    assert guarded.concurrency.in_flight == 0
+    assert guarded.breaker.state == 'closed'
+
+
+def test_cancelled_calls_free_their_slots():
+    guarded = GuardedBackend(StubBackend(latency=5), max_concurrency=2)
+
+    async def cancel_in_flight(call):
+        task = asyncio.ensure_future(call())
+        await asyncio.sleep(0.05)
+        assert guarded.concurrency.in_flight == 1
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def first_piece():
+        async for piece in guarded.astream(NPC_MESSAGES, 'model', 50, 0.5):
+            return piece
+
+    async def run():
+        for _ in range(3): # More cancellations than slots
+            await cancel_in_flight(lambda: guarded.acomplete(NPC_MESSAGES, 'model', 50, 0.5))
+        await cancel_in_flight(first_piece)
+
+    asyncio.run(run())
+    assert guarded.concurrency.in_flight == 0
+    assert guarded.breaker.state == 'closed'
@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+from conftest import PROFILE
+from round_queue import RoundWorkerPool
+
+HOST_STATEMENT = "I believe this project will bring many jobs and affordable homes to our community for years to come."
+GUEST_STATEMENT = "As a neighbour I want the new park and the school expansion written into the plan before we vote."
+
+
+@pytest.fixture
+def room(game_app):
+    """(room id, host client, guest client): a room in its lobby with a second human seated."""
+    host = game_app.app.test_client()
+    host.post('/', data={'role': 'developer', 'mode': 'room'})
+    response = host.post('/customize', data=PROFILE)
+    with host.session_transaction() as session:
+        (room_id, _), = session['rooms'].items()
+    assert response.headers['Location'].endswith(f'/rooms/{room_id}')
+
+    guest = game_app.app.test_client()
+    assert guest.get(f'/rooms/{room_id}').headers['Location'].endswith(f'/rooms/{room_id}/join')
+    role_id = state(host, room_id)['room']['open_roles'][0]
+    guest.post(f'/rooms/{room_id}/join', data={'role': role_id})
+    response = guest.post('/customize', data={**PROFILE, 'name': 'Sam'})
+    assert response.headers['Location'].endswith(f'/rooms/{room_id}')
+    return room_id, host, guest
+
+
+def state(client, room_id):
+    response = client.get(f'/rooms/{room_id}/state')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def run_due_rounds(game_app):
+    """Plays every round job that can be claimed now; returns how many ran."""
+    queue = game_app.get_round_queue()
+    pool = RoundWorkerPool(queue, game_app.process_round_job, workers=0)
+    ran = 0
+    while (job := queue.claim()) is not None:
+        pool.run_job(job)
+        ran += 1
+    return ran
+
+
+def test_joining_takes_an_ai_seat(room):
+    room_id, host, guest = room
+    host_view, guest_view = state(host, room_id), state(guest, room_id)
+    humans = {human['id']: human['name'] for human in host_view['room']['humans']}
+    assert humans[host_view['room']['you']] == 'Pat' and host_view['room']['host'] == host_view['room']['you']
+    assert humans[guest_view['room']['you']] == 'Sam'
+    assert len(host_view['characters']) == len(guest_view['characters']) # The guest replaced an NPC
+    assert host_view['version'] == guest_view['version']
+
+
+def test_only_the_host_starts_and_nobody_joins_after(game_app, room):
+    room_id, host, guest = room
+    response = guest.post(f'/rooms/{room_id}/start')
+    assert response.status_code == 403
+    assert state(host, room_id)['room']['status'] == 'lobby'
+    assert host.post(f'/rooms/{room_id}/start').get_json()['success']
+    assert host.post(f'/rooms/{room_id}/start').status_code == 409
+
+    late = game_app.app.test_client()
+    assert late.get(f'/rooms/{room_id}/state').status_code == 404 # No seat in this room
+    response = late.post(f'/rooms/{room_id}/join', data={'role': 'local_resident'})
+    assert response.headers['Location'].endswith(f'/rooms/{room_id}/join') # Turned away
+    assert state(host, room_id)['room']['open_roles'] == []
+    assert len(state(host, room_id)['room']['humans']) == 2
+
+
+def test_round_waits_for_every_human_then_resolves_for_both(game_app, room):
+    room_id, host, guest = room
+    host.post(f'/rooms/{room_id}/start')
+    assert host.post(f'/rooms/{room_id}/statement', json={'player_statement': HOST_STATEMENT,
+                                                          'round': 1}).get_json()['success']
+    assert host.post(f'/rooms/{room_id}/statement', json={'player_statement': HOST_STATEMENT}).status_code == 409
+    assert run_due_rounds(game_app) == 0 # Held until the deadline while the guest has not spoken
+    guest_view = state(guest, room_id)
+    submitted = {human['id']: human['submitted'] for human in guest_view['room']['humans']}
+    assert submitted == {guest_view['room']['host']: True, guest_view['room']['you']: False}
+
+    assert guest.post(f'/rooms/{room_id}/statement', data={'player_statement': GUEST_STATEMENT}).get_json()['success']
+    assert run_due_rounds(game_app) == 1 # Everyone has spoken: released at once
+
+    host_view, guest_view = state(host, room_id), state(guest, room_id)
+    assert host_view['round'] == guest_view['round'] == 2
+    assert host_view['rounds'] == guest_view['rounds']
+    statements = host_view['rounds'][0]['statements']
+    humans = [human['id'] for human in host_view['room']['humans']]
+    assert [statement['id'] for statement in statements if statement['id'] in humans] == humans # Seat order
+    assert {statement['text'] for statement in statements} >= {HOST_STATEMENT, GUEST_STATEMENT}
+    assert len(statements) > len(humans) # The NPCs answered
+    assert not any(human['submitted'] for human in host_view['room']['humans'])
+    response = guest.post(f'/rooms/{room_id}/statement', json={'player_statement': GUEST_STATEMENT, 'round': 1})
+    assert response.status_code == 409 # Round 1 is over
+
+
+def test_events_stream_starts_with_the_room_state(room):
+    room_id, host, guest = room
+    response = guest.get(f'/rooms/{room_id}/events')
+    assert response.mimetype == 'text/event-stream'
+    frame = next(response.iter_encoded()).decode()
+    response.close()
+    event, data = frame.strip().split('\n')
+    assert event == 'event: state'
+    assert json.loads(data.removeprefix('data: '))['room']['you'] == state(guest, room_id)['room']['you']
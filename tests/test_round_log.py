@@ -0,0 +1,26 @@
+import engine
+from game_store import GameStore
+
+
+def drifting_policy(table, negotiation_state, player_statement, rng):
+    """Moves every AI by its seat number, like a policy's result: only the response and new score."""
+    return {ai.id: {'response': f"{ai.name} replies.", 'new_score': max(0, min(100, ai.stance_score + seat))}
+            for seat, ai in enumerate(table.ai_characters, start=1)}
+
+
+def test_round_log_records_each_npc_score_change(tmp_path):
+    store = GameStore(str(tmp_path / 'game_state.sqlite3'))
+    table, negotiation_state = engine.new_game(engine.create_player('developer', name='Pat'), seed=7)
+    game = store.create_game(table, negotiation_state)
+
+    engine.start_round(table, negotiation_state, engine.round_rng(negotiation_state)) # May fire an event moving stances
+    scores = {ai.id: ai.stance_score for ai in table.ai_characters}
+    statement = "Homes and jobs for the town."
+    engine.finish_round(table, negotiation_state, statement, drifting_policy(table, negotiation_state, statement, None))
+    store.save_game(game)
+
+    npc_entries = [entry for entry in store.load_log(game.id) if entry['kind'] == 'npc']
+    assert len(npc_entries) == len(scores)
+    for entry in npc_entries:
+        assert entry['score_change'] == entry['new_score'] - scores[entry['char_id']]
+    assert any(entry['score_change'] for entry in npc_entries)
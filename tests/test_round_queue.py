@@ -0,0 +1,31 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from conftest import REPO
+from game_store import GameStore
+from round_queue import RoundQueue
+
+
+def test_standalone_worker_fails_permanent_errors_once(tmp_path):
+    """`python -m round_queue` fails a job whose game is gone once, with the processor's error, not after retries."""
+    store_path = str(tmp_path / 'game_state.sqlite3')
+    GameStore(store_path) # The store owns the file's schema, as in app.get_round_queue()
+    env = dict(os.environ, GAME_STORE_PATH=store_path, LLM_BACKEND='stub', REAPER='0',
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO, os.environ.get('PYTHONPATH')])))
+    worker = subprocess.Popen([sys.executable, '-m', 'round_queue', '--workers', '1'], cwd=tmp_path, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        queue = RoundQueue(store_path)
+        job, created = queue.submit('no-such-game', 1, 'A statement for a game that does not exist.')
+        assert created
+        deadline = time.time() + 30
+        while queue.get(job.id).status in ('queued', 'running') and time.time() < deadline:
+            time.sleep(0.1)
+        job = queue.get(job.id)
+    finally:
+        worker.send_signal(signal.SIGTERM)
+        worker.wait(30)
+    assert (job.status, job.attempts, job.error) == ('failed', 1, 'Game not found.')
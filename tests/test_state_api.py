@@ -0,0 +1,60 @@
+import pytest
+
+from conftest import STATEMENT, start_game
+
+
+@pytest.fixture
+def client(game_app):
+    client = game_app.app.test_client()
+    start_game(client)
+    return client
+
+
+def play_round(client):
+    assert client.post('/negotiation', data={'player_statement': STATEMENT}).status_code == 302
+
+
+def test_etag_gets_304_until_the_game_changes(client):
+    response = client.get('/negotiation/state')
+    etag = response.headers['ETag']
+    assert etag.startswith('W/') and response.headers['Cache-Control'] == 'no-cache'
+    assert response.get_json()['version'] == 1
+
+    unchanged = client.get('/negotiation/state', headers={'If-None-Match': etag})
+    assert unchanged.status_code == 304 and unchanged.get_data() == b''
+    assert unchanged.headers['ETag'] == etag
+
+    play_round(client)
+    changed = client.get('/negotiation/state', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    # A delta's ETag names its base round, so it never matches the full state's
+    delta = client.get('/negotiation/state?since=1', headers={'If-None-Match': changed.headers['ETag']})
+    assert delta.status_code == 200
+
+
+def test_since_returns_only_later_rounds_and_changed_characters(client):
+    play_round(client)
+    full = client.get('/negotiation/state').get_json()
+    play_round(client)
+    delta = client.get('/negotiation/state?since=1').get_json()
+
+    assert set(delta) == set(full)
+    assert delta['since'] == 1 and full['since'] is None
+    assert delta['round'] == 3
+    assert [entry['round'] for entry in delta['rounds']] == [2]
+    assert all(set(statement) == {'id', 'name', 'text'} for statement in delta['rounds'][0]['statements'])
+    assert 0 < len(delta['characters']) <= len(full['characters'])
+    assert {char['id'] for char in delta['characters']} <= {char['id'] for char in full['characters']}
+    assert client.get('/negotiation/state?since=2').get_json()['rounds'] == []
+
+
+@pytest.mark.parametrize('since', ['abc', '', '-1', '1.5'])
+def test_bad_since_is_rejected(client, since):
+    play_round(client)
+    response = client.get(f'/negotiation/state?since={since}')
+    assert response.status_code == 400
+    assert not response.get_json()['success']
+
+
+def test_state_without_a_game_is_404(game_app):
+    assert game_app.app.test_client().get('/negotiation/state').status_code == 404
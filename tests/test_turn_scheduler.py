@@ -0,0 +1,79 @@
+import threading
+
+import app
+import engine
+import metrics
+from llm_backends import StubBackend
+
+
+class Counting(StubBackend):
+    """Stub backend that counts its completions."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def complete(self, messages, model, max_tokens, temperature, timeout=None):
+        with self._lock:
+            self.calls += 1
+        return super().complete(messages, model, max_tokens, temperature, timeout)
+
+
+def calls_saved():
+    """(rounds observed, listeners summed) from the calls-saved histogram at /metrics (absent until observed)."""
+    lines = dict(line.rsplit(' ', 1) for line in metrics.REGISTRY.render().splitlines()
+                 if line.startswith('npc_calls_saved_per_round_'))
+    return int(lines.get('npc_calls_saved_per_round_count', 0)), float(lines.get('npc_calls_saved_per_round_sum', 0))
+
+
+def seated_game():
+    table, _ = engine.new_game(engine.create_player('developer', name='Pat'), seed=7)
+    return table
+
+
+def test_named_npcs_speak_and_the_rest_listen(monkeypatch):
+    backend = Counting()
+    monkeypatch.setattr(app, 'llm', backend)
+    monkeypatch.setattr(app, 'AI_SPEAKERS_PER_ROUND', 2)
+    table = seated_game()
+    npcs = table.ai_characters
+    # The two NPCs the scheduler would otherwise rank last, addressed by name
+    quietest = sorted(npcs, key=lambda char: engine.npc_relevance(char, set(), False))[:2]
+    statement = f"{quietest[0].name.split()[0]} and {quietest[1].name.split()[0]}, this project brings jobs to town."
+    climate = 70 # Listeners drift towards support
+    rounds_before, saved_before = calls_saved()
+
+    responses = app.get_ai_responses(table, [], statement, climate)
+
+    assert list(responses) == [char.id for char in npcs]
+    assert backend.calls == 2
+    speaking = {ai_id for ai_id, data in responses.items() if data['response'] is not None}
+    assert speaking == {char.id for char in quietest}
+    for char in npcs:
+        if char.id not in speaking:
+            assert responses[char.id]['new_score'] == engine.listener_drift(char, climate)
+    assert calls_saved() == (rounds_before + 1, saved_before + len(npcs) - 2)
+
+
+def test_no_speaker_limit_calls_every_npc(monkeypatch):
+    backend = Counting()
+    monkeypatch.setattr(app, 'llm', backend)
+    monkeypatch.setattr(app, 'AI_SPEAKERS_PER_ROUND', None)
+    table = seated_game()
+    rounds_before, saved_before = calls_saved()
+
+    responses = app.get_ai_responses(table, [], "This project brings jobs to town.", 50)
+
+    assert backend.calls == len(table.ai_characters)
+    assert all(data['response'] is not None for data in responses.values())
+    assert calls_saved() == (rounds_before + 1, saved_before)
+
+
+def test_schedule_speakers_keeps_table_order():
+    npcs = seated_game().ai_characters
+    last = npcs[-1]
+    speakers, listeners = engine.schedule_speakers(npcs, f"What does {last.name} think?", [], 1)
+    assert speakers == [last]
+    assert listeners == npcs[:-1]
+    assert engine.schedule_speakers(npcs, "Anything", [], None) == (npcs, [])